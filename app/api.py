@@ -0,0 +1,511 @@
+"""JSON API for Translation Buddy phrasebooks.
+
+Reads go straight from SQL rows to JSON without building ORM objects.
+Writes go through the models so the phrasebook bookkeeping stays exact.
+Write routes only accept application/json bodies (or, for imports, text/csv and
+JSON Lines bodies), which browsers will not send cross-site without a CORS preflight.
+The one form upload, a multipart import, has to carry a CSRF token instead."""
+
+import base64
+import binascii
+import csv
+import json
+from functools import partial
+
+import deepl
+from flask import Blueprint, current_app, g, request, stream_with_context
+from flask_wtf.csrf import validate_csrf
+from sqlalchemy import select
+from wtforms import ValidationError
+
+from models import db, Phrasebook, PhrasebookTranslation, Translation, TranslationPopularity, phrase_text
+from imports import FORMATS, READERS, import_phrases
+from dispatcher import BULK
+from translation import translate_texts
+from replicas import read_only
+from practice import GRADES, due_cards, record_reviews
+from sync import changes_since
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+MAX_BULK = 1000
+
+# Import bodies that a cross-site form can't send without a CORS preflight.
+UPLOAD_TYPES = {"text/csv": "csv", "application/x-ndjson": "jsonl", "application/jsonl": "jsonl"}
+
+phrasebooks = Phrasebook.__table__
+pb_translations = PhrasebookTranslation.__table__
+translations = Translation.__table__
+popularity = TranslationPopularity.__table__
+
+PHRASEBOOK_FIELDS = {
+    "id": phrasebooks.c.id,
+    "name": phrasebooks.c.name,
+    "user_id": phrasebooks.c.user_id,
+    "public": phrasebooks.c.public,
+    "lang_from": phrasebooks.c.lang_from,
+    "lang_to": phrasebooks.c.lang_to,
+    "version": phrasebooks.c.version,
+}
+
+TRANSLATION_FIELDS = {
+    "id": translations.c.id,
+    "lang_from": translations.c.lang_from,
+    "lang_to": translations.c.lang_to,
+    "text_from": phrase_text(translations.c.phrase_from_id),
+    "text_to": phrase_text(translations.c.phrase_to_id),
+}
+
+# Translations listed inside the user's own phrasebooks also carry their private note.
+ENTRY_FIELDS = dict(TRANSLATION_FIELDS, note=pb_translations.c.note)
+
+POPULAR_FIELDS = dict(TRANSLATION_FIELDS, saves=popularity.c.saves)
+
+
+class APIError(Exception):
+    """Error returned to the client as a JSON body with an HTTP status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+##############################################################################
+# Helper functions
+
+def dumps(data):
+    """Serialize data with orjson when it is installed, otherwise with compact stdlib json."""
+
+    if orjson:
+        return orjson.dumps(data)
+
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def json_response(data, status=200):
+    return current_app.response_class(dumps(data), status=status, mimetype="application/json")
+
+
+def encode_cursor(last_id):
+    """Return an opaque cursor pointing after last_id."""
+
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return the id a cursor points after. A missing cursor starts from the beginning."""
+
+    if not cursor:
+        return 0
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, binascii.Error):
+        raise APIError(400, "Invalid cursor.")
+
+
+def page_limit():
+    """Read the page size from the query string."""
+
+    try:
+        limit = int(request.args.get("limit", DEFAULT_LIMIT))
+    except ValueError:
+        raise APIError(400, "limit must be an integer.")
+
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def selected_columns(allowed, param="fields"):
+    """Return the columns named in a sparse fieldset parameter, or all of them.
+    The id is always included since cursors and clients depend on it."""
+
+    requested = request.args.get(param)
+    if not requested:
+        return [column.label(name) for name, column in allowed.items()]
+
+    names = [name.strip() for name in requested.split(",") if name.strip()]
+    unknown = [name for name in names if name not in allowed]
+    if unknown:
+        raise APIError(400, f"Unknown field(s): {', '.join(unknown)}")
+
+    if "id" not in names:
+        names.insert(0, "id")
+
+    return [allowed[name].label(name) for name in names]
+
+
+def paginate(query, id_column, limit):
+    """Run a keyset paginated query, returning (rows, next_cursor)."""
+
+    after = decode_cursor(request.args.get("cursor"))
+    query = query.where(id_column > after).order_by(id_column).limit(limit + 1)
+    rows = [dict(row) for row in db.session.execute(query).mappings()]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["id"])
+
+    return rows, next_cursor
+
+
+def entry_fields(pb):
+    """Notes are private, so they are only listed for the owner's phrasebooks."""
+
+    return ENTRY_FIELDS if pb.user_id == g.user.id else TRANSLATION_FIELDS
+
+
+def entries_query(pb_id, columns):
+    """Select a phrasebook's translations together with their notes."""
+
+    return (select(*columns)
+            .select_from(pb_translations.join(translations))
+            .where(pb_translations.c.phrasebook_id == pb_id))
+
+
+def visible_translations(ids):
+    """Select which of ids are saved in one of the user's phrasebooks or in a public phrasebook."""
+
+    return (select(pb_translations.c.translation_id)
+            .select_from(pb_translations.join(phrasebooks))
+            .where(pb_translations.c.translation_id.in_(ids))
+            .where((phrasebooks.c.user_id == g.user.id) | (phrasebooks.c.public == True)))
+
+
+def readable_phrasebook(pb_id):
+    """Return the phrasebook row if the current user owns it or it is public."""
+
+    row = db.session.execute(
+        select(phrasebooks.c.id, phrasebooks.c.user_id, phrasebooks.c.public)
+        .where(phrasebooks.c.id == pb_id)).first()
+
+    if row is None or (row.user_id != g.user.id and not row.public):
+        raise APIError(404, "Phrasebook not found.")
+
+    return row
+
+
+def owned_phrasebook(pb_id):
+    """Return the Phrasebook if it belongs to the current user."""
+
+    pb = Phrasebook.query.get(pb_id)
+
+    if pb is None or pb.user_id != g.user.id:
+        raise APIError(404, "Phrasebook not found.")
+
+    return pb
+
+
+def json_body(key):
+    """Return the list stored under key in the request's JSON body."""
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get(key), list):
+        raise APIError(400, f"Request body must be a JSON object with a '{key}' list.")
+
+    if len(data[key]) > MAX_BULK:
+        raise APIError(400, f"At most {MAX_BULK} items can be sent at once.")
+
+    return data[key]
+
+
+##############################################################################
+# Before request / errors
+
+@api.before_request
+def require_login():
+    """Every API route acts on behalf of the logged in user."""
+
+    if not g.user:
+        return json_response({"error": "Login required."}, 401)
+
+
+@api.errorhandler(APIError)
+def handle_api_error(e):
+    return json_response({"error": e.message}, e.status)
+
+
+##############################################################################
+# User / phrasebook routes
+
+@api.route("/user")
+@read_only
+def show_user():
+    """Show the current user."""
+
+    return json_response({"id": g.user.id, "username": g.user.username})
+
+
+@api.route("/phrasebooks")
+@read_only
+def list_phrasebooks():
+    """List the current user's phrasebooks, or other users' public ones with ?public=1."""
+
+    query = select(*selected_columns(PHRASEBOOK_FIELDS))
+
+    if request.args.get("public") in ("1", "true"):
+        query = query.where(phrasebooks.c.public == True, phrasebooks.c.user_id != g.user.id)
+    else:
+        query = query.where(phrasebooks.c.user_id == g.user.id)
+
+    rows, next_cursor = paginate(query, phrasebooks.c.id, page_limit())
+
+    return json_response({"data": rows, "next_cursor": next_cursor})
+
+
+@api.route("/phrasebooks/<int:pb_id>")
+@read_only
+def show_phrasebook(pb_id):
+    """Show one phrasebook. With ?embed=translations all its translations and notes are included."""
+
+    pb = readable_phrasebook(pb_id)
+
+    query = select(*selected_columns(PHRASEBOOK_FIELDS)).where(phrasebooks.c.id == pb_id)
+    data = dict(db.session.execute(query).mappings().one())
+
+    if "translations" in request.args.get("embed", "").split(","):
+        columns = selected_columns(entry_fields(pb), "translation_fields")
+        query = entries_query(pb_id, columns).order_by(translations.c.id)
+        data["translations"] = [dict(row) for row in db.session.execute(query).mappings()]
+
+    return json_response({"data": data})
+
+
+##############################################################################
+# Phrasebook translation routes
+
+@api.route("/phrasebooks/<int:pb_id>/translations")
+@read_only
+def list_phrasebook_translations(pb_id):
+    """List the translations in a phrasebook along with their notes."""
+
+    pb = readable_phrasebook(pb_id)
+
+    query = entries_query(pb_id, selected_columns(entry_fields(pb)))
+    rows, next_cursor = paginate(query, translations.c.id, page_limit())
+
+    return json_response({"data": rows, "next_cursor": next_cursor})
+
+
+@api.route("/phrasebooks/<int:pb_id>/translations", methods=["POST"])
+def add_phrasebook_translations(pb_id):
+    """Add translations to one of the user's phrasebooks.
+    Each item is either {"id": ...} for a saved translation, or the full
+    lang_from / lang_to / text_from / text_to of a new one. Items may carry a note."""
+
+    pb = owned_phrasebook(pb_id)
+    items = json_body("translations")
+
+    ids = set()
+    keys = set()
+    for item in items:
+        if not isinstance(item, dict):
+            raise APIError(400, "Each translation must be a JSON object.")
+        if item.get("note") is not None and not isinstance(item["note"], str):
+            raise APIError(400, "Notes must be strings.")
+        if "id" in item:
+            if not isinstance(item["id"], int):
+                raise APIError(400, "Translation ids must be integers.")
+            ids.add(item["id"])
+            continue
+        fields = [item.get(f) for f in ("lang_from", "lang_to", "text_from", "text_to")]
+        if not all(isinstance(f, str) and f.strip() for f in fields):
+            raise APIError(400, "New translations need lang_from, lang_to, text_from and text_to.")
+        keys.add(tuple(fields))
+
+    by_id = ({t.id: t for t in Translation.query.filter(Translation.id.in_(visible_translations(ids)))}
+             if ids else {})
+    missing = ids - set(by_id)
+    if missing:
+        raise APIError(404, f"Translation(s) not found: {', '.join(map(str, sorted(missing)))}")
+
+    by_key = Translation.find_existing(keys)
+    for key in keys:
+        if key not in by_key:
+            lang_from, lang_to, text_from, text_to = key
+            by_key[key] = Translation(lang_from=lang_from, lang_to=lang_to,
+                                      text_from=text_from, text_to=text_to)
+            db.session.add(by_key[key])
+    db.session.flush()
+
+    ordered = []
+    notes = {}
+    for item in items:
+        if "id" in item:
+            t = by_id[item["id"]]
+        else:
+            t = by_key[tuple(item[f] for f in ("lang_from", "lang_to", "text_from", "text_to"))]
+        ordered.append(t)
+        if item.get("note"):
+            notes[t.id] = item["note"]
+
+    added = pb.add_translations(ordered, notes)
+    db.session.commit()
+
+    return json_response({"added": [t.id for t in added],
+                          "skipped": sorted({t.id for t in ordered} - {t.id for t in added})}, 201)
+
+
+@api.route("/phrasebooks/<int:pb_id>/translations", methods=["DELETE"])
+def delete_phrasebook_translations(pb_id):
+    """Remove translations from one of the user's phrasebooks, deleting any that are orphaned."""
+
+    pb = owned_phrasebook(pb_id)
+    ids = json_body("ids")
+
+    if not all(isinstance(t_id, int) for t_id in ids):
+        raise APIError(400, "ids must be a list of integers.")
+
+    removed = pb.delete_translations(ids)
+    db.session.commit()
+
+    return json_response({"deleted": removed})
+
+
+def upload_format(filename=None):
+    """Work out whether an upload is CSV or JSON Lines from ?format=, the file name or the content type."""
+
+    fmt = request.args.get("format")
+    if not fmt and filename and "." in filename:
+        fmt = filename.rsplit(".", 1)[1].lower()
+    if not fmt:
+        fmt = UPLOAD_TYPES.get(request.mimetype)
+
+    if fmt == "ndjson":
+        fmt = "jsonl"
+    if fmt not in FORMATS:
+        raise APIError(400, "Upload must be CSV or JSON Lines (set ?format=csv or ?format=jsonl).")
+
+    return fmt
+
+
+@api.route("/phrasebooks/<int:pb_id>/import", methods=["POST"])
+def import_phrasebook_translations(pb_id):
+    """Import phrases from a CSV or JSON Lines upload, sent as a text/csv or application/x-ndjson body
+    or as a "file" form field with a csrf_token field (or X-CSRFToken header).
+    Phrases without text_to are translated. Progress is streamed back as JSON Lines, one line per batch,
+    ending with a line that has "done": true (or "error" if the import stopped early)."""
+
+    if request.mimetype == "multipart/form-data":
+        try:
+            validate_csrf(request.form.get("csrf_token") or request.headers.get("X-CSRFToken"))
+        except ValidationError:
+            raise APIError(400, "Form uploads need a valid CSRF token.")
+    elif request.mimetype not in UPLOAD_TYPES:
+        raise APIError(415, f"Upload must be sent as {', '.join(UPLOAD_TYPES)} or as a multipart form.")
+
+    pb = owned_phrasebook(pb_id)
+
+    if request.mimetype == "multipart/form-data":
+        upload = request.files.get("file")
+        if upload is None:
+            raise APIError(400, "Missing 'file' upload.")
+        rows = READERS[upload_format(upload.filename)](upload.stream)
+    else:
+        rows = READERS[upload_format()](request.stream)
+
+    def progress():
+        try:
+            for totals in import_phrases(pb, rows, partial(translate_texts, priority=BULK, user=g.user.id)):
+                yield dumps(totals) + b"\n"
+        except (ValueError, csv.Error, deepl.DeepLException) as e:
+            db.session.rollback()
+            yield dumps({"error": str(e)}) + b"\n"
+
+    return current_app.response_class(stream_with_context(progress()), mimetype="application/x-ndjson")
+
+
+##############################################################################
+# Translation routes
+
+@api.route("/translations/<int:t_id>")
+@read_only
+def show_translation(t_id):
+    """Show a translation saved in one of the user's phrasebooks or in a public phrasebook."""
+
+    query = (select(*selected_columns(TRANSLATION_FIELDS))
+             .where(translations.c.id == t_id, translations.c.id.in_(visible_translations([t_id]))))
+    row = db.session.execute(query).mappings().first()
+
+    if row is None:
+        raise APIError(404, "Translation not found.")
+
+    return json_response({"data": dict(row)})
+
+
+@api.route("/translations/popular")
+@read_only
+def list_popular_translations():
+    """List the translations saved in the most public phrasebooks for ?lang_from=&lang_to=, most saved first."""
+
+    lang_from = request.args.get("lang_from", "").upper()
+    lang_to = request.args.get("lang_to", "").upper()
+    if not lang_from or not lang_to:
+        raise APIError(400, "lang_from and lang_to are required.")
+
+    query = (select(*selected_columns(POPULAR_FIELDS))
+             .select_from(popularity.join(translations))
+             .where(popularity.c.lang_from == lang_from, popularity.c.lang_to == lang_to)
+             .order_by(popularity.c.saves.desc(), popularity.c.translation_id)
+             .limit(page_limit()))
+
+    return json_response({"data": [dict(row) for row in db.session.execute(query).mappings()]})
+
+
+##############################################################################
+# Practice routes
+
+@api.route("/practice/due")
+@read_only
+def list_due_cards():
+    """List the user's review cards that are due, soonest first. ?phrasebook_id= practices one phrasebook."""
+
+    phrasebook_id = request.args.get("phrasebook_id")
+    if phrasebook_id is not None and not phrasebook_id.isdigit():
+        raise APIError(400, "phrasebook_id must be an integer.")
+
+    rows = due_cards(g.user.id, page_limit(), int(phrasebook_id) if phrasebook_id else None)
+
+    return json_response({"data": rows})
+
+
+@api.route("/practice/reviews", methods=["POST"])
+def add_reviews():
+    """Record a batch of answers, each {"phrasebook_id": ..., "translation_id": ..., "grade": ...}
+    with a grade of again, hard, good or easy."""
+
+    reviews = []
+    for item in json_body("reviews"):
+        if not (isinstance(item, dict) and isinstance(item.get("phrasebook_id"), int)
+                and isinstance(item.get("translation_id"), int) and item.get("grade") in GRADES):
+            raise APIError(400, f"Each review needs integer phrasebook_id and translation_id and a grade of {', '.join(GRADES)}.")
+        reviews.append((item["phrasebook_id"], item["translation_id"], item["grade"]))
+
+    updated = record_reviews(g.user.id, reviews)
+    db.session.commit()
+
+    return json_response({"updated": len(updated)})
+
+
+##############################################################################
+# Sync routes
+
+@api.route("/sync")
+@read_only
+def sync():
+    """Return phrasebook inserts, updates and tombstones since ?since=<cursor>.
+    Without a cursor (or with one older than the compacted history) a full snapshot is returned."""
+
+    since = request.args.get("since")
+    changes = changes_since(g.user, decode_cursor(since) if since else None)
+    changes["cursor"] = encode_cursor(changes["cursor"])
+
+    return json_response(changes)
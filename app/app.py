@@ -1,61 +1,98 @@
-from flask import Flask, render_template, url_for, session, redirect, flash, jsonify, g, request
+from flask import Flask, Blueprint, render_template, url_for, session, redirect, flash, jsonify, g, request, make_response, current_app, has_request_context, get_flashed_messages
+from flask.cli import with_appcontext
+from flask_sqlalchemy import get_state
 from flask_debugtoolbar import DebugToolbarExtension
-from models import db, connect_db, User, Translation, Phrasebook, PhrasebookTranslation
+from models import db, connect_db, User, Translation, Phrasebook, PhrasebookTranslation, TranslationPopularity, TranslationNeighbors
 from forms import LoginForm, UserAddForm, TranslateForm, UserEditForm, PhrasebookForm, AddTranslationForm, NoteForm, EditPhrasebookForm, FilterPhrasebookFrom
-from sqlalchemy.exc import IntegrityError
-import deepl
+from templating import init_templates
+from assets import init_assets, etag_variants
+from database import engine_options
+from replicas import init_replicas, read_only
+from dispatcher import INTERACTIVE, INTERACTIVE_DEADLINE, DeadlineExceeded, dispatcher
+from ratelimit import init_rate_limits, parse_limits, prune_buckets
+from metrics import metrics
+from profiling import init_profiling, profile_signature
+from slow_queries import init_slow_queries
+from logs import init_logging, parse_sample_rates, start_listener
+from api import api
+from practice import GRADES
+from sync import compact_change_log
+from query_plans import check_query_plans
+import migrations
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import selectinload
+from translation import (API_AUTH_KEY, AUTO_DETECT, deepl_translate, reset_translator, load_languages,
+                         resolve_source_language, deepl_source_language, lookup_translation, remember_result)
 try:
-    from secret import API_AUTH_KEY, SESSION_KEY
+    from secret import SESSION_KEY
 except ImportError:
-    API_AUTH_KEY = None
     SESSION_KEY = None
-    print('Secret file not found.')
 
 import os
+import logging
+import hashlib
+import time
+from datetime import timedelta
+import click
+import weakref
+from urllib.parse import urlsplit
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+views = Blueprint("views", __name__)
 
-try:
-    prodURI = os.getenv('DATABASE_URL')
-    app.config['SQLALCHEMY_DATABASE_URI'] = prodURI 
-except:
-    # For running locally
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///translator-app'
-    
 
-    
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+##############################################################################
+# Translation functions
 
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', SESSION_KEY)
+def source_languages():
+    return current_app.config["SOURCE_LANGUAGES"]
 
-toolbar = DebugToolbarExtension(app)
 
-connect_db(app)
+def target_languages():
+    return current_app.config["TARGET_LANGUAGES"]
 
-API_AUTH_KEY = os.environ.get("API_AUTH_KEY"
-                              , API_AUTH_KEY
-                              )
-translator = deepl.Translator(API_AUTH_KEY)
 
+def translate_source_languages():
+    """Source language choices for the translate form, led by automatic detection."""
+    return ((AUTO_DETECT, "Detect language"),) + source_languages()
 
-source_languages = [(l.code, l.name) for l in translator.get_source_languages()]
-target_languages = [(l.code, l.name) for l in translator.get_target_languages()]
 
+def dispatch_user():
+    """Whose turn a DeepL request takes in the dispatcher: the user, or the client address when logged out."""
+    if not has_request_context():
+        return None
+    return g.user.id if g.get("user") else request.remote_addr
 
-##############################################################################
-# Translation functions
 
 def get_translation(text, source_lang, target_lang):
-    """Fetches translation data from API and creates a new Translation object."""
-    result = translator.translate_text(text, source_lang=source_lang, target_lang=target_lang)
+    """Fetches translation data from API and creates a new Translation object.
+    A source_lang of AUTO_DETECT is guessed locally where possible, so the cache is checked
+    before DeepL is asked; on a miss DeepL detects the language itself. The DeepL request is
+    interactive: it goes ahead of bulk work and raises DeadlineExceeded if it can't start in time."""
+    guessed_lang = resolve_source_language(text, source_lang)
+    text_to = lookup_translation(text, guessed_lang, target_lang)
+
+    if text_to is None:
+        source_lang = deepl_source_language(source_lang)
+        with dispatcher.slot(INTERACTIVE, user=dispatch_user(),
+                             deadline=time.monotonic() + INTERACTIVE_DEADLINE):
+            result = deepl_translate(text, source_lang, target_lang)
+        source_lang = source_lang or result.detected_source_lang
+        text_to = result.text
+        remember_result(text, source_lang, target_lang, text_to)
+    else:
+        source_lang = guessed_lang
+    
+    return make_translation(text, source_lang, target_lang, text_to)
+
+
+def make_translation(text, source_lang, target_lang, text_to):
+    """Create a new (unsaved) Translation object from a translation result."""
     translation = Translation(lang_from=source_lang,
                             lang_to=target_lang,
                             text_from=text,
-                            text_to=result.text)
+                            text_to=text_to)
     
     return translation
 
@@ -63,7 +100,7 @@ def get_translation(text, source_lang, target_lang):
 ##############################################################################
 # Before request
 
-@app.before_request
+@views.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
@@ -73,14 +110,7 @@ def add_user_to_g():
     else:
         g.user = None
         
-@app.before_request
-def add_langs_to_g():
-    """If user is logged in, put language codes and names in Flask global"""
-   
-    if CURR_USER_KEY in session:
-        g.langs = source_languages
-        
-@app.before_request
+@views.before_app_request
 def set_default_sort():
     """Set default phrasebook sorting method to id if not set by user.
     Otherwise user and public phrasebooks will return an error.""" 
@@ -92,6 +122,28 @@ def set_default_sort():
         session["sort_public"] = "id"
 
 
+@views.after_app_request
+def refresh_stale_recommendations(response):
+    """After a request that committed changes to public phrasebooks, recompute a small batch of
+    the recommendations it made stale. The batch is bounded (RECOMMENDATIONS_REFRESH_BATCH) and
+    taken with SKIP LOCKED, so concurrent requests refresh different rows; the refresh-recommendations
+    command drains bigger backlogs, such as the one migration 0007 queues."""
+
+    if not db.session.info.pop("neighbors_stale", False):
+        return response
+    if db.session.new or db.session.dirty or db.session.deleted:
+        return response
+
+    try:
+        TranslationNeighbors.refresh(db.session.connection(), current_app.config['RECOMMENDATIONS_REFRESH_BATCH'])
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        current_app.logger.exception("Refreshing recommendations failed")
+
+    return response
+
+
 ##############################################################################
 # Helper functions
 def clear_translation():
@@ -108,10 +160,6 @@ def reset_sort():
 def reset_filter():
     """Reset filter if user navigates away from page. """
 
-    if request.path == "/user":
-        if 'filter' in session and request.referrer != request.url: 
-            del session['filter']
-        
     if request.path == "/public":  
         if 'filter_public_from' in session and request.referrer != request.url: 
             del session['filter_public_from']
@@ -132,6 +180,99 @@ def find_existing_translation(translation):
         return found
     return False
         
+def phrasebook_notes(user_id):
+    """Return {(phrasebook id, translation id): note} for all of a user's noted translations."""
+
+    rows = (db.session.query(PhrasebookTranslation.phrasebook_id,
+                             PhrasebookTranslation.translation_id,
+                             PhrasebookTranslation.note)
+            .join(Phrasebook)
+            .filter(Phrasebook.user_id == user_id,
+                    PhrasebookTranslation.note != None))
+    
+    return {(pb_id, t_id): note for pb_id, t_id, note in rows}
+
+
+def phrasebook_versions(*criteria):
+    """Return (id, version, owner username) rows for the phrasebooks matching criteria.
+    This is the version vector used to build phrasebook page ETags. It never loads translations."""
+
+    return (db.session.query(Phrasebook.id, Phrasebook.version, User.username)
+            .join(User)
+            .filter(*criteria)
+            .order_by(Phrasebook.id)
+            .all())
+
+
+PHRASEBOOK_SORTS = {"id": Phrasebook.id,
+                    "name": db.func.lower(Phrasebook.name),
+                    "lang_to": Phrasebook.lang_to}
+
+
+def user_phrasebooks(user_id, sort="id", lang=None):
+    """Return the user's phrasebooks in display order, only those translating into lang if given.
+    Their translations are loaded with one extra query."""
+
+    query = Phrasebook.query.filter(Phrasebook.user_id == user_id)
+    if lang:
+        query = query.filter(Phrasebook.lang_to == lang)
+
+    return (query.order_by(PHRASEBOOK_SORTS[sort], Phrasebook.id)
+            .options(selectinload(Phrasebook.translations))
+            .all())
+
+
+def phrasebook_languages(user_id):
+    """Return the distinct languages of the user's phrasebooks, for the filter menu."""
+
+    return [lang for (lang,) in db.session.query(Phrasebook.lang_to)
+                                          .filter(Phrasebook.user_id == user_id)
+                                          .distinct()
+                                          .order_by(Phrasebook.lang_to)]
+
+
+def csrf_window():
+    """Return the CSRF state that rendered forms depend on.
+    Tokens embedded in a cached page expire, so pages are only reused within half the token lifetime."""
+
+    limit = current_app.config.get("WTF_CSRF_TIME_LIMIT", 3600)
+    window = int(time.time() // (limit // 2)) if limit else None
+    
+    return session.get("csrf_token"), window
+
+
+def page_etag(*parts):
+    """Build a strong ETag from the data versions and session state a page depends on.
+    Pending flash messages are part of the page, so they are always included."""
+
+    parts += (session.get("_flashes"), csrf_window())
+    
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+def not_modified(etag):
+    """Return an empty 304 response if the client already has the page for etag (in any encoding), otherwise None.
+    The client's copy already shows the pending flash messages, so they are consumed here as a render would."""
+
+    for tag in etag_variants(etag):
+        if request.if_none_match.contains(tag):
+            get_flashed_messages()
+            resp = current_app.response_class(status=304)
+            resp.set_etag(tag)
+            resp.headers["Cache-Control"] = "private, no-cache"
+            return resp
+
+
+def etag_response(html, etag):
+    """Wrap rendered html in a response the browser must revalidate with its ETag."""
+
+    resp = make_response(html)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    
+    return resp
+
+
 def unauthorized():
     """Check if user is logged in. If not redirect home and flash message."""
         
@@ -139,6 +280,19 @@ def unauthorized():
     return redirect("/")
 
 
+def wants_fragment():
+    """Check if the request came from app.js, which updates the page in place from a
+    small fragment or JSON delta instead of following a redirect to the full page."""
+
+    return request.headers.get("X-Requested-With") == "XMLHttpRequest"
+
+
+def fragment_error(message, status=400):
+    """Answer a failed in-place update. app.js then resubmits the form normally."""
+
+    return jsonify(error=message), status
+
+
 
 def do_login(user):
     """Log in user."""
@@ -156,7 +310,7 @@ def do_logout():
 ##############################################################################
 # User signup/login/logout
 
-@app.route('/signup', methods=["POST"])
+@views.route('/signup', methods=["POST"])
 def signup():
     """Handle user signup.
     Create new user and add to DB. Redirect to home page.
@@ -194,7 +348,7 @@ def signup():
     return redirect("/")
 
 
-@app.route('/login', methods=["POST"])
+@views.route('/login', methods=["POST"])
 def login():
     """Handle user login."""
 
@@ -214,7 +368,7 @@ def login():
     return redirect("/")
 
 
-@app.route('/logout')
+@views.route('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -230,7 +384,8 @@ def logout():
 ####################################################################################
 # Home Page
 
-@app.route('/')
+@views.route('/')
+@read_only
 def home():
 
 
@@ -239,14 +394,14 @@ def home():
     
     phrasebook_add_form = PhrasebookForm(lang_from = session.get("lang_from") or "EN", 
                                          lang_to = session.get("lang_to") or "ES",)
-    phrasebook_add_form.lang_from.choices = source_languages
-    phrasebook_add_form.lang_to.choices = source_languages
+    phrasebook_add_form.lang_from.choices = source_languages()
+    phrasebook_add_form.lang_to.choices = source_languages()
     
     translate_form = TranslateForm(source_lang = session.get("lang_from") or "EN",
                                    target_lang = session.get("lang_to") or "ES", 
                                    translate_text = session.get("last_translation", {}).get("text_from"))
-    translate_form.target_lang.choices = target_languages
-    translate_form.source_lang.choices = source_languages
+    translate_form.target_lang.choices = target_languages()
+    translate_form.source_lang.choices = translate_source_languages()
     
     save_translation_form = AddTranslationForm()
     
@@ -261,25 +416,39 @@ def home():
 ####################################################################################
 # Translate Routes
 
-@app.route('/translate', methods=["POST"])
-def translate():
-    """Fetch translation from API and create new translation object."""
+def translate_form():
+    """Build the translate form with its language choices."""
     form = TranslateForm()
-    form.source_lang.choices = source_languages
-    form.target_lang.choices = target_languages
+    form.source_lang.choices = translate_source_languages()
+    form.target_lang.choices = target_languages()
+    
+    return form
+
 
+def remember_translation(translation):
+    """Keep the latest translation and its (possibly detected) languages in the session for the home page."""
+    session["lang_from"] = translation.lang_from
+    session["lang_to"] = translation.lang_to
+    session["last_translation"] = translation.to_dict()
 
 
+@views.route('/translate', methods=["POST"])
+def translate():
+    """Fetch translation from API and create new translation object.
+    Under the ASGI entry point (asgi.py) this route is served by a non-blocking variant."""
+    form = translate_form()
 
     if form.validate_on_submit():
         
-        translation = get_translation(form.translate_text.data, 
-                                      form.source_lang.data, 
-                                      form.target_lang.data)
+        try:
+            translation = get_translation(form.translate_text.data, 
+                                          form.source_lang.data, 
+                                          form.target_lang.data)
+        except DeadlineExceeded:
+            flash("The translator is busy right now. Please try again.", 'danger')
+            return redirect("/")
 
-        session["lang_from"] = form.source_lang.data
-        session["lang_to"] = translation.lang_to
-        session["last_translation"] = translation.to_dict()
+        remember_translation(translation)
 
         return redirect("/")
     
@@ -287,7 +456,7 @@ def translate():
     return redirect("/")
 
     
-@app.route("/clear")
+@views.route("/clear")
 def clear_translation():
     if "last_translation" in session:
         del session['last_translation']
@@ -297,7 +466,8 @@ def clear_translation():
 # User Routes
 
 
-@app.route('/user')
+@views.route('/user')
+@read_only
 def show_user():
     """Show user profile and phrasebooks."""
 
@@ -305,24 +475,47 @@ def show_user():
     if not g.user: return unauthorized()
     
     clear_translation()
-    reset_filter()
+    
+    # ?sort= is remembered for later visits, ?lang= filters this view only
+    if request.args.get("sort") in PHRASEBOOK_SORTS:
+        session["sort"] = request.args["sort"]
+    sort = session.get("sort") if session.get("sort") in PHRASEBOOK_SORTS else "id"
+    lang = request.args.get("lang")
+    
+    etag = page_etag("user",
+                     g.user.id,
+                     g.user.username,
+                     phrasebook_versions(Phrasebook.user_id == g.user.id),
+                     sort,
+                     lang,
+                     session.get("lang_from"),
+                     session.get("lang_to"))
+    
+    cached = not_modified(etag)
+    if cached: return cached
     
     user_edit_form = UserEditForm(username=g.user.username)
     
     phrasebook_add_form = PhrasebookForm(lang_from = session.get("lang_from") or "EN", 
                                          lang_to = session.get("lang_to") or "ES",)
-    phrasebook_add_form.lang_from.choices = source_languages
-    phrasebook_add_form.lang_to.choices = source_languages
+    phrasebook_add_form.lang_from.choices = source_languages()
+    phrasebook_add_form.lang_to.choices = source_languages()
     
     pb_edit_form = EditPhrasebookForm()
     
     note_form = NoteForm()
     
-    pb_langs = {pb.lang_to for pb in g.user.phrasebooks}
+    phrasebooks = user_phrasebooks(g.user.id, sort, lang)
+    
+    pb_langs = phrasebook_languages(g.user.id)
+    
+    notes = phrasebook_notes(g.user.id)
 
-    return render_template("/user/profile.html", user_edit_form=user_edit_form, phrasebook_add_form=phrasebook_add_form, pb_edit_form=pb_edit_form, note_form=note_form, pb_langs=pb_langs)
+    html = render_template("user/profile.html", user_edit_form=user_edit_form, phrasebook_add_form=phrasebook_add_form, pb_edit_form=pb_edit_form, note_form=note_form, phrasebooks=phrasebooks, pb_langs=pb_langs, lang_filter=lang, notes=notes)
+    
+    return etag_response(html, etag)
 
-@app.route('/user/edit', methods=["POST"])
+@views.route('/user/edit', methods=["POST"])
 def edit_user():
     """Edit user in db if user is logged in and confirms password. 
     If form is not valid, redirect home.
@@ -351,7 +544,7 @@ def edit_user():
     return redirect("/user")
     
     
-@app.route('/user/delete', methods=["POST"])
+@views.route('/user/delete', methods=["POST"])
 def delete_user():
     """Delete user if user is logged in."""
 
@@ -368,7 +561,7 @@ def delete_user():
 ####################################################################################
 # Phrasebook Routes
 
-@app.route('/phrasebook/add', methods=["POST"])
+@views.route('/phrasebook/add', methods=["POST"])
 def add_phrasebook():
     """If user is logged in, create a new phrasebook."""
     
@@ -376,8 +569,8 @@ def add_phrasebook():
 
     form = PhrasebookForm()
 
-    form.lang_from.choices = source_languages
-    form.lang_to.choices = source_languages
+    form.lang_from.choices = source_languages()
+    form.lang_to.choices = source_languages()
     
     if form.validate_on_submit():
         p = Phrasebook(name=form.name.data,
@@ -394,7 +587,7 @@ def add_phrasebook():
     
     return redirect(request.referrer)
 
-@app.route('/phrasebook/<int:pb_id>/edit', methods=["POST"])
+@views.route('/phrasebook/<int:pb_id>/edit', methods=["POST"])
 def edit_phrasebook(pb_id):
     """Edit phrasebook in database."""
 
@@ -411,13 +604,45 @@ def edit_phrasebook(pb_id):
         
         db.session.commit()
         
+        if wants_fragment():
+            return render_template("user/phrasebook_header.html", p=pb, pb_edit_form=form)
+        
         flash(f"Phrasebook updated.","success")
         return redirect("/user")
     
+    if wants_fragment(): return fragment_error("Phrasebook edit unsuccessful.")
+    
     flash("Phrasebook edit unsuccessful.", "danger")
     return redirect("/user")
     
-@app.route('/phrasebook/<int:pb_id>/delete', methods=["POST"])
+@views.route('/practice')
+def practice():
+    """Practice the user's saved translations. Cards are loaded and answered through the API by app.js."""
+
+    if not g.user: return unauthorized()
+    
+    return render_template("practice.html", phrasebooks=g.user.phrasebooks, grades=GRADES)
+
+@views.route('/phrasebook/<int:pb_id>/suggestions')
+@read_only
+def phrasebook_suggestions(pb_id):
+    """Fragment suggesting translations others saved alongside this phrasebook's, loaded by app.js
+    when the phrasebook is opened. Served from the precomputed TranslationNeighbors."""
+
+    if not g.user: return unauthorized()
+    
+    pb = Phrasebook.query.get_or_404(pb_id)
+    if pb.user_id != g.user.id: return unauthorized()
+    
+    t_ids = [t_id for (t_id,) in db.session.query(PhrasebookTranslation.translation_id)
+                                           .filter_by(phrasebook_id=pb_id)]
+    
+    save_translation_form = AddTranslationForm()
+    
+    return render_template("user/suggestions.html", p=pb, suggestions=TranslationNeighbors.recommend(t_ids),
+                           save_translation_form=save_translation_form)
+
+@views.route('/phrasebook/<int:pb_id>/delete', methods=["POST"])
 def delete_phrasebook(pb_id):
     """Delete phrasebook from database."""
 
@@ -432,26 +657,39 @@ def delete_phrasebook(pb_id):
 ####################################################################################
 # Public Phrasebook Routes
 
-@app.route('/public')
+@views.route('/public')
+@read_only
 def show_public_phrasebooks():
     """Show public phrasebooks from all users."""
 
 
     if not g.user: return unauthorized()
     reset_filter()
+    
+    # Public phrasebooks of any owner, plus the user's own phrasebooks offered in the save form.
+    etag = page_etag("public",
+                     g.user.id,
+                     phrasebook_versions(db.or_(Phrasebook.public == True,
+                                                Phrasebook.user_id == g.user.id)),
+                     session.get("sort_public"),
+                     session.get("filter_public_from"),
+                     session.get("filter_public_to"))
+    
+    cached = not_modified(etag)
+    if cached: return cached
          
     save_translation_form = AddTranslationForm()
     save_translation_form.phrasebooks.choices = [(p.id, p.name) for p in g.user.phrasebooks]
     
-    public_pbs = Phrasebook.query.filter(Phrasebook.public==True, 
-                                         Phrasebook.user_id!=g.user.id).all()
+    others_public = db.and_(Phrasebook.public == True, Phrasebook.user_id != g.user.id)
 
     # Creating sets of languages for use in phrasebook filter. 
-    codes_from = list({pb.lang_from for pb in public_pbs})
-    codes_to = list({pb.lang_to for pb in public_pbs})
+    languages = db.session.query(Phrasebook.lang_from, Phrasebook.lang_to).filter(others_public).distinct().all()
+    codes_from = list({lang_from for lang_from, lang_to in languages})
+    codes_to = list({lang_to for lang_from, lang_to in languages})
     
-    choices_from = [(x,y) for x,y in source_languages if x in codes_from]
-    choices_to = [(x,y) for x,y in source_languages if x in codes_to]
+    choices_from = [(x,y) for x,y in source_languages() if x in codes_from]
+    choices_to = [(x,y) for x,y in source_languages() if x in codes_to]
     
     
     filter_form = FilterPhrasebookFrom()
@@ -459,14 +697,20 @@ def show_public_phrasebooks():
     filter_form.lang_to.choices = choices_to
     
     if 'filter_public_from' and "filter_public_to" in session:
-        public_pbs = Phrasebook.query.filter_by(public=True,
-                                            lang_from=session['filter_public_from'],
-                                            lang_to=session['filter_public_to'])
-        
+        query = Phrasebook.query.filter_by(public=True,
+                                           lang_from=session['filter_public_from'],
+                                           lang_to=session['filter_public_to'])
+    else:
+        query = Phrasebook.query.filter(others_public)
 
-    return render_template("show_public.html", public_pbs=public_pbs, save_translation_form=save_translation_form, filter_form=filter_form)
+    # Owners and translations are loaded with one extra query each, not one per phrasebook.
+    public_pbs = query.options(selectinload(Phrasebook.user), selectinload(Phrasebook.translations)).all()
 
-@app.route('/public/translation/<int:t_id>/add', methods=["POST"])
+    html = render_template("show_public.html", public_pbs=public_pbs, save_translation_form=save_translation_form, filter_form=filter_form)
+    
+    return etag_response(html, etag)
+
+@views.route('/public/translation/<int:t_id>/add', methods=["POST"])
 def add_public_translation(t_id):
     """Add translation from a public phrasebooks to a user's phrasebook"""
     
@@ -476,6 +720,7 @@ def add_public_translation(t_id):
     form.phrasebooks.choices = [(p.id, p.name) for p in g.user.phrasebooks]
     
     if not form.phrasebooks.data:
+        if wants_fragment(): return fragment_error("No data submitted")
         flash("No data submitted", "danger")
         return redirect("/public")
     
@@ -487,11 +732,14 @@ def add_public_translation(t_id):
             pb.translations.append(t)
             db.session.commit()
 
+        if wants_fragment():
+            return render_template("alert.html", category="success", message=f"Translation saved to {pb.name}")
+
         flash(f"Translation saved to {pb.name}", "success")
         return redirect("/public")
     
     
-@app.route('/public/phrasebook/<int:pb_id>/add', methods=["POST"])
+@views.route('/public/phrasebook/<int:pb_id>/add', methods=["POST"])
 def copy_public_phrasebook(pb_id):
     """Copy a public phrasebook to the current user's profile."""
     
@@ -516,30 +764,28 @@ def copy_public_phrasebook(pb_id):
 ####################################################################################
 # Sort / Filter Phrasebook Routes
 
-@app.route('/sort/<sort_by>')
+@views.route('/sort/<sort_by>')
 def sort_phrasebook(sort_by):
-    """Sort phrasebooks by field indicated by adjusting session."""
+    """Sort phrasebooks by field indicated by adjusting session.
+    The user page takes ?sort= itself; this keeps old links to it working."""
     
     if request.referrer.endswith("/user"):
-        session['sort']=sort_by
-        return redirect(request.referrer)
+        return redirect(f"/user?sort={sort_by}")
 
     if request.referrer.endswith("/public"):
         session['sort_public']=sort_by
         return redirect(request.referrer)
 
-@app.route('/filter/<lang_code>')
+@views.route('/filter/<lang_code>')
 def filter_phrasebook(lang_code):
-    """Filter user phrasebooks by language code."""
+    """Filter user phrasebooks by language code. The user page takes ?lang= itself; this keeps old links to it working."""
     
     if lang_code == "all":
-        if 'filter' in session: session.pop('filter') 
-        return redirect(request.referrer)
+        return redirect("/user")
     else:
-        session['filter'] = lang_code
-        return redirect(request.referrer)      
+        return redirect(f"/user?lang={lang_code}")
     
-@app.route('/filter', methods=['GET', 'POST']) 
+@views.route('/filter', methods=['GET', 'POST']) 
 def filter_public_phrasebook():
     '''Handle public phrasebook filter form and set filter settings in session.
     If accessed as a get request, show all public phrasebooks. If form is submitted, filter by language.'''
@@ -558,8 +804,8 @@ def filter_public_phrasebook():
     codes_from = list({pb.lang_from for pb in public_pbs})
     codes_to = list({pb.lang_to for pb in public_pbs})
     
-    choices_from = [(x,y) for x,y in source_languages if x in codes_from]
-    choices_to = [(x,y) for x,y in source_languages if x in codes_to]
+    choices_from = [(x,y) for x,y in source_languages() if x in codes_from]
+    choices_to = [(x,y) for x,y in source_languages() if x in codes_to]
     
     form = FilterPhrasebookFrom()
     form.lang_from.choices = choices_from
@@ -580,7 +826,7 @@ def filter_public_phrasebook():
 ####################################################################################
 # Translation Routes
 
-@app.route('/translation/add', methods=["POST"])
+@views.route('/translation/add', methods=["POST"])
 def add_translation():
     """Add translation to database and add association to one or more phrasebooks."""
     
@@ -590,6 +836,7 @@ def add_translation():
     form.phrasebooks.choices = [(p.id, p.name) for p in g.user.phrasebooks]
 
     if not form.phrasebooks.data:
+        if wants_fragment(): return fragment_error("No data submitted")
         flash("No data submitted", "danger")
         return redirect("/")
     
@@ -607,46 +854,296 @@ def add_translation():
             pb.translations.append(new_translation)
             db.session.commit()
 
+        if wants_fragment():
+            return render_template("alert.html", category="success", message="Translation saved.")
+
         flash(f"Translation saved.", "success")
         return redirect("/")
     
     else:
+        if wants_fragment(): return fragment_error("Form did not validate.")
         flash("Form did not validate.", "danger")
         return redirect("/")
 
 
-@app.route('/<int:pb_id>/<int:t_id>/note', methods=["POST"])
+@views.route('/<int:pb_id>/<int:t_id>/note', methods=["POST"])
 def edit_translation_note(pb_id, t_id):
     """Edit note on user's translation (on association)"""
     
     if not g.user: return unauthorized()
+
+    pb = Phrasebook.query.get_or_404(pb_id)
+    if pb.user_id != g.user.id:
+        if wants_fragment(): return fragment_error("Access unauthorized.", 403)
+        return unauthorized()
+
     form = NoteForm()
     
     if form.validate_on_submit():
-        pb_t = PhrasebookTranslation.query.get((pb_id, t_id))
+        pb_t = PhrasebookTranslation.query.get_or_404((pb_id, t_id))
         pb_t.note = form.note.data
     
         db.session.commit()
+        
+        if wants_fragment():
+            return render_template("user/note.html", p={"id": pb_id}, t={"id": t_id},
+                                   note=pb_t.note, note_form=form)
         return redirect("/user")
     
+    if wants_fragment(): return fragment_error("Note submission failed.")
+    
     flash("Note submission failed.", "danger")
     return redirect(request.referrer)
 
 
-@app.route('/phrasebook/<int:pb_id>/translation/<int:t_id>/delete', methods=["POST"])
+@views.route('/phrasebook/<int:pb_id>/translation/<int:t_id>/delete', methods=["POST"])
 def delete_translation(pb_id, t_id):
     """Delete translation from phrasebook and its association in database.
     Check if translation is orphaned, and if so, delete it from the database."""
     
     if not g.user: return unauthorized()
     pb = Phrasebook.query.get_or_404(pb_id)
+    if pb.user_id != g.user.id:
+        if wants_fragment(): return fragment_error("Access unauthorized.", 403)
+        return unauthorized()
+
     t = Translation.query.get_or_404(t_id)
     pb.delete_translation(t)
     db.session.commit()
     
+    if wants_fragment():
+        return jsonify(phrasebook_id=pb.id, translation_id=t_id, translation_count=pb.translation_count)
+    
     flash("Translation deleted.", "success")
     return redirect("/user")
 
 
+####################################################################################
+# CLI commands
+
+@click.command("compact-sync-log")
+@with_appcontext
+@click.option("--days", default=30, help="Keep change log entries newer than this many days.")
+def compact_sync_log_command(days):
+    """Remove superseded and expired entries from the sync change log."""
+
+    removed = compact_change_log(timedelta(days=days))
+    click.echo(f"Removed {removed} change log entries.")
+
+
+@click.command("prune-rate-limits")
+@with_appcontext
+@click.option("--hours", default=24, help="Delete shared rate limit buckets idle for longer than this.")
+def prune_rate_limits_command(hours):
+    """Remove idle buckets from the shared rate limit store."""
+
+    removed = prune_buckets(hours * 3600)
+    click.echo(f"Removed {removed} rate limit buckets.")
+
+
+@click.command("recount-translations")
+@with_appcontext
+def recount_translations_command():
+    """Repair phrasebook translation counts from the phrasebook_translation table."""
+
+    fixed = Phrasebook.recount_translations()
+    click.echo(f"Fixed translation counts on {fixed} phrasebooks.")
+
+
+@click.command("recount-popularity")
+@with_appcontext
+def recount_popularity_command():
+    """Repair the public save counts behind the popular translations listing."""
+
+    fixed = TranslationPopularity.refresh(db.session.connection())
+    db.session.commit()
+    click.echo(f"Fixed {fixed} translation popularity rows.")
+
+
+@click.command("refresh-recommendations")
+@with_appcontext
+@click.option("--all", "everything", is_flag=True, help="Recompute every translation, not just the stale ones.")
+@click.option("--batch-size", default=500, help="Translations recomputed per transaction.")
+def refresh_recommendations_command(everything, batch_size):
+    """Recompute the co-occurrence neighbors behind phrasebook suggestions."""
+
+    if everything:
+        db.session.execute(TranslationNeighbors.__table__.update().values(stale=True))
+        TranslationNeighbors.mark_stale(db.session.connection(),
+                                        [t_id for (t_id,) in db.session.query(TranslationPopularity.translation_id)])
+        db.session.commit()
+
+    refreshed = 0
+    while True:
+        n = TranslationNeighbors.refresh(db.session.connection(), batch_size)
+        db.session.commit()
+        if not n:
+            break
+        refreshed += n
+
+    click.echo(f"Refreshed recommendations for {refreshed} translations.")
+
+
+@click.command("profile-url")
+@with_appcontext
+@click.argument("url")
+@click.option("--ttl", default=3600, help="Seconds the signed URL turns on profiling for.")
+def profile_url_command(url, ttl):
+    """Print URL with the signature that turns on profiling for it (needs ADMIN_TOKEN)."""
+
+    token = current_app.config.get("ADMIN_TOKEN")
+    if not token:
+        raise click.ClickException("ADMIN_TOKEN is not set.")
+
+    path, _, query = url.partition("?")
+    signature = profile_signature(urlsplit(path).path or "/", token, time.time() + ttl)
+    click.echo(f"{url}{'&' if query else '?'}_profile={signature}")
+
+
+@click.command("db-upgrade")
+@with_appcontext
+def db_upgrade_command():
+    """Apply pending schema migrations."""
+
+    applied = migrations.upgrade(db.engine, db=db, echo=click.echo)
+    click.echo(f"{len(applied)} migration(s) applied.")
+
+
+@click.command("db-status")
+@with_appcontext
+def db_status_command():
+    """List schema migrations and whether they have been applied."""
+
+    done = migrations.applied_revisions(db.engine)
+    for m in migrations.discover():
+        mark = "x" if migrations.revision(m) in done else " "
+        click.echo(f"[{mark}] {migrations.revision(m)}")
+
+
+@click.command("check-query-plans")
+@with_appcontext
+def check_query_plans_command():
+    """Verify the hot queries are planned with their indexes. Exits non-zero on a mismatch."""
+
+    problems = check_query_plans(db.engine)
+    for description, problem in problems:
+        click.echo(f"FAIL {description}: {problem}")
+
+    if problems:
+        raise SystemExit(1)
+    click.echo("All query plans use their expected indexes.")
+
+
+####################################################################################
+# Application factory
+
+COMMANDS = [compact_sync_log_command, recount_translations_command, db_upgrade_command,
+            db_status_command, check_query_plans_command, prune_rate_limits_command,
+            recount_popularity_command, refresh_recommendations_command, profile_url_command]
+
+
+def load_config(app):
+    """Read the app's settings from the environment."""
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'postgresql:///translator-app')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options()
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['DATABASE_REPLICA_URLS'] = os.environ.get('DATABASE_REPLICA_URLS')
+    app.config['DB_REPLICA_MAX_LAG'] = float(os.environ.get('DB_REPLICA_MAX_LAG', 5))
+    app.config['DB_REPLICA_CONNECT_TIMEOUT'] = int(os.environ.get('DB_REPLICA_CONNECT_TIMEOUT', 2))
+    app.config['DB_READ_YOUR_WRITES_SECONDS'] = float(os.environ.get('DB_READ_YOUR_WRITES_SECONDS', 10))
+    app.config['RATE_LIMITS'] = parse_limits(os.environ.get('RATE_LIMITS'))
+    app.config['RATE_LIMIT_STORE'] = os.environ.get('RATE_LIMIT_STORE', 'memory')
+    app.config['RECOMMENDATIONS_REFRESH_BATCH'] = int(os.environ.get('RECOMMENDATIONS_REFRESH_BATCH', 50))
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', SESSION_KEY)
+    app.config['TEMPLATE_CACHE_DIR'] = os.environ.get('TEMPLATE_CACHE_DIR')
+    app.config['ASSET_BUILD_DIR'] = os.environ.get('ASSET_BUILD_DIR')
+    app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+    app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN')
+    app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    app.config['PROFILE_INTERVAL'] = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+    app.config['PROFILE_KEEP'] = int(os.environ.get('PROFILE_KEEP', 50))
+    app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 200))
+    app.config['SLOW_QUERY_EXPLAIN_EVERY'] = float(os.environ.get('SLOW_QUERY_EXPLAIN_EVERY', 300))
+    app.config['SLOW_QUERY_REPEAT'] = int(os.environ.get('SLOW_QUERY_REPEAT', 20))
+    app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    app.config['LOG_DEBUG_SAMPLE_RATE'] = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', 1))
+    app.config['LOG_SAMPLE_RATES'] = parse_sample_rates(os.environ.get('LOG_SAMPLE_RATES'))
+    app.config['LOG_QUEUE_SIZE'] = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+
+def create_app(config=None):
+    """Build a Translation Buddy app.
+
+    Everything immutable (language tables, compiled templates) is built here, so under
+    gunicorn --preload it is built once in the master and shared copy-on-write by the
+    workers. Per-process resources are opened lazily and reset after a fork."""
+
+    app = Flask(__name__)
+    load_config(app)
+    if config:
+        app.config.update(config)
+
+    # Before anything logs, so every record is JSON with its request id.
+    init_logging(app)
+    if not app.config['SECRET_KEY']:
+        logging.getLogger(__name__).warning("No SECRET_KEY set and secret.py not found.")
+
+    source, target = load_languages()
+    app.config['SOURCE_LANGUAGES'] = source
+    app.config['TARGET_LANGUAGES'] = target
+
+    # Before the other request hooks (all but the request id's), so they are inside the profile.
+    init_profiling(app)
+
+    # Before the debug toolbar, whose after_request hook has to see the HTML uncompressed.
+    init_assets(app)
+    DebugToolbarExtension(app)
+
+    init_replicas(app)
+    connect_db(app)
+    init_slow_queries(app)
+
+    app.register_blueprint(views)
+    app.register_blueprint(api)
+    app.register_blueprint(metrics)
+
+    init_rate_limits(app)
+
+    for command in COMMANDS:
+        app.cli.add_command(command)
+
+    init_templates(app, source)
+
+    created_apps.add(app)
+
+    return app
+
+
+# Apps whose pooled connections are dropped in forked children.
+created_apps = weakref.WeakSet()
+
+
+def reset_after_fork():
+    """Drop the connections and HTTP session inherited from the parent process.
+    The child opens its own on first use; the parent's stay open for the parent.
+    The log writer thread doesn't survive the fork, so the child starts its own."""
+
+    reset_translator()
+    start_listener()
+
+    for app in list(created_apps):
+        for connector in get_state(app).connectors.values():
+            engine = connector._engine
+            if engine is not None:
+                engine.dispose(close=False)
+
+
+# Registered once, however many apps are built (tests and the ASGI wrapper build several).
+os.register_at_fork(after_in_child=reset_after_fork)
 
 
+app = create_app()
@@ -0,0 +1,190 @@
+"""ASGI entry point for Translation Buddy.
+
+    gunicorn --chdir app --preload --forwarded-allow-ips='*' -k uvicorn.workers.UvicornWorker asgi:application
+
+--forwarded-allow-ips='*' makes the client address the one the Heroku router puts at the
+end of X-Forwarded-For rather than the router's own. Only trust every peer like this where
+the app can't be reached except through the proxy.
+
+POST /translate is served on the event loop: the request is validated and the
+session updated in short synchronous steps on a worker thread, while the DeepL
+call itself is awaited through a non-blocking client. A worker process can
+therefore hold hundreds of translations in flight without a thread for each;
+how many reach DeepL at once is up to the dispatcher (dispatcher.py). Every other request is passed to the Flask app through WsgiToAsgi."""
+
+import asyncio
+import gc
+import io
+import os
+import time
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import flash, redirect
+
+import app as translate_app
+import metrics
+from deepl_async import AsyncTranslator
+from dispatcher import INTERACTIVE, INTERACTIVE_DEADLINE, DeadlineExceeded, dispatcher
+from logs import incoming_request_id, request_id_var
+
+IN_FLIGHT = metrics.gauge("translate_async_in_flight", "Async /translate requests waiting on DeepL.")
+
+
+def build_environ(scope, body):
+    """Build the WSGI environ for an ASGI http scope and its complete body."""
+
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": io.StringIO(),
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1").upper().replace("-", "_")
+        value = value.decode("latin1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        if name in environ:
+            value = environ[name] + "," + value
+        environ[name] = value
+
+    return environ
+
+
+class TranslateApplication:
+    """Serve POST /translate natively and hand everything else to the WSGI app."""
+
+    def __init__(self, flask_app, translator):
+        self.flask_app = flask_app
+        self.translator = translator
+        self.wsgi = WsgiToAsgi(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == "/translate":
+            await self.translate(scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.translator.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def translate(self, scope, receive, send):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        environ = build_environ(scope, body)
+        # One id for the steps below and the DeepL call between them. The task has its own
+        # context, and each step's thread gets a copy of it.
+        request_id_var.set(incoming_request_id(environ.get("HTTP_X_REQUEST_ID")))
+
+        response, session, job = await asyncio.to_thread(self.validate, environ)
+
+        if response is None and job["text_to"] is not None:
+            response = await asyncio.to_thread(self.finish, environ, session, job, None)
+        elif response is None:
+            IN_FLIGHT.inc()
+            try:
+                async with dispatcher.aslot(INTERACTIVE, user=job["user"],
+                                            deadline=time.monotonic() + INTERACTIVE_DEADLINE):
+                    result = await self.translator.translate_text(job["text"],
+                                                                  source_lang=job["source_lang"],
+                                                                  target_lang=job["target_lang"])
+            except Exception as e:
+                result = e
+            finally:
+                IN_FLIGHT.dec()
+
+            response = await asyncio.to_thread(self.finish, environ, session, job, result)
+
+        await send({"type": "http.response.start",
+                    "status": response.status_code,
+                    "headers": [(k.lower().encode("latin1"), v.encode("latin1"))
+                                for k, v in response.headers.to_wsgi_list()]})
+        await send({"type": "http.response.body", "body": response.get_data()})
+
+    def validate(self, environ):
+        """Run the before-request hooks and validate the form.
+
+        Returns (response, session, job): a finished response if the request ends here,
+        otherwise the session to carry across the DeepL call and the text to translate.
+        The job's text_to is already set when the cache had it (under the locally guessed language)."""
+
+        with self.flask_app.request_context(environ) as ctx:
+            rv = self.flask_app.preprocess_request()
+            if rv is None:
+                form = translate_app.translate_form()
+                if form.validate_on_submit():
+                    text = form.translate_text.data
+                    guessed_lang = translate_app.resolve_source_language(text, form.source_lang.data)
+                    target_lang = form.target_lang.data
+                    return None, ctx.session, {"text": text,
+                                               "source_lang": translate_app.deepl_source_language(form.source_lang.data),
+                                               "guessed_lang": guessed_lang,
+                                               "target_lang": target_lang,
+                                               "text_to": translate_app.lookup_translation(text, guessed_lang, target_lang),
+                                               "user": translate_app.dispatch_user()}
+
+                flash("Translation did not submit", 'danger')
+                rv = redirect("/")
+
+            return self.flask_app.finalize_request(rv), None, None
+
+    def finish(self, environ, session, job, result):
+        """Store the translation in the session and redirect home, as the sync route does.
+        result is None when the job was answered without DeepL."""
+
+        ctx = self.flask_app.request_context(environ)
+        ctx.session = session
+        with ctx:
+            if isinstance(result, DeadlineExceeded):
+                flash("The translator is busy right now. Please try again.", 'danger')
+            elif isinstance(result, Exception):
+                self.flask_app.log_exception((type(result), result, result.__traceback__))
+                flash("Translation did not submit", 'danger')
+            else:
+                source_lang, text_to = job["guessed_lang"], job["text_to"]
+                if result is not None:
+                    source_lang = job["source_lang"] or result.detected_source_lang
+                    text_to = result.text
+                    translate_app.remember_result(job["text"], source_lang, job["target_lang"], text_to)
+                translation = translate_app.make_translation(job["text"], source_lang,
+                                                             job["target_lang"], text_to)
+                translate_app.remember_translation(translation)
+
+            return self.flask_app.finalize_request(redirect("/"))
+
+
+application = TranslateApplication(
+    translate_app.app,
+    AsyncTranslator(translate_app.API_AUTH_KEY,
+                    max_connections=int(os.environ.get("DEEPL_MAX_CONNECTIONS", 100))))
+
+# Under --preload everything built so far is shared with the workers. Freezing it keeps the
+# garbage collector from writing to those pages, which would copy them into every worker.
+gc.freeze()
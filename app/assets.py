@@ -0,0 +1,174 @@
+"""Fingerprinted static assets and response compression for Translation Buddy.
+
+At startup every file in static/ is copied to the build directory (ASSET_BUILD_DIR,
+default static/build) under a name that includes a hash of its content, e.g.
+style.css -> style.1a2b3c4d5e6f.css, along with gzip and (when the brotli package is
+installed) brotli compressed copies. Templates link to them with asset_url("style.css").
+An edited file gets a new name, so /assets/ can serve the copies with a one-year
+immutable Cache-Control and repeat page loads don't ask for them again. The
+precompressed variant is picked from the browser's Accept-Encoding.
+
+HTML responses of at least COMPRESS_MIN_SIZE bytes are compressed on the fly."""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from flask import Blueprint, abort, current_app, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ONE_YEAR = 365 * 24 * 3600
+
+# Content-Encoding -> file extension of the precompressed copy
+EXTENSIONS = {"br": ".br", "gzip": ".gz"}
+
+# Compression levels for HTML compressed per response: fast, with most of the size saving.
+COMPRESS_LEVEL = {"br": 5, "gzip": 6}
+
+assets = Blueprint("assets", __name__)
+
+
+def compress(data, encoding, level=None):
+    """Compress data for a Content-Encoding. Without a level, compress as hard as possible (for build time)."""
+
+    if encoding == "br":
+        return brotli.compress(data, quality=11 if level is None else level)
+
+    return gzip.compress(data, 9 if level is None else level, mtime=0)
+
+
+def encodings():
+    return ("br", "gzip") if brotli else ("gzip",)
+
+
+def fingerprinted_name(name, data):
+    root, ext = os.path.splitext(name)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+
+def build_assets(static_dir, build_dir):
+    """Write fingerprinted and precompressed copies of the files in static_dir to build_dir.
+    Returns a manifest of name -> fingerprinted name. Files already built are left alone,
+    so every worker (or a build step) can run this."""
+
+    build_dir = os.path.abspath(build_dir)
+    manifest = {}
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(root, d)) != build_dir]
+        for filename in files:
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, static_dir).replace(os.sep, "/")
+            with open(path, "rb") as f:
+                data = f.read()
+
+            built = fingerprinted_name(name, data)
+            target = os.path.join(build_dir, built)
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                for encoding in encodings():
+                    write_atomic(target + EXTENSIONS[encoding], compress(data, encoding))
+                write_atomic(target, data)
+
+            manifest[name] = built
+
+    return manifest
+
+
+def write_atomic(path, data):
+    """Write a file under a temporary name first, so a concurrent reader never sees half of it."""
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def asset_url(name):
+    """URL of the fingerprinted copy of a static file, or its plain /static URL if it wasn't built."""
+
+    built = current_app.config["ASSET_MANIFEST"].get(name)
+    if built is None:
+        return url_for("static", filename=name)
+
+    return url_for("assets.serve_asset", filename=built)
+
+
+def accepted_encoding(available):
+    """The encoding out of `available` the client prefers, or None to send the response as is."""
+
+    return request.accept_encodings.best_match(available)
+
+
+def etag_variants(etag):
+    """The ETags a page may have been sent with: as is, or suffixed with its compression."""
+
+    return [etag] + [f"{etag}-{encoding}" for encoding in EXTENSIONS]
+
+
+@assets.route("/assets/<path:filename>")
+def serve_asset(filename):
+    """Serve a fingerprinted asset, precompressed if the client accepts it, cached for a year."""
+
+    if filename not in current_app.config["ASSET_FILES"]:
+        abort(404)
+
+    encoding = accepted_encoding(encodings())
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    resp = send_from_directory(current_app.config["ASSET_BUILD_DIR"],
+                               filename + EXTENSIONS[encoding] if encoding else filename,
+                               mimetype=mimetype, cache_timeout=ONE_YEAR)
+
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
+    resp.vary.add("Accept-Encoding")
+    resp.headers["Cache-Control"] = f"public, max-age={ONE_YEAR}, immutable"
+
+    return resp
+
+
+def compress_response(response):
+    """Compress HTML responses of at least COMPRESS_MIN_SIZE bytes. A strong ETag gets
+    the encoding appended, since the compressed bytes are a different representation."""
+
+    if (response.mimetype != "text/html" or response.status_code != 200 or response.direct_passthrough
+            or response.is_streamed or "Content-Encoding" in response.headers):
+        return response
+
+    data = response.get_data()
+    if len(data) < current_app.config["COMPRESS_MIN_SIZE"]:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = accepted_encoding(encodings())
+    if encoding is None:
+        return response
+
+    response.set_data(compress(data, encoding, level=COMPRESS_LEVEL[encoding]))
+    response.headers["Content-Encoding"] = encoding
+
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+
+    return response
+
+
+def init_assets(app):
+    """Build the fingerprinted assets and compress HTML responses. Call before other
+    extensions add after_request hooks that rewrite HTML (they have to run first)."""
+
+    if not app.config.get("ASSET_BUILD_DIR"):
+        app.config["ASSET_BUILD_DIR"] = os.path.join(app.static_folder, "build")
+
+    manifest = build_assets(app.static_folder, app.config["ASSET_BUILD_DIR"])
+    app.config["ASSET_MANIFEST"] = manifest
+    app.config["ASSET_FILES"] = frozenset(manifest.values())
+
+    app.jinja_env.globals["asset_url"] = asset_url
+    app.register_blueprint(assets)
+    app.after_request(compress_response)
@@ -0,0 +1,126 @@
+"""Database engine and connection pool configuration for Translation Buddy.
+
+Pool settings come from the environment:
+
+    DB_POOL_SIZE              connections kept open per worker (default 5)
+    DB_MAX_OVERFLOW           extra connections allowed under bursts (default 10)
+    DB_POOL_TIMEOUT           seconds to wait for a free connection (default 30)
+    DB_POOL_RECYCLE           seconds before a connection is replaced (default 1800)
+    DB_POOL_PRE_PING          test connections on checkout (default on)
+    DB_STATEMENT_TIMEOUT_MS   cancel statements running longer than this (default off)
+    DB_PGBOUNCER              set when connecting through PgBouncer in transaction mode
+
+PgBouncer in transaction mode hands each transaction to a different server connection.
+It also rejects startup parameters, so the statement timeout is then set with SET LOCAL at
+the start of every transaction instead of once per connection."""
+
+import os
+import time
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+import metrics
+from replicas import RoutingSession
+
+POOL_CHECKOUTS = metrics.counter("db_pool_checkouts_total", "Connections checked out of the pool.")
+POOL_CONNECTS = metrics.counter("db_pool_connects_total", "New database connections opened.")
+POOL_INVALIDATIONS = metrics.counter("db_pool_invalidations_total", "Connections invalidated (e.g. failed pre-ping).")
+POOL_TIMEOUTS = metrics.counter("db_pool_timeouts_total", "Checkouts that gave up waiting for a connection.")
+POOL_IN_USE = metrics.gauge("db_pool_in_use", "Connections currently checked out.")
+POOL_OVERFLOW = metrics.gauge("db_pool_overflow", "Connections open beyond pool_size.")
+POOL_WAIT = metrics.histogram("db_pool_checkout_wait_seconds", "Time spent waiting for a pooled connection.",
+                              buckets=(.0005, .001, .005, .01, .05, .1, .5, 1, 5, 30))
+
+
+def env_flag(env, name, default):
+    value = env.get(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+def engine_options(env=os.environ):
+    """Build create_engine options from the environment."""
+
+    options = {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": int(env.get("DB_POOL_SIZE", 5)),
+        "max_overflow": int(env.get("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(env.get("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(env.get("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": env_flag(env, "DB_POOL_PRE_PING", True),
+    }
+
+    timeout = int(env.get("DB_STATEMENT_TIMEOUT_MS", 0))
+    if timeout:
+        if env_flag(env, "DB_PGBOUNCER", False):
+            options["execution_options"] = {"statement_timeout_local": timeout}
+        else:
+            options["connect_args"] = {"options": f"-c statement_timeout={timeout}"}
+
+    return options
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait and how far the pool overflows."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            POOL_WAIT.observe(time.perf_counter() - start)
+            POOL_OVERFLOW.set(max(self.overflow(), 0))
+
+
+@event.listens_for(InstrumentedQueuePool, "connect")
+def count_connect(dbapi_connection, connection_record):
+    POOL_CONNECTS.inc()
+
+
+@event.listens_for(InstrumentedQueuePool, "checkout")
+def count_checkout(dbapi_connection, connection_record, connection_proxy):
+    POOL_CHECKOUTS.inc()
+    POOL_IN_USE.inc()
+
+
+@event.listens_for(InstrumentedQueuePool, "checkin")
+def count_checkin(dbapi_connection, connection_record):
+    POOL_IN_USE.dec()
+
+
+@event.listens_for(InstrumentedQueuePool, "invalidate")
+def count_invalidate(dbapi_connection, connection_record, exception):
+    POOL_INVALIDATIONS.inc()
+
+
+@event.listens_for(Engine, "begin")
+def set_local_statement_timeout(conn):
+    """Apply the statement timeout per transaction when running behind PgBouncer."""
+
+    timeout = conn.get_execution_options().get("statement_timeout_local")
+    if timeout:
+        cursor = conn.connection.cursor()
+        cursor.execute(f"SET LOCAL statement_timeout = {int(timeout)}")
+        cursor.close()
+
+
+class TunedSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy extension that passes SQLALCHEMY_ENGINE_OPTIONS on to create_engine
+    and routes reads from read-only views to replicas (see replicas.py)."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, *args):
+        rv = super().apply_driver_hacks(app, *args)
+        # (app, info, options) in Flask-SQLAlchemy 2.3, (app, sa_url, options) in 2.4+
+        args[-1].update(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+        return rv
@@ -0,0 +1,98 @@
+"""Non-blocking DeepL client for the async /translate path.
+
+Implements only the part of the DeepL REST API that translate_text needs
+(POST /v2/translate), with the same key handling and retry behaviour as the
+official client for rate limits and temporary server errors."""
+
+import asyncio
+import logging
+import time
+from collections import namedtuple
+
+import httpx
+
+import metrics
+
+FREE_SERVER_URL = "https://api-free.deepl.com"
+PRO_SERVER_URL = "https://api.deepl.com"
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRIES = 3
+
+TextResult = namedtuple("TextResult", ["text", "detected_source_lang"])
+
+DEEPL_SECONDS = metrics.histogram("deepl_request_seconds", "Time spent waiting on DeepL translate requests.",
+                                  buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10))
+
+logger = logging.getLogger("deepl.calls")
+
+
+class DeepLError(Exception):
+    """DeepL refused or failed a request."""
+
+    def __init__(self, status, message):
+        super().__init__(f"DeepL request failed ({status}): {message}")
+        self.status = status
+
+
+class AsyncTranslator:
+    """Async counterpart of deepl.Translator.translate_text for a single text.
+
+    The HTTP client is created on first use, inside the running event loop,
+    and keeps up to `max_connections` connections to DeepL open."""
+
+    def __init__(self, auth_key, server_url=None, max_connections=100, timeout=10):
+        self.auth_key = auth_key
+        self.server_url = server_url or (FREE_SERVER_URL if auth_key.endswith(":fx") else PRO_SERVER_URL)
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.server_url,
+                headers={"Authorization": f"DeepL-Auth-Key {self.auth_key}"},
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                timeout=self.timeout)
+        return self._client
+
+    async def translate_text(self, text, source_lang=None, target_lang=None):
+        """Translate `text`, returning a TextResult like deepl.Translator.translate_text."""
+
+        data = {"text": text, "target_lang": target_lang.upper()}
+        if source_lang:
+            data["source_lang"] = source_lang.upper()
+
+        fields = {"texts": 1, "chars": len(text), "source_lang": source_lang, "target_lang": target_lang}
+        started = time.perf_counter()
+
+        for attempt in range(MAX_RETRIES + 1):
+            with DEEPL_SECONDS.time():
+                resp = await self.client.post("/v2/translate", data=data)
+            if resp.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                break
+            logger.info("DeepL request retried after %s", resp.status_code,
+                        extra=dict(fields, status=resp.status_code, attempt=attempt + 1))
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+        fields.update(status=resp.status_code, duration_ms=round((time.perf_counter() - started) * 1000, 1))
+
+        if resp.status_code != 200:
+            try:
+                message = resp.json().get("message", resp.reason_phrase)
+            except ValueError:
+                message = resp.reason_phrase
+            logger.warning("DeepL request failed: %s", message, extra=dict(fields, error="DeepLError"))
+            raise DeepLError(resp.status_code, message)
+
+        logger.info("DeepL request", extra=fields)
+        result = resp.json()["translations"][0]
+        return TextResult(result["text"], result["detected_source_language"])
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
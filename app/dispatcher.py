@@ -0,0 +1,189 @@
+"""Scheduling of this process's DeepL requests.
+
+Every DeepL request takes a slot first. Slots are handed out by priority class:
+interactive requests (a user waiting on /translate) before bulk work (imports)
+before background work. At most DEEPL_MAX_CONCURRENCY requests run at once, and
+DEEPL_INTERACTIVE_RESERVE of those slots are kept for interactive requests, so bulk
+work can't fill every slot and make an interactive request wait.
+
+The slots are counted per worker process. Both settings are for the whole server and
+are split evenly between its WEB_CONCURRENCY gunicorn workers (the cap rounded down,
+the reserve up), so together the workers stay within them. Each dyno still gets the
+full amount, and one worker can't borrow another's idle slots.
+
+Within a class, waiting requests are ordered by weighted fair queuing across users:
+each request gets a virtual finish time of max(class virtual time, the user's last
+finish time) + cost / weight, and the lowest goes first. A user with a 2,000-line
+import therefore takes turns with other users' imports instead of running ahead of them.
+
+A request that waits past its deadline is dropped with DeadlineExceeded rather than
+sent to DeepL after its caller has given up."""
+
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import deepl
+
+import metrics
+
+INTERACTIVE, BULK, BACKGROUND = "interactive", "bulk", "background"
+PRIORITIES = (INTERACTIVE, BULK, BACKGROUND)
+
+WORKERS = max(1, int(os.environ.get("WEB_CONCURRENCY", 1)))
+
+# This worker's share of the server-wide limits.
+DEEPL_MAX_CONCURRENCY = max(1, int(os.environ.get("DEEPL_MAX_CONCURRENCY", 8)) // WORKERS)
+DEEPL_INTERACTIVE_RESERVE = -(-int(os.environ.get("DEEPL_INTERACTIVE_RESERVE", 2)) // WORKERS)
+# How long an interactive request may wait for a slot before it's dropped.
+INTERACTIVE_DEADLINE = float(os.environ.get("DEEPL_INTERACTIVE_DEADLINE", 10))
+
+SLOT_WAIT = metrics.histogram("deepl_slot_wait_seconds", "Time DeepL requests waited for a slot.", ["priority"])
+SLOTS_IN_USE = metrics.gauge("deepl_slots_in_use", "DeepL requests running.", ["priority"])
+DROPPED = metrics.counter("deepl_requests_dropped_total", "DeepL requests dropped after waiting past their deadline.", ["priority"])
+
+
+class DeadlineExceeded(deepl.DeepLException):
+    """Raised when a request waited for a DeepL slot past its deadline."""
+
+
+class Waiter:
+    """A request waiting for a slot. Granting wakes a thread or resolves a future on an event loop."""
+
+    def __init__(self, priority, loop=None):
+        self.priority = priority
+        self.granted = False
+        self.cancelled = False
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def grant(self):
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self.resolve)
+
+    def resolve(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class Dispatcher:
+    """Hands out DeepL slots by priority class, then fairly across users."""
+
+    def __init__(self, max_concurrency=DEEPL_MAX_CONCURRENCY, interactive_reserve=DEEPL_INTERACTIVE_RESERVE):
+        self.max_concurrency = max_concurrency
+        self.interactive_reserve = min(interactive_reserve, max_concurrency - 1)
+        self.lock = threading.Lock()
+        self.sequence = itertools.count()
+        self.running = {priority: 0 for priority in PRIORITIES}
+        self.queues = {priority: [] for priority in PRIORITIES}
+        self.virtual_time = {priority: 0.0 for priority in PRIORITIES}
+        self.last_finish = {priority: {} for priority in PRIORITIES}
+
+    def enqueue(self, waiter, user, cost, weight):
+        with self.lock:
+            finished = self.last_finish[waiter.priority]
+            start = max(self.virtual_time[waiter.priority], finished.get(user, 0.0))
+            finish = start + cost / weight
+            if user is not None:
+                finished[user] = finish
+            heapq.heappush(self.queues[waiter.priority], (finish, next(self.sequence), waiter))
+            self.dispatch()
+
+    def dispatch(self):
+        """Grant free slots to the waiters next in line. Call with the lock held."""
+
+        while True:
+            in_use = sum(self.running.values())
+            for priority in PRIORITIES:
+                limit = self.max_concurrency if priority == INTERACTIVE else self.max_concurrency - self.interactive_reserve
+                queue = self.queues[priority]
+                while queue and queue[0][2].cancelled:
+                    heapq.heappop(queue)
+                if queue and in_use < limit:
+                    break
+            else:
+                return
+
+            finish, _, waiter = heapq.heappop(queue)
+            self.virtual_time[priority] = finish
+            self.running[priority] += 1
+            SLOTS_IN_USE.inc(priority=priority)
+            waiter.grant()
+
+            # Users whose last finish time has passed are back to the class's virtual time.
+            finished = self.last_finish[priority]
+            if len(finished) > 1000:
+                self.last_finish[priority] = {u: f for u, f in finished.items() if f > finish}
+
+    def release(self, priority):
+        with self.lock:
+            self.running[priority] -= 1
+            SLOTS_IN_USE.dec(priority=priority)
+            self.dispatch()
+
+    def cancel(self, waiter):
+        """Withdraw a waiter whose deadline passed. Returns True if it got a slot in the meantime."""
+
+        with self.lock:
+            if waiter.granted:
+                return True
+            waiter.cancelled = True
+            return False
+
+    @contextmanager
+    def slot(self, priority=INTERACTIVE, user=None, cost=1, weight=1, deadline=None):
+        """Hold a DeepL slot for the duration of the block. `deadline` is a time.monotonic() value."""
+
+        waiter = Waiter(priority)
+        started = time.monotonic()
+        self.enqueue(waiter, user, cost, weight)
+
+        timeout = None if deadline is None else max(0, deadline - started)
+        if not waiter.event.wait(timeout) and not self.cancel(waiter):
+            DROPPED.inc(priority=priority)
+            raise DeadlineExceeded("Timed out waiting for a DeepL request slot.")
+
+        SLOT_WAIT.observe(time.monotonic() - started, priority=priority)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    @asynccontextmanager
+    async def aslot(self, priority=INTERACTIVE, user=None, cost=1, weight=1, deadline=None):
+        """slot() for coroutines: waits on the event loop instead of blocking a thread."""
+
+        waiter = Waiter(priority, loop=asyncio.get_running_loop())
+        started = time.monotonic()
+        self.enqueue(waiter, user, cost, weight)
+
+        timeout = None if deadline is None else max(0, deadline - started)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+            if not self.cancel(waiter):
+                DROPPED.inc(priority=priority)
+                raise DeadlineExceeded("Timed out waiting for a DeepL request slot.")
+        except asyncio.CancelledError:
+            if self.cancel(waiter):
+                self.release(priority)
+            raise
+
+        SLOT_WAIT.observe(time.monotonic() - started, priority=priority)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+
+dispatcher = Dispatcher()
@@ -1,12 +1,44 @@
 """Forms for Travel Translator"""
 
+from functools import lru_cache
 from flask_wtf import FlaskForm
+from markupsafe import Markup
 from wtforms import StringField, PasswordField, SelectField, BooleanField, TextAreaField, SelectMultipleField, widgets 
 from wtforms.validators import DataRequired, Length, EqualTo, StopValidation
 
 class MultiCheckboxField(SelectMultipleField):
     widget = widgets.ListWidget(prefix_label=False)
     option_widget = widgets.CheckboxInput()
+
+
+@lru_cache(maxsize=256)
+def render_options(choices):
+    """Render (value, label, selected) choices as <option> markup.
+    Cached, since the same language lists are rendered on every page."""
+
+    return Markup("".join(widgets.Select.render_option(value, label, selected)
+                          for value, label, selected in choices))
+
+
+class CachedSelect(widgets.Select):
+    """Select widget that reuses the rendered <option> markup for repeated choices."""
+
+    def __call__(self, field, **kwargs):
+        kwargs.setdefault("id", field.id)
+        if self.multiple:
+            kwargs["multiple"] = True
+        if "required" not in kwargs and "required" in getattr(field, "flags", []):
+            kwargs["required"] = True
+
+        choices = tuple((value, label, selected) for value, label, selected, *_ in field.iter_choices())
+
+        return Markup(f"<select {widgets.html_params(name=field.name, **kwargs)}>{render_options(choices)}</select>")
+
+
+class LanguageField(SelectField):
+    """Select field for one of the DeepL language lists."""
+
+    widget = CachedSelect()
     
     
 
@@ -38,8 +70,8 @@ class TranslateForm(FlaskForm):
     """Text translation form."""
 
     translate_text = TextAreaField("Text to translate", validators=[Length(max=100), DataRequired()])
-    target_lang = SelectField("To:", validators=[DataRequired()])
-    source_lang = SelectField("From:", validators=[DataRequired()])
+    target_lang = LanguageField("To:", validators=[DataRequired()])
+    source_lang = LanguageField("From:", validators=[DataRequired()])
 
 
 class PhrasebookForm(FlaskForm):
@@ -47,8 +79,8 @@ class PhrasebookForm(FlaskForm):
     
     name = StringField("Name", validators=[DataRequired(), Length(max=35)])
     public = BooleanField("Make public?")
-    lang_from = SelectField("From:")
-    lang_to = SelectField("To:")
+    lang_from = LanguageField("From:")
+    lang_to = LanguageField("To:")
     
     
 class EditPhrasebookForm(FlaskForm):
@@ -61,8 +93,8 @@ class EditPhrasebookForm(FlaskForm):
 class FilterPhrasebookFrom(FlaskForm):
     """Form to filter phrasebooks by language."""
     
-    lang_from = SelectField("From:")
-    lang_to = SelectField("To:")
+    lang_from = LanguageField("From:")
+    lang_to = LanguageField("To:")
 
 class AddTranslationForm(FlaskForm):
     """Save translation to user phrasebook."""
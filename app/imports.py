@@ -0,0 +1,158 @@
+"""Streaming import of phrases into a phrasebook.
+
+Uploads are CSV (text_from[,text_to[,note]], with an optional header row naming the
+columns) or JSON Lines ({"text_from": ..., "text_to": ..., "note": ...} per line).
+text_to may be left out, in which case the phrase is translated into the phrasebook's
+language. Rows are read from the upload stream and handled in batches; each batch
+is translated in as few DeepL requests as possible (reusing cached DeepL results), matched
+against saved translations in one query, added to the phrasebook in one flush and committed. Memory use therefore
+depends on the batch size, not the size of the upload."""
+
+import csv
+import io
+import json
+from itertools import islice
+
+from models import db, Translation
+from translation import lookup_translation, remember_result, target_language
+
+BATCH_SIZE = 200
+MAX_REPORTED_ERRORS = 20
+MAX_TEXT_LENGTH = 5000
+
+FORMATS = ("csv", "jsonl")
+CSV_COLUMNS = ("text_from", "text_to", "note")
+
+
+class RawStream(io.RawIOBase):
+    """Adapt any object with read(size), such as a request or upload stream, to io's raw stream interface."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def text_lines(stream):
+    """Decode a binary stream to text lines without reading it all (a BOM is dropped).
+    Only \n, \r and \r\n end lines, and they are passed through untranslated as the csv module expects."""
+
+    return io.TextIOWrapper(io.BufferedReader(RawStream(stream)), encoding="utf-8-sig", newline="")
+
+
+def read_csv(stream):
+    """Yield (line number, row dict) for each non-blank CSV row."""
+
+    columns = CSV_COLUMNS
+    for line_no, row in enumerate(csv.reader(text_lines(stream)), 1):
+        if line_no == 1 and row and row[0].strip().lower() == "text_from":
+            columns = tuple(cell.strip().lower() for cell in row)
+            continue
+        if any(cell.strip() for cell in row):
+            yield line_no, dict(zip(columns, row))
+
+
+def read_jsonl(stream):
+    """Yield (line number, row dict) for each non-blank line. Lines that aren't JSON objects yield None."""
+
+    for line_no, line in enumerate(text_lines(stream), 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_no, row if isinstance(row, dict) else None
+
+
+READERS = {"csv": read_csv, "jsonl": read_jsonl}
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def clean(value):
+    return value.strip() if isinstance(value, str) else ""
+
+
+def cached_targets(lang_from, lang_to, texts):
+    """Return text_from -> text_to for texts whose DeepL translation is cached.
+    Saved translations aren't reused here: other users can save any text they like."""
+
+    targets = {}
+    for text in texts:
+        text_to = lookup_translation(text, lang_from, lang_to)
+        if text_to is not None:
+            targets[text] = text_to
+
+    return targets
+
+
+def import_phrases(pb, rows, translate, batch_size=BATCH_SIZE):
+    """Import rows of (line number, row dict) into phrasebook pb.
+
+    translate(texts, source_lang, target_lang) returns the translated texts for source-only rows.
+    This is a generator: it yields running totals after each committed batch."""
+
+    lang_from = pb.lang_from
+    lang_to = target_language(pb.lang_to)
+    totals = {"rows": 0, "added": 0, "skipped": 0, "translated": 0, "invalid": 0}
+    invalid_lines = []
+
+    for batch in batches(rows, batch_size):
+        entries = []
+        for line_no, row in batch:
+            totals["rows"] += 1
+            row = row or {}
+            text_from, text_to, note = (clean(row.get(c)) for c in CSV_COLUMNS)
+            if not text_from or len(text_from) > MAX_TEXT_LENGTH or len(text_to) > MAX_TEXT_LENGTH:
+                totals["invalid"] += 1
+                if len(invalid_lines) < MAX_REPORTED_ERRORS:
+                    invalid_lines.append(line_no)
+                continue
+            entries.append((text_from, text_to, note))
+
+        # Source-only rows reuse a cached DeepL result where there is one; the rest go to DeepL together.
+        missing = {text_from for text_from, text_to, note in entries if not text_to}
+        targets = cached_targets(lang_from, lang_to, missing)
+        untranslated = sorted(missing - set(targets))
+        if untranslated:
+            translated = translate(untranslated, lang_from, lang_to)
+            for text_from, text_to in zip(untranslated, translated):
+                remember_result(text_from, lang_from, lang_to, text_to)
+            targets.update(zip(untranslated, translated))
+            totals["translated"] += len(untranslated)
+
+        keyed = [((lang_from, lang_to, text_from, text_to or targets[text_from]), note)
+                 for text_from, text_to, note in entries]
+
+        by_key = Translation.find_existing(key for key, note in keyed)
+        for key, note in keyed:
+            if key not in by_key:
+                by_key[key] = Translation(lang_from=lang_from, lang_to=lang_to, text_from=key[2], text_to=key[3])
+                db.session.add(by_key[key])
+        db.session.flush()
+
+        ordered = [by_key[key] for key, note in keyed]
+        notes = {by_key[key].id: note for key, note in keyed if note}
+
+        added = pb.add_translations(ordered, notes)
+        db.session.commit()
+
+        totals["added"] += len(added)
+        totals["skipped"] += len(ordered) - len(added)
+        yield dict(totals)
+
+    yield dict(totals, done=True, invalid_lines=invalid_lines)
@@ -0,0 +1,219 @@
+"""Offline source language identification for auto-detect translations.
+
+Guessing the source language before calling DeepL lets auto-detect requests use the
+same translation cache as requests with an explicit language. The guess only keys the
+cache: on a miss DeepL is still asked to detect the language.
+
+Languages with a script of their own (Greek, Japanese, Korean, Chinese) are told by
+script. Latin and Cyrillic languages are scored with a naive Bayes model over the
+character 2- and 3-grams of a sample text in each language, after ruling out those
+whose alphabet lacks a letter of the text. Detection only answers when the text is
+long enough and the best language clearly beats the next; otherwise it returns None
+and the cache isn't checked."""
+
+import math
+import re
+from collections import Counter
+from functools import lru_cache
+
+MIN_LETTERS = 6
+# Log-likelihood lead of the best language over the next, per trigram of the text.
+MIN_MARGIN = 0.1
+
+WORDS = re.compile(r"[^\W\d_]+")
+
+SCRIPTS = [
+    ("JA", re.compile(r"[\u3040-\u30ff]")),
+    ("KO", re.compile(r"[\uac00-\ud7af\u1100-\u11ff\u3130-\u318f]")),
+    ("ZH", re.compile(r"[\u4e00-\u9fff]")),
+    ("EL", re.compile(r"[\u0370-\u03ff]")),
+]
+
+# The letters each language may use: the base Latin or Cyrillic alphabet and its own.
+LATIN = "abcdefghijklmnopqrstuvwxyz"
+CYRILLIC = "абвгдежзийклмнопрстуфхцчшщьюя"
+CYRILLIC_LANGUAGES = ("BG", "RU", "UK")
+EXTRA_LETTERS = {
+    "BG": "ъ", "CS": "áčďéěíňóřšťúůýž", "DA": "æøåé", "DE": "äöüß", "EN": "é",
+    "ES": "áéíñóúü", "ET": "äöõüšž", "FI": "äöåšž", "FR": "àâæçéèêëîïôœùûüÿ",
+    "HU": "áéíóöőúüű", "ID": "é", "IT": "àèéìíîòóùú", "LT": "ąčęėįšųūž",
+    "LV": "āčēģīķļņšūž", "NB": "æøåéòô", "NL": "áéèëïöü", "PL": "ąćęłńóśźż",
+    "PT": "áâãàçéêíóôõú", "RO": "ăâîșțşţ", "RU": "ыэъё", "SK": "áäčďéíĺľňóôŕšťúýž",
+    "SL": "čšžćđ", "SV": "åäöé", "TR": "çğıöşüîâ", "UK": "іїєґ",
+}
+LETTERS = {code: frozenset((CYRILLIC if code in CYRILLIC_LANGUAGES else LATIN) + extra)
+           for code, extra in EXTRA_LETTERS.items()}
+
+# Article 1 of the Universal Declaration of Human Rights and a few traveller's phrases.
+SAMPLES = {
+    "BG": "Всички хора се раждат свободни и равни по достойнство и права. Те са надарени с разум и съвест "
+          "и следва да се отнасят помежду си в дух на братство. Здравей, как си? Къде е гарата? "
+          "Много благодаря. Бих искал кафе, моля. Колко струва това? Как се казваш? Не разбирам.",
+    "CS": "Všichni lidé rodí se svobodní a sobě rovní co do důstojnosti a práv. Jsou nadáni rozumem a "
+          "svědomím a mají spolu jednat v duchu bratrství. Ahoj, jak se máš? Kde je vlakové nádraží? "
+          "Děkuji mnohokrát. Chtěl bych kávu, prosím. Kolik to stojí? Jak se jmenuješ? Nerozumím.",
+    "DA": "Alle mennesker er født frie og lige i værdighed og rettigheder. De er udstyret med fornuft og "
+          "samvittighed, og de bør handle mod hverandre i en broderskabets ånd. Hej, hvordan har du det? "
+          "Hvor er togstationen? Mange tak. Jeg vil gerne have en kop kaffe. Hvor meget koster det? "
+          "Hvad hedder du? Jeg forstår det ikke.",
+    "DE": "Alle Menschen sind frei und gleich an Würde und Rechten geboren. Sie sind mit Vernunft und "
+          "Gewissen begabt und sollen einander im Geist der Brüderlichkeit begegnen. Hallo, wie geht es "
+          "dir? Wo ist der Bahnhof? Vielen Dank. Ich möchte bitte einen Kaffee. Wie viel kostet das? "
+          "Wie heißt du? Ich verstehe nicht.",
+    "EN": "All human beings are born free and equal in dignity and rights. They are endowed with reason "
+          "and conscience and should act towards one another in a spirit of brotherhood. Hello, how are "
+          "you? Where is the train station? Thank you very much. I would like a coffee, please. How much "
+          "does this cost? What is your name? I don't understand.",
+    "ES": "Todos los seres humanos nacen libres e iguales en dignidad y derechos y, dotados como están de "
+          "razón y conciencia, deben comportarse fraternalmente los unos con los otros. Hola, ¿cómo "
+          "estás? ¿Dónde está la estación de tren? Muchas gracias. Quisiera un café, por favor. ¿Cuánto "
+          "cuesta esto? ¿Cómo te llamas? No entiendo.",
+    "ET": "Kõik inimesed sünnivad vabadena ja võrdsetena oma väärikuselt ja õigustelt. Neile on antud "
+          "mõistus ja südametunnistus ja nende suhtumist üksteisesse peab kandma vendluse vaim. Tere, "
+          "kuidas läheb? Kus on rongijaam? Tänan väga. Ma sooviksin kohvi, palun. Kui palju see maksab? "
+          "Mis su nimi on? Ma ei saa aru.",
+    "FI": "Kaikki ihmiset syntyvät vapaina ja tasavertaisina arvoltaan ja oikeuksiltaan. Heille on "
+          "annettu järki ja omatunto, ja heidän on toimittava toisiaan kohtaan veljeyden hengessä. Hei, "
+          "mitä kuuluu? Missä on rautatieasema? Kiitos paljon. Haluaisin kahvin, kiitos. Paljonko tämä "
+          "maksaa? Mikä sinun nimesi on? En ymmärrä.",
+    "FR": "Tous les êtres humains naissent libres et égaux en dignité et en droits. Ils sont doués de "
+          "raison et de conscience et doivent agir les uns envers les autres dans un esprit de "
+          "fraternité. Bonjour, comment allez-vous ? Où est la gare ? Merci beaucoup. Je voudrais un "
+          "café, s'il vous plaît. Combien ça coûte ? Comment vous appelez-vous ? Je ne comprends pas.",
+    "HU": "Minden emberi lény szabadon születik és egyenlő méltósága és joga van. Az emberek, ésszel és "
+          "lelkiismerettel bírván, egymással szemben testvéri szellemben kell hogy viseltessenek. Szia, "
+          "hogy vagy? Hol van a vasútállomás? Köszönöm szépen. Kérek egy kávét. Mennyibe kerül ez? Hogy "
+          "hívnak? Nem értem.",
+    "ID": "Semua orang dilahirkan merdeka dan mempunyai martabat dan hak-hak yang sama. Mereka "
+          "dikaruniai akal dan hati nurani dan hendaknya bergaul satu sama lain dalam semangat "
+          "persaudaraan. Halo, apa kabar? Di mana stasiun kereta api? Terima kasih banyak. Saya mau "
+          "kopi, tolong. Berapa harganya? Siapa nama kamu? Saya tidak mengerti.",
+    "IT": "Tutti gli esseri umani nascono liberi ed eguali in dignità e diritti. Essi sono dotati di "
+          "ragione e di coscienza e devono agire gli uni verso gli altri in spirito di fratellanza. "
+          "Ciao, come stai? Dov'è la stazione dei treni? Grazie mille. Vorrei un caffè, per favore. "
+          "Quanto costa questo? Come ti chiami? Non capisco.",
+    "LT": "Visi žmonės gimsta laisvi ir lygūs savo orumu ir teisėmis. Jiems suteiktas protas ir sąžinė "
+          "ir jie turi elgtis vienas kito atžvilgiu kaip broliai. Labas, kaip sekasi? Kur yra traukinių "
+          "stotis? Labai ačiū. Norėčiau kavos, prašau. Kiek tai kainuoja? Koks tavo vardas? Aš "
+          "nesuprantu.",
+    "LV": "Visi cilvēki piedzimst brīvi un vienlīdzīgi savā pašcieņā un tiesībās. Viņi ir apveltīti ar "
+          "saprātu un sirdsapziņu, un viņiem jāizturas citam pret citu brālības garā. Sveiki, kā jums "
+          "klājas? Kur ir dzelzceļa stacija? Liels paldies. Es vēlētos kafiju, lūdzu. Cik tas maksā? "
+          "Kā tevi sauc? Es nesaprotu.",
+    "NB": "Alle mennesker er født frie og med samme menneskeverd og menneskerettigheter. De er utstyrt "
+          "med fornuft og samvittighet og bør handle mot hverandre i brorskapets ånd. Hei, hvordan har "
+          "du det? Hvor er togstasjonen? Tusen takk. Jeg vil gjerne ha en kaffe. Hvor mye koster dette? "
+          "Hva heter du? Jeg forstår ikke.",
+    "NL": "Alle mensen worden vrij en gelijk in waardigheid en rechten geboren. Zij zijn begiftigd met "
+          "verstand en geweten, en behoren zich jegens elkander in een geest van broederschap te "
+          "gedragen. Hallo, hoe gaat het met je? Waar is het treinstation? Heel erg bedankt. Ik wil "
+          "graag een koffie. Hoeveel kost dit? Hoe heet je? Ik begrijp het niet.",
+    "PL": "Wszyscy ludzie rodzą się wolni i równi pod względem swej godności i swych praw. Są oni "
+          "obdarzeni rozumem i sumieniem i powinni postępować wobec innych w duchu braterstwa. Cześć, "
+          "jak się masz? Gdzie jest dworzec kolejowy? Dziękuję bardzo. Poproszę kawę. Ile to kosztuje? "
+          "Jak masz na imię? Nie rozumiem.",
+    "PT": "Todos os seres humanos nascem livres e iguais em dignidade e em direitos. Dotados de razão e "
+          "de consciência, devem agir uns para com os outros em espírito de fraternidade. Olá, como vai "
+          "você? Onde fica a estação de comboios? Muito obrigado. Eu queria um café, por favor. Quanto "
+          "custa isto? Como você se chama? Não entendo.",
+    "RO": "Toate ființele umane se nasc libere și egale în demnitate și în drepturi. Ele sunt înzestrate "
+          "cu rațiune și conștiință și trebuie să se comporte unele față de altele în spiritul "
+          "fraternității. Bună, ce mai faci? Unde este gara? Mulțumesc foarte mult. Aș dori o cafea, vă "
+          "rog. Cât costă asta? Cum te numești? Nu înțeleg.",
+    "RU": "Все люди рождаются свободными и равными в своем достоинстве и правах. Они наделены разумом и "
+          "совестью и должны поступать в отношении друг друга в духе братства. Привет, как дела? Где "
+          "находится вокзал? Большое спасибо. Я хотел бы кофе, пожалуйста. Сколько это стоит? Как тебя "
+          "зовут? Я не понимаю.",
+    "SK": "Všetci ľudia sa rodia slobodní a sebe rovní, čo sa týka ich dôstojnosti a práv. Sú obdarení "
+          "rozumom a svedomím a majú spolu zaobchádzať v duchu bratstva. Ahoj, ako sa máš? Kde je "
+          "železničná stanica? Ďakujem veľmi pekne. Chcel by som kávu, prosím. Koľko to stojí? Ako sa "
+          "voláš? Nerozumiem.",
+    "SL": "Vsi ljudje se rodijo svobodni in imajo enako dostojanstvo in enake pravice. Obdarjeni so z "
+          "razumom in vestjo in bi morali ravnati drug z drugim kakor bratje. Živjo, kako si? Kje je "
+          "železniška postaja? Najlepša hvala. Rad bi kavo, prosim. Koliko to stane? Kako ti je ime? Ne "
+          "razumem.",
+    "SV": "Alla människor är födda fria och lika i värde och rättigheter. De har utrustats med förnuft "
+          "och samvete och bör handla gentemot varandra i en anda av broderskap. Hej, hur mår du? Var "
+          "ligger tågstationen? Tack så mycket. Jag skulle vilja ha en kaffe, tack. Hur mycket kostar "
+          "det här? Vad heter du? Jag förstår inte.",
+    "TR": "Bütün insanlar hür, haysiyet ve haklar bakımından eşit doğarlar. Akıl ve vicdana sahiptirler "
+          "ve birbirlerine karşı kardeşlik zihniyeti ile hareket etmelidirler. Merhaba, nasılsın? Tren "
+          "istasyonu nerede? Çok teşekkür ederim. Bir kahve istiyorum, lütfen. Bu ne kadar? Adın ne? "
+          "Anlamıyorum.",
+    "UK": "Всі люди народжуються вільними і рівними у своїй гідності та правах. Вони наділені розумом і "
+          "совістю і повинні діяти у відношенні один до одного в дусі братерства. Привіт, як справи? "
+          "Де знаходиться вокзал? Дуже дякую. Я хотів би каву, будь ласка. Скільки це коштує? Як тебе "
+          "звати? Я не розумію.",
+}
+
+
+def ngrams(text):
+    """Count the character 2- and 3-grams of the words in text, padded with spaces."""
+
+    counts = Counter()
+    for word in WORDS.findall(text.lower()):
+        padded = f" {word} "
+        for n in (2, 3):
+            for i in range(len(padded) - n + 1):
+                counts[padded[i:i + n]] += 1
+
+    return counts
+
+
+@lru_cache(maxsize=None)
+def model():
+    """Return code -> (log probability per n-gram, log probability of an unseen n-gram)
+    for every sample language, with add-one smoothing. Built once per process."""
+
+    samples = {code: ngrams(sample) for code, sample in SAMPLES.items()}
+    vocabulary = len(set().union(*samples.values()))
+
+    built = {}
+    for code, counts in samples.items():
+        total = sum(counts.values()) + vocabulary
+        built[code] = ({gram: math.log((c + 1) / total) for gram, c in counts.items()}, math.log(1 / total))
+
+    return built
+
+
+def scores(text, candidates=None):
+    """Return (log-likelihood, code) pairs for text, best first, leaving out candidates
+    whose alphabet lacks one of its letters."""
+
+    counts = ngrams(text)
+    letters = {ch for ch in text.lower() if ch.isalpha()}
+
+    ranked = []
+    for code, (logp, unseen) in model().items():
+        if candidates is not None and code not in candidates:
+            continue
+        if not letters <= LETTERS[code]:
+            continue
+        ranked.append((sum(c * logp.get(gram, unseen) for gram, c in counts.items()), code))
+
+    return sorted(ranked, reverse=True)
+
+
+def detect_language(text, candidates=None):
+    """Return the language code of text if it can be told confidently, otherwise None.
+    candidates limits the answer to those codes (e.g. DeepL's source languages)."""
+
+    candidates = set(candidates) if candidates is not None else None
+
+    for code, pattern in SCRIPTS:
+        if pattern.search(text):
+            return code if candidates is None or code in candidates else None
+
+    words = WORDS.findall(text.lower())
+    if sum(len(word) for word in words) < MIN_LETTERS:
+        return None
+
+    ranked = scores(text, candidates)
+    if not ranked:
+        return None
+    if len(ranked) > 1:
+        trigrams = sum(len(word) for word in words)
+        if ranked[0][0] - ranked[1][0] < MIN_MARGIN * trigrams:
+            return None
+
+    return ranked[0][1]
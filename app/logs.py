@@ -0,0 +1,294 @@
+"""Structured logging for Translation Buddy.
+
+Every log record is written as one JSON object per line to stderr, with the id of the
+request it belongs to. The id is taken from an incoming X-Request-ID header when it looks
+sane, generated otherwise, and sent back in the response's X-Request-ID header, so a
+request can be followed from the load balancer through its SQL statements (the "sql"
+logger, at DEBUG) and DeepL calls (the "deepl.calls" logger), to the one "access" line
+written when it finishes.
+
+Logging never blocks a request on I/O: records are put on a queue and formatted and
+written by a listener thread, one per process (restarted after a fork). When the queue
+is full (LOG_QUEUE_SIZE records), records are dropped and counted rather than waited on.
+
+DEBUG records can be sampled. LOG_DEBUG_SAMPLE_RATE (default 1) applies to every logger,
+LOG_SAMPLE_RATES ("sql=0.01,deepl=0.5") to loggers by name. The decision is made per
+request, from its id, so a sampled request keeps all of its debug lines and the requests
+sampled at a lower rate are a subset of those sampled at a higher one. Records at INFO and
+above are never sampled."""
+
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+import re
+import sys
+import time
+import traceback
+import uuid
+import zlib
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import request
+from flask.logging import default_handler
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+REQUEST_ID_HEADER = "X-Request-ID"
+# Incoming ids are trusted only if they can't break a log line or a header.
+VALID_REQUEST_ID = re.compile(r"[A-Za-z0-9._:-]{1,64}")
+
+DROPPED = metrics.counter("log_records_dropped_total", "Log records not written.", ["reason"])
+
+# Attributes every LogRecord has; anything else was passed in `extra` and becomes a field.
+RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+request_id_var = ContextVar("request_id", default=None)
+
+logger = logging.getLogger("access")
+sql_logger = logging.getLogger("sql")
+
+_handler = None
+_listener = None
+
+
+def new_request_id():
+    return uuid.uuid4().hex
+
+
+def incoming_request_id(value):
+    """The id sent by the client or proxy if it is usable, otherwise a new one."""
+
+    if value and VALID_REQUEST_ID.fullmatch(value):
+        return value
+    return new_request_id()
+
+
+def parse_sample_rates(spec):
+    """Parse LOG_SAMPLE_RATES ("logger=rate,logger=rate") into {logger: rate}."""
+
+    rates = {}
+    for part in filter(None, (p.strip() for p in (spec or "").split(","))):
+        name, _, rate = part.partition("=")
+        rate = float(rate)
+        if not 0 <= rate <= 1:
+            raise ValueError(f"Log sample rate for {name} must be between 0 and 1, got {rate}")
+        rates[name.strip()] = rate
+
+    return rates
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamp records with the current request id. Runs on the thread that logged."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class SampleFilter(logging.Filter):
+    """Let through a fraction of DEBUG records, chosen per request (see the module docstring)."""
+
+    def __init__(self, default_rate=1.0, rates=None):
+        super().__init__()
+        self.default_rate = default_rate
+        self.rates = rates or {}
+
+    def rate(self, name):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition(".")[0]
+        return self.default_rate
+
+    def filter(self, record):
+        if record.levelno >= logging.INFO:
+            return True
+
+        rate = self.rate(record.name)
+        if rate >= 1:
+            return True
+
+        request_id = getattr(record, "request_id", None)
+        draw = zlib.crc32(request_id.encode()) / 2 ** 32 if request_id else random.random()
+        if draw < rate:
+            return True
+
+        DROPPED.inc(reason="sampled")
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, request id and any extra fields."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+        }
+        entry.update((k, v) for k, v in vars(record).items() if k not in RECORD_ATTRS)
+
+        if record.exc_info:
+            entry["exc"] = "".join(traceback.format_exception(*record.exc_info)).rstrip()
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+
+        if orjson:
+            return orjson.dumps(entry, default=str).decode()
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class NonBlockingHandler(QueueHandler):
+    """Hand records to the listener thread without formatting them or waiting for room."""
+
+    def prepare(self, record):
+        # Only the message is merged here, since its arguments may change after this call
+        # returns. Building the JSON and the traceback text is left to the listener.
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc(reason="queue_full")
+
+
+def start_listener():
+    """Start this process's writer thread on a fresh queue. A child process calls this
+    after a fork: the parent's thread doesn't exist in it, and whatever was still on the
+    parent's queue is the parent's to write."""
+
+    global _listener
+
+    _handler.queue = queue.Queue(_handler.queue.maxsize)
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonFormatter())
+    _listener = QueueListener(_handler.queue, stream)
+    _listener.start()
+
+
+def stop_listener():
+    """Write out what is queued and stop the writer thread."""
+
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def configure_logging(level, debug_sample_rate=1.0, sample_rates=None, queue_size=10000):
+    """Send every logger's records through the queue. Safe to call again to change settings."""
+
+    global _handler
+
+    if _handler is None:
+        _handler = NonBlockingHandler(queue.Queue(queue_size))
+        _handler.addFilter(RequestIdFilter())
+        _handler.addFilter(SampleFilter())
+
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(_handler)
+
+        start_listener()
+        atexit.register(stop_listener)
+
+    sampler = _handler.filters[1]
+    sampler.default_rate = debug_sample_rate
+    sampler.rates = sample_rates or {}
+
+    logging.getLogger().setLevel(level)
+    # SQLAlchemy logs every statement with its parameters once its logger is enabled for
+    # INFO. The "sql" logger above replaces that, without the parameters.
+    logging.getLogger("sqlalchemy").setLevel(logging.WARNING)
+
+
+def log_sql_start(conn, cursor, statement, parameters, context, executemany):
+    if sql_logger.isEnabledFor(logging.DEBUG):
+        context.log_started = time.perf_counter()
+
+
+def log_sql(conn, cursor, statement, parameters, context, executemany):
+    """Log each statement at DEBUG with its duration. Parameters are left out."""
+
+    started = getattr(context, "log_started", None)
+    if started is None:
+        return
+
+    sql_logger.debug("SQL statement", extra={
+        "statement": " ".join(statement.split()),
+        "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+        "rows": cursor.rowcount,
+        "executemany": executemany,
+    })
+
+
+def start_request():
+    # request_id_var is already set when asgi.py has taken the id for POST /translate.
+    request_id = request_id_var.get() or incoming_request_id(request.headers.get(REQUEST_ID_HEADER))
+    request.environ["request_id.token"] = request_id_var.set(request_id)
+    request.environ.setdefault("request_id.started", time.perf_counter())
+
+
+def finish_request(response):
+    """Return the request id and log one line per request."""
+
+    request_id = request_id_var.get()
+    if request_id is None:
+        return response
+
+    response.headers[REQUEST_ID_HEADER] = request_id
+
+    started = request.environ.get("request_id.started")
+    logger.info("%s %s %s", request.method, request.path, response.status_code, extra={
+        "method": request.method,
+        "path": request.path,
+        "endpoint": request.endpoint,
+        "status": response.status_code,
+        "duration_ms": round((time.perf_counter() - started) * 1000, 1) if started else None,
+    })
+
+    return response
+
+
+def end_request(exc):
+    token = request.environ.pop("request_id.token", None)
+    if token is not None:
+        request_id_var.reset(token)
+
+
+def init_logging(app):
+    """Configure logging from the app's settings and register the request id hooks."""
+
+    configure_logging(app.config["LOG_LEVEL"], app.config["LOG_DEBUG_SAMPLE_RATE"],
+                      app.config["LOG_SAMPLE_RATES"], app.config["LOG_QUEUE_SIZE"])
+    # The root logger's handler is enough; Flask's would write the same records again.
+    app.logger.removeHandler(default_handler)
+
+    if not event.contains(Engine, "before_cursor_execute", log_sql_start):
+        event.listen(Engine, "before_cursor_execute", log_sql_start)
+        event.listen(Engine, "after_cursor_execute", log_sql)
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(end_request)
@@ -0,0 +1,160 @@
+"""In-process metrics for Translation Buddy, served in the Prometheus text format.
+
+Each worker process keeps its own values, so scrape every worker (or sum them)."""
+
+import hmac
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Blueprint, current_app, request, abort
+
+metrics = Blueprint("metrics", __name__)
+
+_registry = {}
+_lock = threading.Lock()
+
+
+class Metric:
+    """A named family of values, one per combination of label values."""
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def label_text(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    def samples(self):
+        with self.lock:
+            return [(self.name + self.label_text(key), value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name} {value}" for name, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=(.001, .005, .01, .05, .1, .5, 1, 5)):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            counts = [c + (value <= bound) for c, bound in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the with block takes."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        out = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                for bound, count in zip(self.buckets, counts):
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    out.append((f"{self.name}_bucket{self.label_text(key, [('le', le)])}", count))
+                out.append((f"{self.name}_sum{self.label_text(key)}", total))
+                out.append((f"{self.name}_count{self.label_text(key)}", counts[-1]))
+        return out
+
+
+def _get_or_create(cls, name, help, labelnames=(), **kwargs):
+    with _lock:
+        if name not in _registry:
+            _registry[name] = cls(name, help, labelnames, **kwargs)
+        return _registry[name]
+
+
+def counter(name, help, labelnames=()):
+    return _get_or_create(Counter, name, help, labelnames)
+
+
+def gauge(name, help, labelnames=()):
+    return _get_or_create(Gauge, name, help, labelnames)
+
+
+def histogram(name, help, labelnames=(), **kwargs):
+    return _get_or_create(Histogram, name, help, labelnames, **kwargs)
+
+
+def render():
+    """Render every registered metric in the Prometheus text format."""
+
+    with _lock:
+        families = list(_registry.values())
+
+    return "\n".join(m.render() for m in families) + "\n"
+
+
+def admin_authorized():
+    """Check the request carries the ADMIN_TOKEN, as `Authorization: Bearer <token>` or X-Admin-Token."""
+
+    token = current_app.config.get("ADMIN_TOKEN")
+    if not token:
+        return False
+
+    sent = request.headers.get("X-Admin-Token", "")
+    auth = request.headers.get("Authorization", "")
+    if auth.startswith("Bearer "):
+        sent = auth[len("Bearer "):]
+
+    return hmac.compare_digest(sent.encode(), token.encode())
+
+
+@metrics.route("/metrics")
+def show_metrics():
+    """Expose this worker's metrics. Requires the admin token."""
+
+    if not admin_authorized():
+        abort(404)
+
+    return current_app.response_class(render(), mimetype="text/plain; version=0.0.4")
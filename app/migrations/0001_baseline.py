@@ -0,0 +1,33 @@
+"""Add the columns and tables introduced before migrations existed."""
+
+from sqlalchemy import text
+
+
+def upgrade(conn):
+    conn.execute(text("""
+        ALTER TABLE phrasebooks
+            ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1,
+            ADD COLUMN IF NOT EXISTS translation_count INTEGER NOT NULL DEFAULT 0"""))
+
+    conn.execute(text("""
+        ALTER TABLE users
+            ADD COLUMN IF NOT EXISTS sync_floor BIGINT NOT NULL DEFAULT 0"""))
+
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS change_log (
+            id BIGSERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            entity VARCHAR NOT NULL,
+            phrasebook_id INTEGER NOT NULL,
+            translation_id INTEGER,
+            op VARCHAR NOT NULL,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+        )"""))
+
+    conn.execute(text("""
+        CREATE INDEX IF NOT EXISTS ix_change_log_user_id_id ON change_log (user_id, id)"""))
+
+    conn.execute(text("""
+        UPDATE phrasebooks p
+        SET translation_count = (SELECT count(*) FROM phrasebook_translation pt
+                                 WHERE pt.phrasebook_id = p.id)"""))
@@ -0,0 +1,22 @@
+"""Index the foreign keys and filters used by the phrasebook pages and orphan checks."""
+
+from migrations import create_index_concurrently
+
+transactional = False
+
+
+def upgrade(conn):
+    # /user and every ETag version vector: phrasebooks by owner
+    create_index_concurrently(conn, "ix_phrasebooks_user_id", "phrasebooks", "user_id")
+
+    # /public listing and its language filter
+    create_index_concurrently(conn, "ix_phrasebooks_public_langs", "phrasebooks",
+                              "public, lang_from, lang_to")
+
+    # Orphan checks look associations up by translation alone
+    create_index_concurrently(conn, "ix_phrasebook_translation_translation_id",
+                              "phrasebook_translation", "translation_id")
+
+    # find_existing_translation: equality on the source text
+    create_index_concurrently(conn, "ix_translations_text_from", "translations",
+                              "text_from", using="hash")
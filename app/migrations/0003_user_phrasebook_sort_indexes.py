@@ -0,0 +1,13 @@
+"""Index the sort and language filter of the user phrasebook list."""
+
+from migrations import create_index_concurrently
+
+transactional = False
+
+
+def upgrade(conn):
+    # /user?lang= filter, language sort and the filter menu's distinct languages
+    create_index_concurrently(conn, "ix_phrasebooks_user_id_lang_to", "phrasebooks", "user_id, lang_to")
+
+    # /user?sort=name
+    create_index_concurrently(conn, "ix_phrasebooks_user_id_lower_name", "phrasebooks", "user_id, lower(name)")
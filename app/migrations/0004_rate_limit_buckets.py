@@ -0,0 +1,12 @@
+"""Add the table that holds rate limit buckets shared between workers."""
+
+from sqlalchemy import text
+
+
+def upgrade(conn):
+    conn.execute(text("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+            key VARCHAR PRIMARY KEY,
+            tokens DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE NOT NULL
+        )"""))
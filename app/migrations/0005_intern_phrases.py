@@ -0,0 +1,62 @@
+"""Move translation texts into the phrases table, storing each text once per language.
+
+The texts are copied in id-range batches that commit on their own, so the
+translations table is never locked for the whole backfill. text_from and text_to
+stay (as nullable columns) for app processes still reading them during the deploy;
+0010 backfills any rows they wrote since and drops the columns."""
+
+from sqlalchemy import inspect, text
+
+from migrations import create_index_concurrently, run_in_batches
+
+transactional = False
+
+# Intern the texts of a batch of translations, then point them at their phrases.
+INTERN_SQL = """
+    INSERT INTO phrases (hash, lang, text)
+    SELECT md5(text_from)::uuid, lang_from, text_from FROM translations
+    WHERE id >= :lo AND id < :hi AND phrase_from_id IS NULL AND text_from IS NOT NULL
+    UNION
+    SELECT md5(text_to)::uuid, lang_to, text_to FROM translations
+    WHERE id >= :lo AND id < :hi AND phrase_to_id IS NULL AND text_to IS NOT NULL
+    ON CONFLICT ON CONSTRAINT uq_phrases_hash_lang DO NOTHING"""
+
+LINK_SQL = """
+    UPDATE translations t
+    SET phrase_from_id = pf.id, phrase_to_id = pt.id
+    FROM phrases pf, phrases pt
+    WHERE t.id >= :lo AND t.id < :hi AND (t.phrase_from_id IS NULL OR t.phrase_to_id IS NULL)
+      AND pf.hash = md5(t.text_from)::uuid AND pf.lang = t.lang_from
+      AND pt.hash = md5(t.text_to)::uuid AND pt.lang = t.lang_to"""
+
+
+def backfill(conn):
+    run_in_batches(conn, "translations", INTERN_SQL)
+    run_in_batches(conn, "translations", LINK_SQL)
+
+
+def upgrade(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS phrases (
+            id SERIAL PRIMARY KEY,
+            hash UUID NOT NULL,
+            lang VARCHAR NOT NULL,
+            text TEXT NOT NULL,
+            CONSTRAINT uq_phrases_hash_lang UNIQUE (hash, lang)
+        )"""))
+
+    conn.execute(text("""
+        ALTER TABLE translations
+            ADD COLUMN IF NOT EXISTS phrase_from_id INTEGER REFERENCES phrases (id),
+            ADD COLUMN IF NOT EXISTS phrase_to_id INTEGER REFERENCES phrases (id)"""))
+
+    columns = {c["name"] for c in inspect(conn).get_columns("translations")}
+    if "text_from" in columns:
+        # The new code inserts translations without the texts.
+        conn.execute(text("""
+            ALTER TABLE translations
+                ALTER COLUMN text_from DROP NOT NULL,
+                ALTER COLUMN text_to DROP NOT NULL"""))
+        backfill(conn)
+
+    create_index_concurrently(conn, "ix_translations_phrase_from_id", "translations", "phrase_from_id")
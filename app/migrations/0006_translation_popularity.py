@@ -0,0 +1,27 @@
+"""Add the public save counts behind the popular translations listing, counted from the existing phrasebooks."""
+
+from sqlalchemy import text
+
+
+def upgrade(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS translation_popularity (
+            translation_id INTEGER PRIMARY KEY REFERENCES translations (id) ON DELETE CASCADE,
+            lang_from VARCHAR NOT NULL,
+            lang_to VARCHAR NOT NULL,
+            saves INTEGER NOT NULL
+        )"""))
+
+    conn.execute(text("""
+        CREATE INDEX IF NOT EXISTS ix_translation_popularity_langs_saves
+            ON translation_popularity (lang_from, lang_to, saves DESC, translation_id)"""))
+
+    conn.execute(text("""
+        INSERT INTO translation_popularity (translation_id, lang_from, lang_to, saves)
+        SELECT t.id, t.lang_from, t.lang_to, count(*)
+        FROM translations t
+        JOIN phrasebook_translation pt ON pt.translation_id = t.id
+        JOIN phrasebooks p ON p.id = pt.phrasebook_id
+        WHERE p.public
+        GROUP BY t.id
+        ON CONFLICT (translation_id) DO UPDATE SET saves = excluded.saves"""))
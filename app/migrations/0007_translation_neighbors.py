@@ -0,0 +1,24 @@
+"""Add the co-occurrence neighbors behind phrasebook suggestions. Every translation in a public
+phrasebook starts out stale; `flask refresh-recommendations` computes them."""
+
+from sqlalchemy import text
+
+
+def upgrade(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS translation_neighbors (
+            translation_id INTEGER PRIMARY KEY REFERENCES translations (id) ON DELETE CASCADE,
+            neighbor_ids INTEGER[] NOT NULL DEFAULT '{}',
+            stale BOOLEAN NOT NULL DEFAULT true
+        )"""))
+
+    conn.execute(text("""
+        CREATE INDEX IF NOT EXISTS ix_translation_neighbors_stale
+            ON translation_neighbors (translation_id) WHERE stale"""))
+
+    conn.execute(text("""
+        INSERT INTO translation_neighbors (translation_id)
+        SELECT DISTINCT pt.translation_id
+        FROM phrasebook_translation pt JOIN phrasebooks p ON p.id = pt.phrasebook_id
+        WHERE p.public
+        ON CONFLICT (translation_id) DO NOTHING"""))
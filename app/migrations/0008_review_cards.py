@@ -0,0 +1,29 @@
+"""Add spaced repetition review cards, one per existing phrasebook entry, all due now."""
+
+from sqlalchemy import text
+
+
+def upgrade(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS review_cards (
+            phrasebook_id INTEGER NOT NULL,
+            translation_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            due_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            "interval" DOUBLE PRECISION NOT NULL DEFAULT 0,
+            ease DOUBLE PRECISION NOT NULL DEFAULT 2.5,
+            reps SMALLINT NOT NULL DEFAULT 0,
+            lapses SMALLINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (phrasebook_id, translation_id),
+            FOREIGN KEY (phrasebook_id, translation_id)
+                REFERENCES phrasebook_translation (phrasebook_id, translation_id) ON DELETE CASCADE
+        )"""))
+
+    conn.execute(text("""
+        CREATE INDEX IF NOT EXISTS ix_review_cards_user_id_due_at ON review_cards (user_id, due_at)"""))
+
+    conn.execute(text("""
+        INSERT INTO review_cards (phrasebook_id, translation_id, user_id)
+        SELECT pt.phrasebook_id, pt.translation_id, p.user_id
+        FROM phrasebook_translation pt JOIN phrasebooks p ON p.id = pt.phrasebook_id
+        ON CONFLICT DO NOTHING"""))
@@ -0,0 +1,19 @@
+"""Add the table that holds request profiles, so any worker can serve any worker's profile."""
+
+from sqlalchemy import text
+
+
+def upgrade(conn):
+    conn.execute(text("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS request_profiles (
+            id BIGSERIAL PRIMARY KEY,
+            reason VARCHAR NOT NULL,
+            endpoint VARCHAR,
+            method VARCHAR NOT NULL,
+            path VARCHAR NOT NULL,
+            status INTEGER NOT NULL,
+            duration_ms DOUBLE PRECISION NOT NULL,
+            samples INTEGER NOT NULL,
+            started_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            stacks TEXT NOT NULL
+        )"""))
@@ -0,0 +1,38 @@
+"""Drop the translation text columns replaced by phrases and make the phrase ids required.
+
+Run once no app process reads text_from or text_to any more. The NOT NULL is proved
+by a CHECK constraint added NOT VALID and then validated, which doesn't block writes,
+so SET NOT NULL can skip its own scan of the table."""
+
+import importlib
+
+from sqlalchemy import inspect, text
+
+transactional = False
+
+intern_phrases = importlib.import_module("migrations.0005_intern_phrases")
+
+
+def upgrade(conn):
+    columns = {c["name"]: c for c in inspect(conn).get_columns("translations")}
+
+    if "text_from" in columns:
+        # Rows written by the old code while 0005 was rolling out
+        intern_phrases.backfill(conn)
+
+    if columns["phrase_from_id"]["nullable"] or columns["phrase_to_id"]["nullable"]:
+        conn.execute(text("ALTER TABLE translations DROP CONSTRAINT IF EXISTS ck_translations_phrase_ids"))
+        conn.execute(text("""
+            ALTER TABLE translations ADD CONSTRAINT ck_translations_phrase_ids
+                CHECK (phrase_from_id IS NOT NULL AND phrase_to_id IS NOT NULL) NOT VALID"""))
+        conn.execute(text("ALTER TABLE translations VALIDATE CONSTRAINT ck_translations_phrase_ids"))
+        conn.execute(text("""
+            ALTER TABLE translations
+                ALTER COLUMN phrase_from_id SET NOT NULL,
+                ALTER COLUMN phrase_to_id SET NOT NULL"""))
+        conn.execute(text("ALTER TABLE translations DROP CONSTRAINT ck_translations_phrase_ids"))
+
+    conn.execute(text("DROP INDEX CONCURRENTLY IF EXISTS ix_translations_text_from"))
+
+    if "text_from" in columns:
+        conn.execute(text("ALTER TABLE translations DROP COLUMN text_from, DROP COLUMN text_to"))
@@ -0,0 +1,135 @@
+"""Versioned schema migrations for Translation Buddy.
+
+Each migration is a module in this package named NNNN_description.py with an
+`upgrade(conn)` function. Migrations run in transactions unless the module sets
+`transactional = False`, which is needed for CREATE INDEX CONCURRENTLY so that
+index builds on a live database don't lock writes, and for backfills that commit
+in batches (see run_in_batches). Applied revisions are
+recorded in the schema_migrations table."""
+
+import importlib
+import pkgutil
+
+from sqlalchemy import inspect, text
+
+MIGRATIONS_TABLE = "schema_migrations"
+
+
+def discover():
+    """Return all migration modules in revision order."""
+
+    names = sorted(name for _, name, _ in pkgutil.iter_modules(__path__) if name[:4].isdigit())
+
+    return [importlib.import_module(f"{__name__}.{name}") for name in names]
+
+
+def revision(migration):
+    return migration.__name__.rsplit(".", 1)[-1]
+
+
+def ensure_migrations_table(engine):
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} (
+                revision TEXT PRIMARY KEY,
+                applied_at TIMESTAMP NOT NULL DEFAULT now()
+            )"""))
+
+
+def applied_revisions(engine):
+    ensure_migrations_table(engine)
+
+    with engine.connect() as conn:
+        return {row[0] for row in conn.execute(text(f"SELECT revision FROM {MIGRATIONS_TABLE}"))}
+
+
+def record(conn, migration):
+    conn.execute(text(f"INSERT INTO {MIGRATIONS_TABLE} (revision) VALUES (:revision)"),
+                 {"revision": revision(migration)})
+
+
+def pending_migrations(engine):
+    done = applied_revisions(engine)
+
+    return [m for m in discover() if revision(m) not in done]
+
+
+def stamp(engine):
+    """Mark every migration as applied, for databases created from the current models."""
+
+    pending = pending_migrations(engine)
+
+    with engine.begin() as conn:
+        for migration in pending:
+            record(conn, migration)
+
+    return pending
+
+
+def upgrade(engine, db=None, echo=print):
+    """Apply all pending migrations in order and return them.
+
+    If the database has no tables yet and `db` is given, the current models are
+    created directly and every migration is stamped as applied instead."""
+
+    if db is not None and not inspect(engine).has_table("users"):
+        db.create_all()
+        echo("Created schema from models.")
+        return stamp(engine)
+
+    pending = pending_migrations(engine)
+
+    for migration in pending:
+        echo(f"Applying {revision(migration)}: {(migration.__doc__ or '').strip().splitlines()[0]}")
+
+        if getattr(migration, "transactional", True):
+            with engine.begin() as conn:
+                migration.upgrade(conn)
+                record(conn, migration)
+        else:
+            with engine.connect() as conn:
+                conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+                migration.upgrade(conn)
+                record(conn, migration)
+
+    return pending
+
+
+def create_index_concurrently(conn, name, table, columns, using=None, where=None):
+    """Build an index without blocking writes. Must run outside a transaction.
+
+    A concurrent build that failed part way leaves an invalid index behind,
+    which is dropped first so the migration can simply be rerun."""
+
+    invalid = conn.execute(text("""
+        SELECT NOT i.indisvalid
+        FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = :name"""), {"name": name}).scalar()
+
+    if invalid:
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+    sql = f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table}"
+    if using:
+        sql += f" USING {using}"
+    sql += f" ({columns})"
+    if where:
+        sql += f" WHERE {where}"
+
+    conn.execute(text(sql))
+
+
+def run_in_batches(conn, table, sql, batch_size=5000):
+    """Run `sql` over `table` one id range at a time, binding :lo and :hi (lo <= id < hi).
+    On a non-transactional migration's connection each batch commits on its own,
+    so rows are only locked for one batch. Returns the total rowcount."""
+
+    lo, hi = conn.execute(text(f"SELECT min(id), max(id) FROM {table}")).one()
+    if lo is None:
+        return 0
+
+    total = 0
+    for start in range(lo, hi + 1, batch_size):
+        total += conn.execute(text(sql), {"lo": start, "hi": start + batch_size}).rowcount
+
+    return total
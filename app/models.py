@@ -1,13 +1,21 @@
 """SQLAlchemy models for Translation Buddy"""
 
+import hashlib
+import uuid
+from datetime import datetime
 from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, select, text, tuple_
+from sqlalchemy.dialects.postgresql import ARRAY, UUID, insert
+from sqlalchemy.ext.hybrid import Comparator, hybrid_property
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.sql import operators
 from sqlalchemy_utils import auto_delete_orphans
+from database import TunedSQLAlchemy
 
 
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = TunedSQLAlchemy()
 
 
 class User(db.Model):
@@ -31,6 +39,14 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Change log entries up to this id have been compacted away, so older sync cursors must resync.
+    sync_floor = db.Column(
+        db.BigInteger,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
     phrasebooks = db.relationship("Phrasebook", backref="user", cascade='all, delete-orphan')
 
     def __repr__(self):
@@ -83,6 +99,8 @@ class Phrasebook(db.Model):
     """A user's saved collection of phrases."""
 
     __tablename__ = "phrasebooks"
+    __table_args__ = (db.Index("ix_phrasebooks_public_langs", "public", "lang_from", "lang_to"),
+                      db.Index("ix_phrasebooks_user_id_lang_to", "user_id", "lang_to"))
 
     id = db.Column(
         db.Integer,
@@ -97,7 +115,8 @@ class Phrasebook(db.Model):
     user_id = db.Column(
         db.Integer, 
         db.ForeignKey("users.id"), 
-        nullable=False
+        nullable=False,
+        index=True,
     )
 
     public = db.Column(
@@ -110,6 +129,21 @@ class Phrasebook(db.Model):
     
     lang_to = db.Column(db.String, nullable=False)
 
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default="1",
+    )
+
+    # Kept equal to the number of phrasebook_translation rows, so listings can show it without loading translations.
+    translation_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
     translations = db.relationship(
         "Translation",
         secondary="phrasebook_translation",
@@ -137,6 +171,70 @@ class Phrasebook(db.Model):
         translation.delete_orphan()
 
 
+    @classmethod
+    def recount_translations(cls):
+        """Recompute translation_count for every phrasebook whose stored count is wrong.
+        Returns the number of phrasebooks that were fixed."""
+        
+        actual = (db.select(db.func.count())
+                  .where(PhrasebookTranslation.phrasebook_id == cls.id)
+                  .scalar_subquery())
+        
+        fixed = (cls.query.filter(cls.translation_count != actual)
+                 .update({"translation_count": actual}, synchronize_session=False))
+        db.session.commit()
+        
+        return fixed
+    
+
+    def add_translations(self, translations, notes=None):
+        """Add translations to phrasebook in one flush, skipping ones it already contains.
+        notes optionally maps translation id to the note to store on the association.
+        Returns the list of translations that were added."""
+        
+        notes = notes or {}
+        existing = {t_id for (t_id,) in db.session.query(PhrasebookTranslation.translation_id)
+                                                  .filter_by(phrasebook_id=self.id)}
+        added = []
+        
+        for t in translations:
+            if t.id in existing:
+                continue
+            existing.add(t.id)
+            db.session.add(PhrasebookTranslation(phrasebook_id=self.id,
+                                                 translation_id=t.id,
+                                                 note=notes.get(t.id)))
+            added.append(t)
+        
+        db.session.flush()
+        return added
+    
+
+    def delete_translations(self, translation_ids):
+        """Delete several translation associations at once and delete any translations left orphaned.
+        Returns the ids of the translations that were removed from the phrasebook."""
+        
+        pts = PhrasebookTranslation.query.filter(
+            PhrasebookTranslation.phrasebook_id == self.id,
+            PhrasebookTranslation.translation_id.in_(translation_ids)).all()
+        
+        for pt in pts:
+            db.session.delete(pt)
+        db.session.flush()
+        
+        removed = [pt.translation_id for pt in pts]
+        orphans = Translation.query.filter(Translation.id.in_(removed),
+                                           ~Translation.pb_t.any()).all()
+        for t in orphans:
+            db.session.delete(t)
+        
+        return removed
+
+
+# The user page sorts by name case-insensitively, as Jinja's sort filter did.
+db.Index("ix_phrasebooks_user_id_lower_name", Phrasebook.user_id, db.func.lower(Phrasebook.name))
+
+
 class PhrasebookTranslation(db.Model):
     """Mapping user phrasebooks to translations"""
 
@@ -153,10 +251,12 @@ class PhrasebookTranslation(db.Model):
         primary_key=True
     )
 
+    # Indexed separately since the primary key can't serve lookups by translation alone (orphan checks).
     translation_id = db.Column(
         db.Integer,
         db.ForeignKey("translations.id"),
-        primary_key=True
+        primary_key=True,
+        index=True,
     )
 
     note = db.Column(db.Text)
@@ -167,10 +267,101 @@ class PhrasebookTranslation(db.Model):
         return f"<Phrasebook #{self.phrasebook_id}, Translation #{self.translation_id}>"
 
 
+def text_hash(text):
+    """The phrases.hash of a text: its MD5, as Postgres computes it with md5(text)::uuid."""
+
+    return uuid.UUID(hashlib.md5(text.encode("utf-8")).hexdigest())
+
+
+class Phrase(db.Model):
+    """A text in one language, stored once however many translations use it.
+    Looked up by the hash of its text, so lookups compare fixed-size keys rather than long strings."""
+
+    __tablename__ = "phrases"
+    __table_args__ = (db.UniqueConstraint("hash", "lang", name="uq_phrases_hash_lang"),)
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    hash = db.Column(
+        UUID(as_uuid=True),
+        nullable=False,
+    )
+
+    lang = db.Column(
+        db.String,
+        nullable=False,
+    )
+
+    text = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    def __repr__(self):
+        return f"<Phrase #{self.id}: {self.lang} {self.text}>"
+
+    @classmethod
+    def intern(cls, connection, pairs):
+        """Given (lang, text) pairs, insert the phrases that are new and return (lang, text) -> phrase id
+        for all of them. Two statements however many pairs there are."""
+
+        pairs = set(pairs)
+        if not pairs:
+            return {}
+
+        phrases = cls.__table__
+        rows = [{"hash": text_hash(text), "lang": lang, "text": text} for lang, text in pairs]
+        connection.execute(insert(phrases).values(rows).on_conflict_do_nothing(constraint="uq_phrases_hash_lang"))
+
+        found = connection.execute(select(phrases.c.id, phrases.c.lang, phrases.c.text)
+                                   .where(tuple_(phrases.c.hash, phrases.c.lang)
+                                          .in_([(row["hash"], row["lang"]) for row in rows])))
+        ids = {(lang, text): id for id, lang, text in found}
+
+        if len(ids.keys() & pairs) < len(pairs):
+            raise ValueError("Phrase hash collision")
+
+        return ids
+
+
+def phrase_text(phrase_id):
+    """The text of the phrase with id phrase_id (a column), for use in a select."""
+
+    return select(Phrase.text).where(Phrase.id == phrase_id).scalar_subquery()
+
+
+class PhraseText(Comparator):
+    """Compares a translation's text by looking the phrase up by hash, so filters such as
+    text_from == "hello" or text_from.in_(texts) become phrase id lookups."""
+
+    def __init__(self, phrase_id):
+        super().__init__(phrase_id)
+        self.phrase_id = phrase_id
+
+    def __clause_element__(self):
+        return phrase_text(self.phrase_id)
+
+    def operate(self, op, *other, **kwargs):
+        if op is operators.eq:
+            texts = [other[0]]
+        elif op is operators.in_op:
+            texts = list(other[0])
+        else:
+            return op(self.__clause_element__(), *other, **kwargs)
+
+        matching = select(Phrase.id).where(Phrase.hash.in_([text_hash(t) for t in texts]), Phrase.text.in_(texts))
+        return self.phrase_id.in_(matching)
+
+
 class Translation(db.Model):
-    """Translations that have been saved by a user."""
+    """Translations that have been saved by a user.
+    The texts are interned in the phrases table; text_from and text_to read and filter through it."""
 
     __tablename__ = "translations"
+    __table_args__ = (db.Index("ix_translations_phrase_from_id", "phrase_from_id"),)
 
     id = db.Column(
         db.Integer,
@@ -187,23 +378,77 @@ class Translation(db.Model):
         nullable=False,
     )
 
-    text_from = db.Column(
-        db.Text,
+    phrase_from_id = db.Column(
+        db.Integer,
+        db.ForeignKey("phrases.id"),
         nullable=False,
     )
 
-    text_to = db.Column(
-        db.Text,
+    phrase_to_id = db.Column(
+        db.Integer,
+        db.ForeignKey("phrases.id"),
         nullable=False,
     )
 
+    phrase_from = db.relationship("Phrase", foreign_keys=[phrase_from_id], lazy="joined", innerjoin=True)
+
+    phrase_to = db.relationship("Phrase", foreign_keys=[phrase_to_id], lazy="joined", innerjoin=True)
+
     pb_t = db.relationship("PhrasebookTranslation", back_populates="translation", overlaps="phrasebooks,translations")
 
+    # Texts given to a new translation are interned when it's flushed (see intern_translation_texts).
+    @hybrid_property
+    def text_from(self):
+        if "_text_from" in self.__dict__:
+            return self._text_from
+        return self.phrase_from.text
+
+    @text_from.setter
+    def text_from(self, value):
+        self._text_from = value
+
+    @text_from.comparator
+    def text_from(cls):
+        return PhraseText(cls.phrase_from_id)
+
+    @hybrid_property
+    def text_to(self):
+        if "_text_to" in self.__dict__:
+            return self._text_to
+        return self.phrase_to.text
+
+    @text_to.setter
+    def text_to(self, value):
+        self._text_to = value
+
+    @text_to.comparator
+    def text_to(cls):
+        return PhraseText(cls.phrase_to_id)
     
     def __repr__(self):
         return f"<Translation #{self.id}: {self.text_from} >> {self.text_to}>"
     
 
+    @classmethod
+    def find_existing(cls, keys):
+        """Given (lang_from, lang_to, text_from, text_to) keys, find all matching saved translations in one query.
+        Returns a dictionary of key -> translation for the keys that already exist."""
+        
+        keys = set(keys)
+        if not keys:
+            return {}
+
+        phrase_from, phrase_to = aliased(Phrase), aliased(Phrase)
+        hashes = {(lang_from, lang_to, text_hash(text_from), text_hash(text_to))
+                  for lang_from, lang_to, text_from, text_to in keys}
+        found = (cls.query
+                 .join(phrase_from, cls.phrase_from_id == phrase_from.id)
+                 .join(phrase_to, cls.phrase_to_id == phrase_to.id)
+                 .filter(db.tuple_(cls.lang_from, cls.lang_to, phrase_from.hash, phrase_to.hash).in_(hashes))
+                 .all())
+        
+        return {key: t for t in found for key in [(t.lang_from, t.lang_to, t.text_from, t.text_to)] if key in keys}
+
     def delete_orphan(self):
         """Delete translation if it does not belong to any phrasebook."""
         if not len(self.phrasebooks):
@@ -211,10 +456,616 @@ class Translation(db.Model):
 
     def to_dict(self):
         """Serialize SQLalchemy translation object into dictionary for storage in flask session. """
-        dict = {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        dict = {name: getattr(self, name) for name in ("id", "lang_from", "lang_to", "text_from", "text_to")}
         
         return dict
 
+class ReviewCard(db.Model):
+    """Spaced repetition state of one phrasebook entry (see practice.py). Every entry gets a card
+    when it's saved, due straight away. user_id is copied from the phrasebook so a user's due
+    cards can be read in order from one index."""
+
+    __tablename__ = "review_cards"
+    __table_args__ = (db.ForeignKeyConstraint(["phrasebook_id", "translation_id"],
+                                              ["phrasebook_translation.phrasebook_id",
+                                               "phrasebook_translation.translation_id"],
+                                              ondelete="CASCADE"),
+                      db.Index("ix_review_cards_user_id_due_at", "user_id", "due_at"))
+
+    phrasebook_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    translation_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    due_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        server_default=db.func.now(),
+    )
+
+    # Days until the next review after a correct answer; 0 while the card is being (re)learned.
+    interval = db.Column(
+        db.Float,
+        nullable=False,
+        server_default="0",
+    )
+
+    ease = db.Column(
+        db.Float,
+        nullable=False,
+        server_default="2.5",
+    )
+
+    # Correct answers in a row.
+    reps = db.Column(
+        db.SmallInteger,
+        nullable=False,
+        server_default="0",
+    )
+
+    lapses = db.Column(
+        db.SmallInteger,
+        nullable=False,
+        server_default="0",
+    )
+
+    def __repr__(self):
+        return f"<ReviewCard {self.phrasebook_id}/{self.translation_id}: due {self.due_at}>"
+
+
+# Advisory lock namespace serializing each user's change log writers.
+CHANGE_LOG_LOCK = 29
+
+
+class ChangeLog(db.Model):
+    """Append-only log of changes to a user's phrasebooks and their translations, used for delta sync.
+    Translation entries are identified by (phrasebook_id, translation_id), phrasebooks by phrasebook_id alone."""
+
+    __tablename__ = "change_log"
+    __table_args__ = (db.Index("ix_change_log_user_id_id", "user_id", "id"),)
+
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    # No foreign key: entries are written during flushes that may also delete the user.
+    user_id = db.Column(db.Integer, nullable=False)
+
+    # "phrasebook" or "translation"
+    entity = db.Column(db.String, nullable=False)
+
+    phrasebook_id = db.Column(db.Integer, nullable=False)
+
+    translation_id = db.Column(db.Integer)
+
+    # "insert", "update" or "delete"
+    op = db.Column(db.String, nullable=False)
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    def __repr__(self):
+        return f"<ChangeLog #{self.id}: {self.op} {self.entity} {self.phrasebook_id}/{self.translation_id}>"
+
+
+class RateLimitBucket(db.Model):
+    """A token bucket shared by every worker (RATE_LIMIT_STORE=database). Rows are written by
+    ratelimit.DatabaseStore in a single upsert rather than through the ORM. The table is
+    unlogged: losing the buckets in a crash only refills them."""
+
+    __tablename__ = "rate_limit_buckets"
+    __table_args__ = {"prefixes": ["UNLOGGED"]}
+
+    # e.g. "views.translate:user:42"
+    key = db.Column(
+        db.String,
+        primary_key=True,
+    )
+
+    tokens = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    updated_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+    )
+
+    def __repr__(self):
+        return f"<RateLimitBucket {self.key}: {self.tokens:.2f}>"
+
+
+class RequestProfile(db.Model):
+    """A sampled request profile (see profiling.py), stored where every worker can serve it.
+    Only the newest PROFILE_KEEP are kept. The table is unlogged: profiles are diagnostics."""
+
+    __tablename__ = "request_profiles"
+    __table_args__ = {"prefixes": ["UNLOGGED"]}
+
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    # "requested" or "sampled"
+    reason = db.Column(
+        db.String,
+        nullable=False,
+    )
+
+    endpoint = db.Column(
+        db.String,
+    )
+
+    method = db.Column(
+        db.String,
+        nullable=False,
+    )
+
+    path = db.Column(
+        db.String,
+        nullable=False,
+    )
+
+    status = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    duration_ms = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    samples = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    started_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+    )
+
+    # Collapsed stacks, one "frame;frame;frame count" line each, most frequent first.
+    stacks = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    def __repr__(self):
+        return f"<RequestProfile #{self.id}: {self.method} {self.path}>"
+
+
+class TranslationPopularity(db.Model):
+    """How many public phrasebooks each translation is saved in, so the most saved translations
+    for a language pair can be listed from an index instead of counting phrasebook_translation.
+    Kept up to date by update_public_aggregates; translations in no public phrasebook have no row."""
+
+    __tablename__ = "translation_popularity"
+
+    translation_id = db.Column(
+        db.Integer,
+        db.ForeignKey("translations.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+
+    lang_from = db.Column(
+        db.String,
+        nullable=False,
+    )
+
+    lang_to = db.Column(
+        db.String,
+        nullable=False,
+    )
+
+    saves = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    def __repr__(self):
+        return f"<TranslationPopularity #{self.translation_id}: {self.saves}>"
+
+    @classmethod
+    def refresh(cls, connection, translation_ids=None):
+        """Recount the public saves of translation_ids, or of every translation if None.
+        Returns the number of rows that changed.
+
+        The translations are locked first (FOR NO KEY UPDATE, which doesn't block the key share
+        lock of new phrasebook_translation rows), so a concurrent recount of the same translation
+        waits for this transaction to commit and then counts its saves too."""
+
+        popularity = cls.__table__
+        translations = Translation.__table__
+        pb_translations = PhrasebookTranslation.__table__
+        phrasebooks = Phrasebook.__table__
+
+        counts = (select(translations.c.id, translations.c.lang_from, translations.c.lang_to, db.func.count())
+                  .select_from(translations.join(pb_translations).join(phrasebooks))
+                  .where(phrasebooks.c.public == True)
+                  .group_by(translations.c.id))
+
+        public_saves = (select(pb_translations.c.translation_id)
+                        .select_from(pb_translations.join(phrasebooks))
+                        .where(phrasebooks.c.public == True,
+                               pb_translations.c.translation_id == popularity.c.translation_id))
+        unsaved = popularity.delete().where(~public_saves.exists())
+
+        if translation_ids is not None:
+            translation_ids = sorted(translation_ids)
+            connection.execute(select(translations.c.id)
+                               .where(translations.c.id.in_(translation_ids))
+                               .order_by(translations.c.id)
+                               .with_for_update(key_share=True))
+            counts = counts.where(translations.c.id.in_(translation_ids))
+            unsaved = unsaved.where(popularity.c.translation_id.in_(translation_ids))
+
+        upsert = insert(popularity).from_select(["translation_id", "lang_from", "lang_to", "saves"], counts)
+        upsert = upsert.on_conflict_do_update(index_elements=["translation_id"],
+                                              set_={"saves": upsert.excluded.saves},
+                                              where=popularity.c.saves != upsert.excluded.saves)
+
+        return connection.execute(upsert).rowcount + connection.execute(unsaved).rowcount
+
+
+# Listing the most saved translations for a language pair reads this index in order.
+db.Index("ix_translation_popularity_langs_saves", TranslationPopularity.lang_from,
+         TranslationPopularity.lang_to, TranslationPopularity.saves.desc(), TranslationPopularity.translation_id)
+
+
+class TranslationNeighbors(db.Model):
+    """The translations most often saved in the same public phrasebooks as a translation, within
+    its language pair, most frequent first. Changes to public phrasebooks mark the translations
+    involved stale (see update_public_aggregates); refresh() recomputes stale rows in batches,
+    so recommendations are read from these arrays without joining phrasebook_translation."""
+
+    __tablename__ = "translation_neighbors"
+
+    # How many neighbors are kept per translation.
+    TOP_N = 20
+
+    translation_id = db.Column(
+        db.Integer,
+        db.ForeignKey("translations.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+
+    neighbor_ids = db.Column(
+        ARRAY(db.Integer),
+        nullable=False,
+        default=list,
+        server_default="{}",
+    )
+
+    stale = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=True,
+        server_default="true",
+    )
+
+    def __repr__(self):
+        return f"<TranslationNeighbors #{self.translation_id}: {self.neighbor_ids}>"
+
+    MARK_STALE_SQL = text("""
+        INSERT INTO translation_neighbors (translation_id, stale)
+        SELECT id, true FROM translations WHERE id = ANY(:translation_ids)
+        UNION
+        SELECT pt.translation_id, true
+        FROM phrasebook_translation pt JOIN phrasebooks p ON p.id = pt.phrasebook_id
+        WHERE p.public AND pt.phrasebook_id = ANY(:phrasebook_ids)
+        ON CONFLICT (translation_id) DO UPDATE SET stale = true
+        WHERE NOT translation_neighbors.stale""")
+
+    # Count how often each translation of a stale batch shares a public phrasebook with
+    # the other translations of its language pair, and keep the TOP_N most frequent.
+    REFRESH_SQL = text("""
+        WITH batch AS (
+            SELECT translation_id FROM translation_neighbors
+            WHERE stale
+            ORDER BY translation_id
+            LIMIT :batch_size
+            FOR UPDATE SKIP LOCKED
+        ), pairs AS (
+            SELECT a.translation_id, b.translation_id AS neighbor_id, count(*) AS shared
+            FROM batch
+            JOIN phrasebook_translation a ON a.translation_id = batch.translation_id
+            JOIN phrasebooks p ON p.id = a.phrasebook_id AND p.public
+            JOIN phrasebook_translation b ON b.phrasebook_id = a.phrasebook_id
+                                         AND b.translation_id <> a.translation_id
+            JOIN translations ta ON ta.id = a.translation_id
+            JOIN translations tb ON tb.id = b.translation_id
+                                AND tb.lang_from = ta.lang_from AND tb.lang_to = ta.lang_to
+            GROUP BY a.translation_id, b.translation_id
+        ), ranked AS (
+            SELECT translation_id, neighbor_id,
+                   row_number() OVER (PARTITION BY translation_id ORDER BY shared DESC, neighbor_id) AS rank
+            FROM pairs
+        )
+        UPDATE translation_neighbors tn
+        SET stale = false,
+            neighbor_ids = coalesce((SELECT array_agg(neighbor_id ORDER BY rank) FROM ranked
+                                     WHERE ranked.translation_id = tn.translation_id AND rank <= :top_n), '{}')
+        FROM batch
+        WHERE tn.translation_id = batch.translation_id""")
+
+    RECOMMEND_SQL = text("""
+        SELECT n.neighbor_id
+        FROM translation_neighbors tn
+        CROSS JOIN LATERAL unnest(tn.neighbor_ids) WITH ORDINALITY AS n(neighbor_id, rank)
+        WHERE tn.translation_id = ANY(:translation_ids) AND n.neighbor_id <> ALL(:translation_ids)
+        GROUP BY n.neighbor_id
+        ORDER BY count(*) DESC, min(n.rank), n.neighbor_id
+        LIMIT :limit""")
+
+    @classmethod
+    def mark_stale(cls, connection, translation_ids, phrasebook_ids=()):
+        """Queue translation_ids, and every translation in the public phrasebooks phrasebook_ids, for refresh()."""
+
+        connection.execute(cls.MARK_STALE_SQL, {"translation_ids": list(translation_ids),
+                                                "phrasebook_ids": list(phrasebook_ids)})
+
+    @classmethod
+    def refresh(cls, connection, batch_size=500):
+        """Recompute the neighbors of up to batch_size stale translations. Returns how many were refreshed.
+        Concurrent refreshes take different batches."""
+
+        return connection.execute(cls.REFRESH_SQL, {"batch_size": batch_size, "top_n": cls.TOP_N}).rowcount
+
+    @classmethod
+    def recommend(cls, translation_ids, limit=10):
+        """Translations often saved together with translation_ids that aren't among them,
+        best first. Reads only the precomputed neighbor arrays."""
+
+        translation_ids = list(translation_ids)
+        if not translation_ids:
+            return []
+
+        ids = [id for (id,) in db.session.execute(cls.RECOMMEND_SQL, {"translation_ids": translation_ids,
+                                                                      "limit": limit})]
+        found = {t.id: t for t in Translation.query.filter(Translation.id.in_(ids))}
+
+        return [found[id] for id in ids if id in found]
+
+
+# refresh() picks its batches from the stale rows.
+db.Index("ix_translation_neighbors_stale", TranslationNeighbors.translation_id,
+         postgresql_where=TranslationNeighbors.stale)
+
+
+@event.listens_for(Session, "before_flush")
+def intern_translation_texts(session, flush_context, instances):
+    """Point new translations at the phrases for their texts, interning all of the flush's texts at once."""
+
+    new = [obj for obj in session.new if isinstance(obj, Translation) and obj.phrase_from_id is None]
+    if not new:
+        return
+
+    ids = Phrase.intern(session.connection(), [pair for t in new for pair in ((t.lang_from, t.text_from),
+                                                                               (t.lang_to, t.text_to))])
+    for t in new:
+        t.phrase_from_id = ids[(t.lang_from, t.text_from)]
+        t.phrase_to_id = ids[(t.lang_to, t.text_to)]
+
+
+@event.listens_for(Session, "before_flush")
+def bump_phrasebook_versions(session, flush_context, instances):
+    """Bump the version of every phrasebook whose name, visibility, translations
+    or notes change in this flush. Versions are used to build page ETags."""
+
+    touched = {obj for obj in session.dirty
+               if isinstance(obj, Phrasebook) and session.is_modified(obj)}
+
+    with session.no_autoflush:
+        for obj in session.new | session.dirty | session.deleted:
+            if isinstance(obj, PhrasebookTranslation) and obj.phrasebook_id:
+                pb = session.get(Phrasebook, obj.phrasebook_id)
+                if pb is not None:
+                    touched.add(pb)
+
+    for pb in touched - set(session.deleted):
+        pb.version = Phrasebook.version + 1
+
+
+@event.listens_for(Session, "before_flush")
+def count_phrasebook_translations(session, flush_context, instances):
+    """Keep Phrasebook.translation_count in step with the translations added and removed in this flush."""
+
+    deltas = {}
+
+    def adjust(pb, n):
+        if pb is not None and n:
+            deltas[pb] = deltas.get(pb, 0) + n
+
+    with session.no_autoflush:
+        for obj in session.new:
+            if isinstance(obj, PhrasebookTranslation):
+                adjust(session.get(Phrasebook, obj.phrasebook_id), 1)
+        for obj in session.deleted:
+            if isinstance(obj, PhrasebookTranslation):
+                adjust(session.get(Phrasebook, obj.phrasebook_id), -1)
+
+    # Translations appended to / removed from Phrasebook.translations directly.
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Phrasebook):
+            history = inspect(obj).attrs.translations.history
+            adjust(obj, len(history.added) - len(history.deleted))
+
+    for pb, n in deltas.items():
+        if pb in session.deleted:
+            continue
+        if inspect(pb).pending:
+            pb.translation_count = (pb.translation_count or 0) + n
+        else:
+            pb.translation_count = Phrasebook.translation_count + n
+
+
+@event.listens_for(Session, "before_flush")
+def collect_public_changes(session, flush_context, instances):
+    """Note what this flush may change about public phrasebooks: the translations added to or
+    removed from a phrasebook, every translation of a phrasebook made public, private or deleted,
+    and the phrasebooks whose translations change."""
+
+    translations, phrasebooks = session.info.setdefault("public_changes", (set(), set()))
+
+    with session.no_autoflush:
+        for obj in session.new | session.deleted:
+            if isinstance(obj, PhrasebookTranslation):
+                translations.add(obj.translation_id)
+                phrasebooks.add(obj.phrasebook_id)
+
+        for obj in session.new | session.dirty | session.deleted:
+            if not isinstance(obj, Phrasebook):
+                continue
+
+            history = inspect(obj).attrs.translations.history
+            if history.added or history.deleted:
+                translations.update(history.added, history.deleted)
+                phrasebooks.add(obj)
+
+            state = inspect(obj)
+            if state.persistent and (obj in session.deleted and obj.public
+                                     or state.attrs.public.history.has_changes()):
+                translations.update(t_id for (t_id,) in session.query(PhrasebookTranslation.translation_id)
+                                                               .filter_by(phrasebook_id=obj.id))
+
+
+@event.listens_for(Session, "after_flush")
+def update_public_aggregates(session, flush_context):
+    """Recount the public saves of the translations collect_public_changes noted, and queue
+    them and the rest of the changed public phrasebooks for new recommendations."""
+
+    translations, phrasebooks = session.info.pop("public_changes", (None, None))
+    if not translations:
+        return
+
+    # Objects appended through Phrasebook.translations were noted as such; they have ids now.
+    t_ids = {t.id if isinstance(t, Translation) else t for t in translations} - {None}
+    pb_ids = {pb.id if isinstance(pb, Phrasebook) else pb for pb in phrasebooks} - {None}
+
+    connection = session.connection()
+    TranslationPopularity.refresh(connection, t_ids)
+    TranslationNeighbors.mark_stale(connection, t_ids, pb_ids)
+    session.info["neighbors_queued"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def note_stale_neighbors(session):
+    """Once the stale marks are committed, let the app refresh a batch (see refresh_stale_recommendations)."""
+
+    if session.info.pop("neighbors_queued", False):
+        session.info["neighbors_stale"] = True
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_stale_neighbors(session):
+    session.info.pop("neighbors_queued", None)
+
+
+@event.listens_for(Session, "after_flush")
+def create_review_cards(session, flush_context):
+    """Give every phrasebook entry added in this flush a review card, in one statement."""
+
+    entries = {(obj.phrasebook_id, obj.translation_id) for obj in session.new
+               if isinstance(obj, PhrasebookTranslation)}
+
+    # Translations appended to Phrasebook.translations never become PhrasebookTranslation objects.
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Phrasebook):
+            entries.update((obj.id, t.id) for t in inspect(obj).attrs.translations.history.added)
+
+    if not entries:
+        return
+
+    cards = ReviewCard.__table__
+    pb_translations = PhrasebookTranslation.__table__
+    phrasebooks = Phrasebook.__table__
+    new_cards = (select(pb_translations.c.phrasebook_id, pb_translations.c.translation_id, phrasebooks.c.user_id)
+                 .select_from(pb_translations.join(phrasebooks))
+                 .where(tuple_(pb_translations.c.phrasebook_id, pb_translations.c.translation_id).in_(entries)))
+
+    session.connection().execute(
+        insert(cards).from_select(["phrasebook_id", "translation_id", "user_id"], new_cards)
+        .on_conflict_do_nothing())
+
+
+@event.listens_for(Session, "after_flush")
+def record_changes(session, flush_context):
+    """Append a change log entry for every phrasebook, translation association and note changed in this flush."""
+
+    deleted_users = {obj.id for obj in session.deleted if isinstance(obj, User)}
+    deleted_pbs = {obj.id for obj in session.deleted if isinstance(obj, Phrasebook)}
+    changes = []
+
+    def log(user_id, entity, pb_id, t_id, op):
+        if user_id not in deleted_users:
+            changes.append(dict(user_id=user_id, entity=entity, phrasebook_id=pb_id,
+                                translation_id=t_id, op=op))
+
+    def log_entry(pb_id, t_id, op):
+        if pb_id in deleted_pbs:
+            return
+        pb = session.get(Phrasebook, pb_id)
+        if pb is not None:
+            log(pb.user_id, "translation", pb_id, t_id, op)
+
+    for obj in session.new:
+        if isinstance(obj, Phrasebook):
+            log(obj.user_id, "phrasebook", obj.id, None, "insert")
+        elif isinstance(obj, PhrasebookTranslation):
+            log_entry(obj.phrasebook_id, obj.translation_id, "insert")
+
+    for obj in session.dirty:
+        if isinstance(obj, Phrasebook) and session.is_modified(obj, include_collections=False):
+            log(obj.user_id, "phrasebook", obj.id, None, "update")
+        elif isinstance(obj, PhrasebookTranslation) and session.is_modified(obj):
+            log_entry(obj.phrasebook_id, obj.translation_id, "update")
+
+    for obj in session.deleted:
+        if isinstance(obj, Phrasebook):
+            log(obj.user_id, "phrasebook", obj.id, None, "delete")
+        elif isinstance(obj, PhrasebookTranslation):
+            log_entry(obj.phrasebook_id, obj.translation_id, "delete")
+
+    # Translations appended to / removed from Phrasebook.translations never become
+    # PhrasebookTranslation objects, so read them from the collection history.
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Phrasebook):
+            history = inspect(obj).attrs.translations.history
+            for t in history.added:
+                log(obj.user_id, "translation", obj.id, t.id, "insert")
+            for t in history.deleted:
+                log(obj.user_id, "translation", obj.id, t.id, "delete")
+
+    connection = session.connection()
+    if deleted_users:
+        connection.execute(ChangeLog.__table__.delete()
+                           .where(ChangeLog.user_id.in_(deleted_users)))
+    if changes:
+        # Sync cursors are change log ids, so a user's entries must commit in id order. Holding a
+        # per-user lock until commit keeps a second writer from taking a higher id in the meantime.
+        for user_id in sorted({change["user_id"] for change in changes}):
+            connection.execute(select(db.func.pg_advisory_xact_lock(CHANGE_LOG_LOCK, user_id)))
+        connection.execute(ChangeLog.__table__.insert(), changes)
+
+
 def connect_db(app):
     """Connect this database to provided Flask app."""
 
@@ -0,0 +1,108 @@
+"""Spaced repetition practice over a user's saved translations.
+
+Every phrasebook entry has a review card (models.ReviewCard) with an interval, ease and
+due time, scheduled with a simplified SM-2: a correct answer multiplies the interval by
+the card's ease, "hard" and "easy" nudge the ease down or up, and "again" sends the card
+back to be relearned in RELEARN_DELAY.
+
+A practice session reads the next due cards from the (user_id, due_at) index, however
+many cards the user has, and posts the answers back in batches. record_reviews applies a
+batch with one select and one executemany update."""
+
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import bindparam, select, tuple_
+
+from models import db, ReviewCard, Translation, phrase_text
+
+GRADES = ("again", "hard", "good", "easy")
+
+MIN_EASE = 1.3
+RELEARN_DELAY = timedelta(minutes=10)
+
+cards = ReviewCard.__table__
+translations = Translation.__table__
+
+
+def schedule(state, grade):
+    """Given a card's (interval, ease, reps, lapses), return them after answering with grade."""
+
+    interval, ease, reps, lapses = state
+
+    if grade == "again":
+        return 0.0, max(MIN_EASE, ease - 0.2), 0, lapses + 1
+
+    if reps == 0:
+        good = 1.0
+    elif reps == 1:
+        good = 6.0
+    else:
+        good = max(interval, 1.0) * ease
+
+    if grade == "hard":
+        return max(1.0, interval * 1.2), max(MIN_EASE, ease - 0.15), reps + 1, lapses
+    if grade == "good":
+        return good, ease, reps + 1, lapses
+
+    return good * 1.3, ease + 0.15, reps + 1, lapses
+
+
+def next_due(now, interval):
+    return now + (RELEARN_DELAY if interval == 0 else timedelta(days=interval))
+
+
+def due_cards(user_id, limit, phrasebook_id=None, now=None):
+    """The user's cards due by now (default: the database's now()), soonest first, with their texts."""
+
+    query = (select(cards.c.phrasebook_id, cards.c.translation_id, cards.c.due_at,
+                    translations.c.lang_from, translations.c.lang_to,
+                    phrase_text(translations.c.phrase_from_id).label("text_from"),
+                    phrase_text(translations.c.phrase_to_id).label("text_to"))
+             .select_from(cards.join(translations, translations.c.id == cards.c.translation_id))
+             .where(cards.c.user_id == user_id, cards.c.due_at <= (now or db.func.now()))
+             .order_by(cards.c.due_at)
+             .limit(limit))
+
+    if phrasebook_id is not None:
+        query = query.where(cards.c.phrasebook_id == phrasebook_id)
+
+    rows = [dict(row) for row in db.session.execute(query).mappings()]
+    for row in rows:
+        row["due_at"] = row["due_at"].isoformat()
+
+    return rows
+
+
+def record_reviews(user_id, reviews, now=None):
+    """Apply a batch of (phrasebook_id, translation_id, grade) answers to the user's cards.
+    Answers to the same card build on each other in order. Cards the user doesn't have are
+    skipped. Returns the keys of the cards that were updated; the caller commits."""
+
+    now = now or datetime.now(timezone.utc)
+    keys = {(pb_id, t_id) for pb_id, t_id, _ in reviews}
+    if not keys:
+        return []
+
+    found = db.session.execute(
+        select(cards.c.phrasebook_id, cards.c.translation_id,
+               cards.c.interval, cards.c.ease, cards.c.reps, cards.c.lapses)
+        .where(cards.c.user_id == user_id,
+               tuple_(cards.c.phrasebook_id, cards.c.translation_id).in_(keys)))
+    state = {(pb_id, t_id): tuple(rest) for pb_id, t_id, *rest in found}
+
+    changed = {}
+    for pb_id, t_id, grade in reviews:
+        if (pb_id, t_id) in state:
+            state[(pb_id, t_id)] = changed[(pb_id, t_id)] = schedule(state[(pb_id, t_id)], grade)
+
+    if changed:
+        db.session.execute(
+            cards.update()
+            .where(cards.c.phrasebook_id == bindparam("pb_id"), cards.c.translation_id == bindparam("t_id"))
+            .values(interval=bindparam("new_interval"), ease=bindparam("new_ease"),
+                    reps=bindparam("new_reps"), lapses=bindparam("new_lapses"), due_at=bindparam("new_due_at")),
+            [{"pb_id": pb_id, "t_id": t_id, "new_interval": interval, "new_ease": ease,
+              "new_reps": reps, "new_lapses": lapses, "new_due_at": next_due(now, interval)}
+             for (pb_id, t_id), (interval, ease, reps, lapses) in changed.items()])
+
+    return list(changed)
@@ -0,0 +1,196 @@
+"""On-demand request profiling for Translation Buddy.
+
+A request is profiled when it carries ?_profile=<expiry and signature of its path> (see
+profile_signature and `flask profile-url`), or at random with probability
+PROFILE_SAMPLE_RATE. While it runs, a sampler thread records the request thread's
+stack every PROFILE_INTERVAL seconds. The counts are stored with the route and timing
+in the request_profiles table, so any worker can serve them; only the newest PROFILE_KEEP
+are kept. They can be downloaded from /admin/profiles/<id> as collapsed stacks for
+flamegraph.pl or speedscope.
+
+Requests that aren't profiled only pay for a query string lookup (and a random() call
+if sampling is on). For POST /translate under asgi.py each synchronous step around the
+DeepL call is profiled separately; the awaited call itself isn't sampled."""
+
+import hashlib
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from flask import Blueprint, abort, current_app, g, jsonify, request
+from sqlalchemy import delete, insert, select
+
+import metrics
+from metrics import admin_authorized
+from models import db, RequestProfile
+
+PROFILE_PARAM = "_profile"
+
+CAPTURED = metrics.counter("request_profiles_total", "Requests profiled.", ["reason"])
+
+profiles = Blueprint("profiles", __name__)
+
+request_profiles = RequestProfile.__table__
+
+LISTED_COLUMNS = [c for c in request_profiles.c if c.name != "stacks"]
+
+
+def profile_signature(path, token, expires):
+    """The ?_profile= value that turns on profiling for path until the Unix time expires.
+    Signed with the admin token so the token itself never appears in URLs or access logs,
+    and a URL that leaks through the logs stops working once it expires."""
+
+    message = f"{int(expires)}:{path}".encode()
+
+    return f"{int(expires)}.{hmac.new(token.encode(), message, hashlib.sha256).hexdigest()[:32]}"
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse(frame):
+    """A stack as one collapsed-stack line, outermost frame first."""
+
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame).replace(";", ":"))
+        frame = frame.f_back
+
+    return ";".join(reversed(names))
+
+
+class Sampler(threading.Thread):
+    """Counts the stacks of another thread, sampled every `interval` seconds until stopped."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        return self.stacks
+
+
+def profile_reason():
+    """Why this request should be profiled, or None if it shouldn't."""
+
+    sent = request.args.get(PROFILE_PARAM)
+    if sent:
+        token = current_app.config.get("ADMIN_TOKEN")
+        expires = sent.partition(".")[0]
+        if (token and expires.isdigit() and int(expires) >= time.time()
+                and hmac.compare_digest(sent.encode(), profile_signature(request.path, token, expires).encode())):
+            return "requested"
+
+    rate = current_app.config["PROFILE_SAMPLE_RATE"]
+    if rate and random.random() < rate:
+        return "sampled"
+
+    return None
+
+
+def start_profile():
+    reason = profile_reason()
+    if reason is None:
+        return
+
+    sampler = Sampler(threading.get_ident(), current_app.config["PROFILE_INTERVAL"])
+    g.profile = (reason, datetime.now(timezone.utc), time.perf_counter(), sampler)
+    sampler.start()
+
+
+def record_status(response):
+    if "profile" in g:
+        g.profile_status = response.status_code
+    return response
+
+
+def finish_profile(exc):
+    profile = g.pop("profile", None)
+    if profile is None:
+        return
+
+    reason, started_at, started, sampler = profile
+    stacks = sampler.stop()
+    CAPTURED.inc(reason=reason)
+
+    row = {
+        "reason": reason,
+        "endpoint": request.endpoint,
+        "method": request.method,
+        "path": request.path,
+        "status": g.pop("profile_status", 500),
+        "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+        "samples": sum(stacks.values()),
+        "started_at": started_at,
+        "stacks": "".join(f"{stack} {count}\n" for stack, count in stacks.most_common()),
+    }
+
+    # On a connection of its own: the request's session may be mid-transaction or failed.
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(insert(request_profiles), row)
+            oldest_kept = (select(request_profiles.c.id)
+                           .order_by(request_profiles.c.id.desc())
+                           .offset(current_app.config["PROFILE_KEEP"] - 1)
+                           .limit(1)
+                           .scalar_subquery())
+            conn.execute(delete(request_profiles).where(request_profiles.c.id < oldest_kept))
+    except Exception:
+        current_app.logger.exception("Storing a request profile failed")
+
+
+@profiles.route("/admin/profiles")
+def list_profiles():
+    """List the stored profiles, newest first. Requires the admin token."""
+
+    if not admin_authorized():
+        abort(404)
+
+    rows = db.session.execute(select(*LISTED_COLUMNS).order_by(request_profiles.c.id.desc())).mappings()
+
+    return jsonify(data=[dict(row, started_at=row["started_at"].isoformat()) for row in rows])
+
+
+@profiles.route("/admin/profiles/<int:profile_id>")
+def download_profile(profile_id):
+    """Download a profile as collapsed stacks ("frame;frame;frame count" lines)."""
+
+    if not admin_authorized():
+        abort(404)
+
+    body = db.session.execute(select(request_profiles.c.stacks)
+                              .where(request_profiles.c.id == profile_id)).scalar()
+    if body is None:
+        abort(404)
+
+    resp = current_app.response_class(body, mimetype="text/plain")
+    resp.headers["Content-Disposition"] = f"attachment; filename=profile-{profile_id}.folded"
+
+    return resp
+
+
+def init_profiling(app):
+    """Register the profiling hooks. Call before other before_request hooks so they are profiled too."""
+
+    app.before_request(start_profile)
+    app.after_request(record_status)
+    app.teardown_request(finish_profile)
+    app.register_blueprint(profiles)
@@ -0,0 +1,83 @@
+"""Checks that the hot queries are planned with the indexes they rely on."""
+
+import json
+
+from sqlalchemy import text
+
+# (description, query, table, index the planner should use for it)
+EXPECTED_PLANS = [
+    ("user phrasebooks / version vector",
+     "SELECT id, version FROM phrasebooks WHERE user_id = 1",
+     "phrasebooks", "ix_phrasebooks_user_id"),
+    ("user phrasebooks filtered by language",
+     "SELECT id FROM phrasebooks WHERE user_id = 1 AND lang_to = 'ES'",
+     "phrasebooks", "ix_phrasebooks_user_id_lang_to"),
+    ("user phrasebooks sorted by name",
+     "SELECT id FROM phrasebooks WHERE user_id = 1 ORDER BY lower(name)",
+     "phrasebooks", "ix_phrasebooks_user_id_lower_name"),
+    ("public phrasebooks by language pair",
+     "SELECT id FROM phrasebooks WHERE public AND lang_from = 'EN' AND lang_to = 'ES'",
+     "phrasebooks", "ix_phrasebooks_public_langs"),
+    ("orphan check",
+     "SELECT 1 FROM phrasebook_translation WHERE translation_id = 1",
+     "phrasebook_translation", "ix_phrasebook_translation_translation_id"),
+    ("phrase lookup by hash",
+     "SELECT id FROM phrases WHERE hash = md5('hello')::uuid AND text = 'hello'",
+     "phrases", "uq_phrases_hash_lang"),
+    ("existing translation lookup",
+     "SELECT id FROM translations WHERE phrase_from_id = 1 AND lang_to = 'ES'",
+     "translations", "ix_translations_phrase_from_id"),
+    ("popular translations by language pair",
+     "SELECT translation_id FROM translation_popularity WHERE lang_from = 'EN' AND lang_to = 'ES' "
+     "ORDER BY saves DESC, translation_id LIMIT 20",
+     "translation_popularity", "ix_translation_popularity_langs_saves"),
+    ("due review cards",
+     "SELECT translation_id FROM review_cards WHERE user_id = 1 AND due_at <= now() ORDER BY due_at LIMIT 50",
+     "review_cards", "ix_review_cards_user_id_due_at"),
+    ("sync changes since cursor",
+     "SELECT id FROM change_log WHERE user_id = 1 AND id > 0 ORDER BY id",
+     "change_log", "ix_change_log_user_id_id"),
+]
+
+
+def plan_nodes(node):
+    """Yield every node of an EXPLAIN (FORMAT JSON) plan tree."""
+
+    yield node
+    for child in node.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def explain(conn, query):
+    """Return the plan for query with sequential scans discouraged.
+
+    Test and development tables are tiny, and on them the planner prefers sequential
+    scans. Turning seqscan off shows whether a usable index exists at all."""
+
+    conn.execute(text("SET LOCAL enable_seqscan = off"))
+    result = conn.execute(text(f"EXPLAIN (FORMAT JSON) {query}")).scalar()
+    if isinstance(result, str):
+        result = json.loads(result)
+
+    return result[0]["Plan"]
+
+
+def check_query_plans(engine, expected=EXPECTED_PLANS):
+    """Explain each expected query and return a list of (description, problem) for those
+    not using their index. An empty list means every plan matches."""
+
+    problems = []
+
+    for description, query, table, index in expected:
+        with engine.begin() as conn:
+            nodes = list(plan_nodes(explain(conn, query)))
+
+        used = {n["Index Name"] for n in nodes if "Index Name" in n}
+        seq_scans = [n for n in nodes if n["Node Type"] == "Seq Scan" and n.get("Relation Name") == table]
+
+        if index not in used:
+            problems.append((description, f"expected {index}, plan used {sorted(used) or 'no index'}"))
+        elif seq_scans:
+            problems.append((description, f"sequential scan on {table}"))
+
+    return problems
@@ -0,0 +1,228 @@
+"""Token-bucket rate limiting of the routes that call DeepL.
+
+RATE_LIMITS maps an endpoint to its limits, each a (scope, count, seconds) tuple:
+up to `count` requests in a burst, refilled at count/seconds per second. The scope
+picks whose bucket a request draws from: "user" (the logged in user; anonymous
+requests only draw from their IP's bucket), "ip" (the client address) or "global"
+(everyone). A request must get a token from every bucket, otherwise it gets a 429
+with a Retry-After header and the tokens it took from the other buckets are put back.
+
+The "ip" scope keys on the client address. Behind a proxy such as the Heroku router that
+is only right when the server trusts the proxy's X-Forwarded-For header, which the
+Procfile does with gunicorn's --forwarded-allow-ips; otherwise every client shares the
+proxy's bucket.
+
+Buckets live in this process (RATE_LIMIT_STORE=memory, the default), so with several
+workers each enforces the limits on its own share of the traffic. RATE_LIMIT_STORE=database
+keeps them in the rate_limit_buckets table instead, so the limits hold across workers
+and dynos. If the database can't be reached, requests are let through.
+
+Limits can be set in the environment as, for example,
+
+    RATE_LIMITS="views.translate=user:30/60,ip:60/60,global:600/60;api.import_phrasebook_translations=user:5/3600"
+"""
+
+import math
+import threading
+import time
+
+from flask import current_app, g, jsonify, request
+from sqlalchemy import text
+
+import metrics
+from models import db
+
+SCOPES = ("user", "ip", "global")
+
+DEFAULT_LIMITS = {
+    "views.translate": [("user", 30, 60), ("ip", 60, 60), ("global", 600, 60)],
+    "api.add_phrasebook_translations": [("user", 30, 60), ("ip", 60, 60)],
+    "api.import_phrasebook_translations": [("user", 5, 3600), ("ip", 10, 3600)],
+}
+
+# Buckets that have refilled are dropped from the in-process store once it holds this many.
+MAX_MEMORY_BUCKETS = 100000
+
+RATE_LIMITED = metrics.counter("rate_limited_total", "Requests refused by a rate limit.", ["endpoint", "scope"])
+RATE_LIMIT_ERRORS = metrics.counter("rate_limit_store_errors_total", "Rate limit checks let through because the store failed.")
+
+TAKE_SQL = text("""
+    INSERT INTO rate_limit_buckets AS b (key, tokens, updated_at)
+    VALUES (:key, :burst - 1, now())
+    ON CONFLICT (key) DO UPDATE SET
+        tokens = CASE WHEN LEAST(:burst, b.tokens + EXTRACT(EPOCH FROM now() - b.updated_at) * :rate) >= 1
+                      THEN LEAST(:burst, b.tokens + EXTRACT(EPOCH FROM now() - b.updated_at) * :rate) - 1
+                      ELSE b.tokens END,
+        updated_at = CASE WHEN LEAST(:burst, b.tokens + EXTRACT(EPOCH FROM now() - b.updated_at) * :rate) >= 1
+                          THEN now()
+                          ELSE b.updated_at END
+    RETURNING updated_at = now(), tokens, EXTRACT(EPOCH FROM now() - updated_at)""")
+
+PUT_BACK_SQL = text("UPDATE rate_limit_buckets SET tokens = LEAST(:burst, tokens + 1) WHERE key = :key")
+
+
+def parse_limits(spec):
+    """Parse RATE_LIMITS from the environment format shown above. None gives the defaults."""
+
+    if spec is None:
+        return DEFAULT_LIMITS
+
+    limits = {}
+    for route in filter(None, (part.strip() for part in spec.split(";"))):
+        endpoint, _, rules = route.partition("=")
+        limits[endpoint.strip()] = []
+        for rule in filter(None, (r.strip() for r in rules.split(","))):
+            scope, _, rate = rule.partition(":")
+            count, _, seconds = rate.partition("/")
+            if scope not in SCOPES:
+                raise ValueError(f"Unknown rate limit scope {scope!r} for {endpoint}")
+            limits[endpoint.strip()].append((scope, int(count), float(seconds)))
+
+    return limits
+
+
+def retry_after(tokens, rate):
+    """Seconds until a bucket holding `tokens` has a whole token again."""
+
+    return max(1, math.ceil((1 - tokens) / rate))
+
+
+class MemoryStore:
+    """Token buckets kept in this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def take(self, key, burst, rate):
+        """Take a token from the bucket. Returns (allowed, seconds until one is available)."""
+
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated_at, full_at = self.buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            self.buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            if len(self.buckets) > MAX_MEMORY_BUCKETS:
+                self.prune(now)
+
+        return (True, 0) if allowed else (False, retry_after(tokens, rate))
+
+    def put_back(self, key, burst):
+        """Return a token taken from the bucket."""
+
+        with self.lock:
+            if key in self.buckets:
+                tokens, updated_at, full_at = self.buckets[key]
+                self.buckets[key] = (min(burst, tokens + 1), updated_at, full_at)
+
+    def prune(self, now):
+        """Drop buckets that have refilled; a missing bucket counts as full."""
+
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket[2] > now}
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class DatabaseStore:
+    """Token buckets in the rate_limit_buckets table, shared by every worker.
+    Each take is a single upsert, so concurrent requests can't both spend the last token."""
+
+    def take(self, key, burst, rate):
+        with db.engine.begin() as conn:
+            allowed, tokens, elapsed = conn.execute(TAKE_SQL, {"key": key, "burst": burst, "rate": rate}).one()
+
+        if allowed:
+            return True, 0
+        return False, retry_after(min(burst, tokens + float(elapsed) * rate), rate)
+
+    def put_back(self, key, burst):
+        with db.engine.begin() as conn:
+            conn.execute(PUT_BACK_SQL, {"key": key, "burst": burst})
+
+    def clear(self):
+        with db.engine.begin() as conn:
+            conn.execute(text("DELETE FROM rate_limit_buckets"))
+
+
+memory_store = MemoryStore()
+
+STORES = {"memory": memory_store, "database": DatabaseStore()}
+
+
+def bucket_key(endpoint, scope):
+    """The bucket this request draws from for one limit, or None if the scope doesn't apply."""
+
+    if scope == "user":
+        user = g.get("user")
+        return f"{endpoint}:user:{user.id}" if user else None
+    if scope == "ip":
+        return f"{endpoint}:ip:{request.remote_addr}"
+
+    return f"{endpoint}:global"
+
+
+def check_rate_limits():
+    """Refuse the request with a 429 if any of its endpoint's buckets is empty.
+    A refused request doesn't count against the buckets it did get a token from."""
+
+    limits = current_app.config["RATE_LIMITS"].get(request.endpoint)
+    if not limits or not current_app.config.get("RATE_LIMIT_ENABLED", True):
+        return None
+
+    store = STORES[current_app.config["RATE_LIMIT_STORE"]]
+    taken = []
+    try:
+        for scope, count, seconds in limits:
+            key = bucket_key(request.endpoint, scope)
+            if key is None:
+                continue
+
+            allowed, wait = store.take(key, count, count / seconds)
+            if not allowed:
+                RATE_LIMITED.inc(endpoint=request.endpoint, scope=scope)
+                for key, count in taken:
+                    store.put_back(key, count)
+                return too_many_requests(wait)
+
+            taken.append((key, count))
+    except Exception:
+        current_app.logger.exception("Rate limit check failed")
+        RATE_LIMIT_ERRORS.inc()
+
+    return None
+
+
+def too_many_requests(wait):
+    message = f"Too many requests. Try again in {wait} seconds."
+    if request.blueprint == "api":
+        response = jsonify({"error": message})
+    else:
+        response = current_app.response_class(message, mimetype="text/plain")
+
+    response.status_code = 429
+    response.headers["Retry-After"] = str(wait)
+    return response
+
+
+def prune_buckets(seconds):
+    """Delete shared buckets untouched for `seconds`. Returns how many were deleted."""
+
+    with db.engine.begin() as conn:
+        return conn.execute(text("DELETE FROM rate_limit_buckets WHERE updated_at < now() - make_interval(secs => :seconds)"),
+                            {"seconds": seconds}).rowcount
+
+
+def init_rate_limits(app):
+    """Check rate limits before each request. Call after the blueprints are registered,
+    so the user is loaded into g first."""
+
+    if app.config["RATE_LIMIT_STORE"] not in STORES:
+        raise ValueError(f"RATE_LIMIT_STORE must be one of {', '.join(STORES)}")
+
+    app.before_request(check_rate_limits)
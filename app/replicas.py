@@ -0,0 +1,183 @@
+"""Routing of read-only queries to PostgreSQL read replicas.
+
+Replicas are listed in DATABASE_REPLICA_URLS (comma separated) and registered as
+Flask-SQLAlchemy binds. Queries made while handling a GET to a view marked with
+@read_only go to a healthy replica, the same one for the whole request, so its reads
+(a sync cursor and the rows after it, an ETag and the page) see one point in time. Everything else goes to the primary:
+flushes, DML, CLI commands, other routes, and any request from a user who wrote
+within the last DB_READ_YOUR_WRITES_SECONDS, so users always see their own changes.
+
+A replica whose replay lag exceeds DB_REPLICA_MAX_LAG seconds, or that can't be
+reached within DB_REPLICA_CONNECT_TIMEOUT seconds, is skipped until its next lag
+check. Only one thread checks a replica at a time; the others use the last result."""
+
+import random
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+
+import metrics
+
+WRITTEN_AT_KEY = "db_written_at"
+LAG_CHECK_INTERVAL = 5
+
+REPLICA_READS = metrics.counter("db_replica_reads_total", "Read-only requests routed to a read replica.", ["replica"])
+REPLICA_FALLBACKS = metrics.counter("db_replica_fallbacks_total", "Read-only requests sent to the primary instead.", ["reason"])
+
+REPLICA_LAG_SQL = text("""
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END""")
+
+
+def read_only(view):
+    """Mark a view as safe to serve from a read replica. Apply below @app.route."""
+
+    view.read_only = True
+    return view
+
+
+def replica_binds(urls, connect_timeout=2):
+    """Return the SQLALCHEMY_BINDS entries for a comma separated list of replica URLs.
+    Each URL gets a libpq connect_timeout unless it sets its own."""
+
+    binds = {}
+    for i, url in enumerate(url.strip() for url in (urls or "").split(",") if url.strip()):
+        url = make_url(url)
+        if connect_timeout and "connect_timeout" not in url.query:
+            url = url.update_query_dict({"connect_timeout": str(int(connect_timeout))})
+        binds[f"replica_{i}"] = url.render_as_string(hide_password=False)
+
+    return binds
+
+
+class ReplicaHealth:
+    """Caches each replica's replication lag for a few seconds.
+    While one thread checks a replica, the others get the cached lag (infinite before the first check)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked = {}
+        self.checking = set()
+
+    def lag(self, key, engine):
+        now = time.monotonic()
+        with self.lock:
+            lag, checked_at = self.checked.get(key, (float("inf"), 0))
+            if now - checked_at < LAG_CHECK_INTERVAL or key in self.checking:
+                return lag
+            self.checking.add(key)
+
+        try:
+            with engine.connect() as conn:
+                lag = float(conn.execute(REPLICA_LAG_SQL).scalar())
+        except Exception:
+            lag = float("inf")
+        finally:
+            with self.lock:
+                self.checking.discard(key)
+                self.checked[key] = (lag, time.monotonic())
+
+        return lag
+
+
+health = ReplicaHealth()
+
+
+def replica_keys(app):
+    return [key for key in app.config.get("SQLALCHEMY_BINDS") or {} if key.startswith("replica_")]
+
+
+def wants_replica():
+    """Whether statements issued for the current request may be served by a replica."""
+
+    if not has_request_context() or request.method not in ("GET", "HEAD"):
+        return False
+    if "use_replica" in g:
+        return g.use_replica
+
+    view = current_app.view_functions.get(request.endpoint)
+    allowed = getattr(view, "read_only", False)
+
+    window = current_app.config.get("DB_READ_YOUR_WRITES_SECONDS", 10)
+    if allowed and time.time() - session.get(WRITTEN_AT_KEY, 0) < window:
+        REPLICA_FALLBACKS.inc(reason="recent_write")
+        allowed = False
+
+    g.use_replica = allowed
+    return allowed
+
+
+def choose_replica(app, db):
+    """Return the engine of a random replica within the lag limit, or None."""
+
+    max_lag = app.config.get("DB_REPLICA_MAX_LAG", 5)
+    keys = replica_keys(app)
+    random.shuffle(keys)
+
+    for key in keys:
+        engine = db.get_engine(app, bind=key)
+        if health.lag(key, engine) <= max_lag:
+            REPLICA_READS.inc(replica=key)
+            return engine
+
+    REPLICA_FALLBACKS.inc(reason="lagging" if keys else "no_replicas")
+    return None
+
+
+def request_replica(app, db):
+    """The replica engine this request reads from (None for the primary), chosen on its first read."""
+
+    if "db_replica" not in g:
+        g.db_replica = choose_replica(app, db)
+    return g.db_replica
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends reads from read-only views to a replica."""
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if (not self._flushing
+                and not getattr(clause, "is_dml", False)
+                and not (has_request_context() and g.get("db_wrote"))
+                and replica_keys(self.app)
+                and wants_replica()):
+            engine = request_replica(self.app, self.db)
+            if engine is not None:
+                return engine
+
+        return super().get_bind(mapper, clause)
+
+
+def mark_write(session, flush_context):
+    """after_flush: pin the rest of this request, and the user's next requests, to the primary."""
+
+    if has_request_context():
+        g.db_wrote = True
+
+
+def remember_write(response):
+    """after_request: start the read-your-writes window in the user's session."""
+
+    if g.get("db_wrote"):
+        session[WRITTEN_AT_KEY] = time.time()
+    return response
+
+
+def init_replicas(app):
+    """Register replica binds from DATABASE_REPLICA_URLS and the read-your-writes hooks."""
+
+    binds = app.config.setdefault("SQLALCHEMY_BINDS", {}) or {}
+    binds.update(replica_binds(app.config.get("DATABASE_REPLICA_URLS"),
+                               app.config.get("DB_REPLICA_CONNECT_TIMEOUT", 2)))
+    app.config["SQLALCHEMY_BINDS"] = binds
+
+    if not event.contains(Session, "after_flush", mark_write):
+        event.listen(Session, "after_flush", mark_write)
+    app.after_request(remember_write)
@@ -2,11 +2,15 @@
 
 from models import User, Translation, Phrasebook, PhrasebookTranslation
 from app import db
+import migrations
 
 # Create all tables
 db.drop_all()
 db.create_all()
 
+# Tables match the current models, so no migration needs to run on them
+migrations.stamp(db.engine)
+
 # If table isn't empty, empty it
 User.query.delete()
 
@@ -0,0 +1,297 @@
+"""Slow query log for Translation Buddy.
+
+Statements that take longer than SLOW_QUERY_MS (default 200, 0 turns the log off) are
+recorded with the shape of their parameters, the route that ran them and the line of app
+code they came from, grouped by a fingerprint of the statement with its literals and
+parameters taken out. The first slow run of a fingerprint, and then at most one every
+SLOW_QUERY_EXPLAIN_EVERY seconds, is explained on the same connection with
+EXPLAIN (GENERIC_PLAN) (PostgreSQL 16 and later; older servers record no plan). That plans
+the statement with its parameters left as $1, $2, ... instead of running it again, so the
+plan holds no user data and the request doesn't pay for the query twice.
+
+N+1 patterns are made of statements that are each fast, so they are caught by count
+instead: a statement run SLOW_QUERY_REPEAT times (default 20) or more within one request
+is recorded as repeated, with the route and how many times it ran.
+
+Like the metrics, each worker keeps its own log. /admin/slow-queries lists it ranked by
+total time spent. The settings are read from app.config, see load_config in app.py."""
+
+import hashlib
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+from collections import Counter
+
+from flask import Blueprint, abort, current_app, g, has_app_context, has_request_context, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import metrics
+from metrics import admin_authorized
+
+# Fingerprints kept per worker; the ones with the least total time make room for new ones.
+MAX_FINGERPRINTS = 500
+
+SLOW_QUERIES = metrics.counter("db_slow_queries_total", "Statements slower than SLOW_QUERY_MS.")
+REPEATED_QUERIES = metrics.counter("db_repeated_queries_total",
+                                   "Requests that ran a statement SLOW_QUERY_REPEAT times or more.")
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+logger = logging.getLogger(__name__)
+
+slow_queries = Blueprint("slow_queries", __name__)
+
+# Literals and placeholders become ?, and IN (?, ?, ...) lists of any length become IN (...).
+NORMALIZE = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"%\(\w+\)s|%s|\$\d+"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(...)"),
+    (re.compile(r"\s+"), " "),
+]
+
+# psycopg2's placeholders, and the %% that stands for a literal % when there are parameters.
+PLACEHOLDERS = re.compile(r"%%|%\((\w+)\)s|%s")
+
+
+def normalize(statement):
+    for pattern, replacement in NORMALIZE:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+def fingerprint(statement):
+    """Return (id, normalized statement). Runs of the same query with different values share an id."""
+
+    normalized = normalize(statement)
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12], normalized
+
+
+def params_shape(parameters, executemany=False):
+    """Describe parameters by type only, so no user data ends up in the log."""
+
+    if executemany:
+        rows = list(parameters)
+        return f"{len(rows)} x {params_shape(rows[0]) if rows else '{}'}"
+
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{k}: {type(v).__name__}" for k, v in sorted(parameters.items())) + "}"
+
+    return "(" + ", ".join(type(v).__name__ for v in parameters or ()) + ")"
+
+
+def call_site():
+    """The innermost frame of app code (outside this module) that led to the statement."""
+
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(APP_DIR) and filename != __file__:
+            return f"{os.path.relpath(filename, APP_DIR)}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+
+    return None
+
+
+def numbered_placeholders(statement, parameters):
+    """Rewrite psycopg2's placeholders as $1, $2, ... (a name used twice keeps its number),
+    so the statement can be planned without its parameter values."""
+
+    if parameters is None:
+        return statement
+
+    numbers = {}
+
+    def number(match):
+        if match.group(0) == "%%":
+            return "%"
+        key = match.group(1) or len(numbers)
+        return f"${numbers.setdefault(key, len(numbers) + 1)}"
+
+    return PLACEHOLDERS.sub(number, statement)
+
+
+def explain(cursor, statement, parameters):
+    """EXPLAIN (GENERIC_PLAN) a statement on the connection it ran on, inside a savepoint
+    so a failure can't abort the caller's transaction. Returns the plan text, or None."""
+
+    connection = cursor.connection
+    if connection.autocommit:
+        return None
+
+    explain_cursor = connection.cursor()
+    try:
+        explain_cursor.execute("SAVEPOINT slow_query_explain")
+        try:
+            explain_cursor.execute(f"EXPLAIN (GENERIC_PLAN) {numbered_placeholders(statement, parameters)}")
+            plan = "\n".join(row[0] for row in explain_cursor.fetchall())
+        except Exception:
+            explain_cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            plan = None
+        explain_cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+        return plan
+    except Exception:
+        logger.exception("Could not explain slow query")
+        return None
+    finally:
+        explain_cursor.close()
+
+
+class SlowQueryLog:
+    """Slow statements of this worker, aggregated by fingerprint."""
+
+    def __init__(self, max_fingerprints=MAX_FINGERPRINTS):
+        self.max_fingerprints = max_fingerprints
+        self.entries = {}
+        self.repeats = {}
+        self.lock = threading.Lock()
+
+    def wants_explain(self, fp, now, every):
+        """Claim the next explain for a fingerprint, if one is due `every` seconds after the last."""
+
+        with self.lock:
+            entry = self.entries.get(fp)
+            if entry is not None and now - entry["explained_at"] < every:
+                return False
+            if entry is not None:
+                entry["explained_at"] = now
+            return True
+
+    def record(self, fp, statement, duration_ms, shape, route, site, plan, now):
+        with self.lock:
+            entry = self.entries.get(fp)
+            if entry is None:
+                if len(self.entries) >= self.max_fingerprints:
+                    del self.entries[min(self.entries, key=lambda k: self.entries[k]["total_ms"])]
+                entry = self.entries[fp] = {
+                    "fingerprint": fp, "statement": statement, "count": 0, "total_ms": 0.0, "max_ms": 0.0,
+                    "params": shape, "routes": {}, "call_sites": {}, "plan": None, "explained_at": now,
+                }
+
+            entry["count"] += 1
+            entry["total_ms"] += duration_ms
+            entry["max_ms"] = max(entry["max_ms"], duration_ms)
+            entry["routes"][route] = entry["routes"].get(route, 0) + 1
+            entry["call_sites"][site] = entry["call_sites"].get(site, 0) + 1
+            if plan is not None:
+                entry["plan"] = plan
+
+    def record_repeat(self, fp, statement, times, route):
+        with self.lock:
+            entry = self.repeats.get(fp)
+            if entry is None:
+                if len(self.repeats) >= self.max_fingerprints:
+                    del self.repeats[min(self.repeats, key=lambda k: self.repeats[k]["requests"])]
+                entry = self.repeats[fp] = {"fingerprint": fp, "statement": statement, "requests": 0,
+                                            "max_per_request": 0, "routes": {}}
+
+            entry["requests"] += 1
+            entry["max_per_request"] = max(entry["max_per_request"], times)
+            entry["routes"][route] = entry["routes"].get(route, 0) + 1
+
+    def report(self):
+        """Slow entries ranked by total time and repeated ones by how many requests repeated them."""
+
+        with self.lock:
+            slow = [dict(e, routes=dict(e["routes"]), call_sites=dict(e["call_sites"]))
+                    for e in self.entries.values()]
+            repeated = [dict(e, routes=dict(e["routes"])) for e in self.repeats.values()]
+
+        for entry in slow:
+            del entry["explained_at"]
+            entry["total_ms"] = round(entry["total_ms"], 1)
+            entry["mean_ms"] = round(entry["total_ms"] / entry["count"], 1)
+
+        return {"slow": sorted(slow, key=lambda e: e["total_ms"], reverse=True),
+                "repeated": sorted(repeated, key=lambda e: e["requests"], reverse=True)}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.repeats.clear()
+
+
+slow_query_log = SlowQueryLog()
+
+
+def start_timer(conn, cursor, statement, parameters, context, executemany):
+    context.slow_query_started = time.perf_counter()
+
+
+def current_route():
+    if not has_request_context():
+        return "-"
+    return request.endpoint or request.path
+
+
+def check_duration(conn, cursor, statement, parameters, context, executemany):
+    duration_ms = (time.perf_counter() - context.slow_query_started) * 1000
+
+    # Counting the raw text is enough: the statements of an N+1 loop are identical.
+    if has_request_context():
+        g.setdefault("statement_counts", Counter())[statement] += 1
+
+    if not has_app_context():
+        return
+
+    config = current_app.config
+    if not config["SLOW_QUERY_MS"] or duration_ms < config["SLOW_QUERY_MS"]:
+        return
+
+    SLOW_QUERIES.inc()
+    fp, normalized = fingerprint(statement)
+    shape = params_shape(parameters, executemany)
+    route = current_route()
+    site = call_site() or "-"
+
+    now = time.monotonic()
+    plan = None
+    if not executemany and slow_query_log.wants_explain(fp, now, config["SLOW_QUERY_EXPLAIN_EVERY"]):
+        plan = explain(cursor, statement, parameters)
+
+    slow_query_log.record(fp, normalized, duration_ms, shape, route, site, plan, now)
+    logger.warning("Slow query %s took %.1f ms (route %s, %s): %s", fp, duration_ms, route, site, normalized)
+
+
+def check_repeats(exc):
+    """At the end of a request, record the statements it ran SLOW_QUERY_REPEAT times or more."""
+
+    counts = g.pop("statement_counts", None)
+    if not counts:
+        return
+
+    for statement, times in counts.items():
+        if times >= current_app.config["SLOW_QUERY_REPEAT"]:
+            REPEATED_QUERIES.inc()
+            fp, normalized = fingerprint(statement)
+            slow_query_log.record_repeat(fp, normalized, times, current_route())
+            logger.warning("Query %s ran %d times in one request (route %s): %s",
+                           fp, times, current_route(), normalized)
+
+
+def init_slow_queries(app):
+    """Time every statement on every engine and serve the report. The statement hooks
+    aren't installed when SLOW_QUERY_MS is 0."""
+
+    if app.config["SLOW_QUERY_MS"] and not event.contains(Engine, "before_cursor_execute", start_timer):
+        event.listen(Engine, "before_cursor_execute", start_timer)
+        event.listen(Engine, "after_cursor_execute", check_duration)
+
+    app.teardown_request(check_repeats)
+    app.register_blueprint(slow_queries)
+
+
+@slow_queries.route("/admin/slow-queries")
+def show_slow_queries():
+    """This worker's slow and repeated statements by fingerprint. Requires the admin token."""
+
+    if not admin_authorized():
+        abort(404)
+
+    return jsonify(threshold_ms=current_app.config["SLOW_QUERY_MS"],
+                   repeat_threshold=current_app.config["SLOW_QUERY_REPEAT"], **slow_query_log.report())
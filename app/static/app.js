@@ -6,12 +6,16 @@ $(".dropdown").on("click", ".dropdown-menu", function (e) {
 
 
 // Stop bubbling for dropdown menu forms
-$(".dropdown-menu").click(function (e) {
-	e.stopPropagation();
-	if ($(e.target).is('[data-toggle=modal]')) {
-        $($(e.target).data('target')).modal()
-    }
-});
+function keepMenusOpen(scope) {
+	$(scope).find(".dropdown-menu").click(function (e) {
+		e.stopPropagation();
+		if ($(e.target).is('[data-toggle=modal]')) {
+			$($(e.target).data('target')).modal()
+		}
+	});
+}
+
+keepMenusOpen(document);
 
 
 ///////////////////////////////////////////////
@@ -31,9 +35,215 @@ $("#accordion").bind("shown.bs.collapse hidden.bs.collapse", function () {
 	Cookies.set("activeAccordionGroup", active);
 });
 
+// Load a phrasebook's suggestions the first time it is opened
+$("#accordion").on("shown.bs.collapse", function (e) {
+	let suggestions = $(e.target).find(".suggestions").not(".loaded");
+	if (!suggestions.length) {
+		return;
+	}
+	suggestions.addClass("loaded");
+
+	fetch(suggestions.data("url"), {
+		headers: {"X-Requested-With": "XMLHttpRequest"},
+		credentials: "same-origin",
+	})
+		.then(function (resp) {
+			return resp.ok && !resp.redirected ? resp.text() : "";
+		})
+		.then(function (html) {
+			suggestions.html(html);
+		});
+});
+
 //Delete accordion position cookie when navigating away from page
 let currentPath = window.location.pathname
 if (currentPath !== "/user") {
     Cookies.remove("activeAccordionGroup");
 }
 
+
+///////////////////////////////////////////////
+//** In-place updates */
+
+// Post a form in the background. The server answers with a fragment or JSON delta for
+// just the part of the page that changed; if anything goes wrong the form is submitted
+// the normal way and the full page comes back as before.
+function submitInPlace(selector, update) {
+	$(document).on("submit", selector, function (e) {
+		e.preventDefault();
+		let form = this;
+
+		fetch(form.action, {
+			method: "POST",
+			body: new FormData(form),
+			headers: {"X-Requested-With": "XMLHttpRequest"},
+			credentials: "same-origin",
+		})
+			.then(function (resp) {
+				if (!resp.ok || resp.redirected) {
+					throw new Error(resp.status);
+				}
+				return resp;
+			})
+			.then(function (resp) {
+				return update(form, resp);
+			}, function () {
+				form.submit();
+			});
+	});
+}
+
+function replaceWith(target, html) {
+	let replacement = $(html);
+	$(target).replaceWith(replacement);
+	keepMenusOpen(replacement);
+}
+
+submitInPlace(".edit-note-form", function (form, resp) {
+	return resp.text().then(function (html) {
+		let cell = $(form).closest("td");
+		cell.html(html);
+		keepMenusOpen(cell);
+	});
+});
+
+submitInPlace(".delete-translation-form", function (form, resp) {
+	return resp.json().then(function (data) {
+		$(form).closest("tr").remove();
+		$("#pb-header-" + data.phrasebook_id + " .translation-count").text(data.translation_count);
+	});
+});
+
+submitInPlace(".edit-phrasebook-form", function (form, resp) {
+	return resp.text().then(function (html) {
+		replaceWith($(form).closest("[id^=pb-header-]"), html);
+	});
+});
+
+submitInPlace(".add-translation-form", function (form, resp) {
+	return resp.text().then(function (html) {
+		$(form).closest(".dropdown").find("[data-toggle=dropdown]").dropdown("hide");
+		$("#main").prepend(html);
+	});
+});
+
+submitInPlace(".add-suggestion-form", function (form, resp) {
+	return resp.text().then(function (html) {
+		$(form).closest("tr").remove();
+		$("#main").prepend(html);
+	});
+});
+
+
+///////////////////////////////////////////////
+//** Practice */
+
+// Due cards are fetched a page at a time, soonest first. Answers are sent back in
+// batches, and whatever is left over when the page is closed is sent with a beacon.
+const PRACTICE_PAGE = 50;
+const PRACTICE_BATCH = 20;
+
+let practice = $("#practice");
+
+if (practice.length) {
+	let cards = [];
+	let answers = [];
+	let current = null;
+	// Settles once every answer batch sent so far has been saved (or failed).
+	let pending = Promise.resolve();
+
+	function sendAnswers(beacon) {
+		if (!answers.length) {
+			return pending;
+		}
+		let body = JSON.stringify({reviews: answers});
+		answers = [];
+
+		if (beacon) {
+			navigator.sendBeacon(practice.data("reviews-url"), new Blob([body], {type: "application/json"}));
+			return pending;
+		}
+		let request = fetch(practice.data("reviews-url"), {
+			method: "POST",
+			body: body,
+			headers: {"Content-Type": "application/json"},
+			credentials: "same-origin",
+		}).catch(function () {});
+		pending = Promise.all([pending, request]);
+		return pending;
+	}
+
+	function loadCards() {
+		let params = new URLSearchParams({limit: PRACTICE_PAGE});
+		let phrasebook = $("#practice-phrasebook").val();
+		if (phrasebook) {
+			params.set("phrasebook_id", phrasebook);
+		}
+
+		// Answers go first, and batches already on their way are waited for, so the cards
+		// just answered aren't due in the next page.
+		return sendAnswers(false)
+			.then(function () {
+				return fetch(practice.data("due-url") + "?" + params, {credentials: "same-origin"});
+			})
+			.then(function (resp) {
+				return resp.json();
+			})
+			.then(function (body) {
+				cards = body.data || [];
+			});
+	}
+
+	function showCard() {
+		current = cards.shift();
+		practice.find(".practice-to, .practice-grades").addClass("d-none");
+
+		if (!current) {
+			practice.find(".practice-from").text("");
+			practice.find(".practice-show").addClass("d-none");
+			practice.find(".practice-empty").removeClass("d-none");
+			return;
+		}
+
+		practice.find(".practice-empty").addClass("d-none");
+		practice.find(".practice-show").removeClass("d-none");
+		practice.find(".practice-from").text(current.text_from);
+		practice.find(".practice-to").text(current.text_to);
+	}
+
+	function nextCard() {
+		if (cards.length) {
+			showCard();
+		} else {
+			loadCards().then(showCard);
+		}
+	}
+
+	practice.on("click", ".practice-show", function () {
+		$(this).addClass("d-none");
+		practice.find(".practice-to, .practice-grades").removeClass("d-none");
+	});
+
+	practice.on("click", "[data-grade]", function () {
+		answers.push({
+			phrasebook_id: current.phrasebook_id,
+			translation_id: current.translation_id,
+			grade: $(this).data("grade"),
+		});
+		if (answers.length >= PRACTICE_BATCH) {
+			sendAnswers(false);
+		}
+		nextCard();
+	});
+
+	$("#practice-phrasebook").on("change", function () {
+		cards = [];
+		nextCard();
+	});
+
+	window.addEventListener("pagehide", function () {
+		sendAnswers(true);
+	});
+
+	nextCard();
+}
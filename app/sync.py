@@ -0,0 +1,166 @@
+"""Delta sync of a user's phrasebooks from the change log."""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import aliased
+
+from models import db, User, ChangeLog, Phrasebook, PhrasebookTranslation, Translation, phrase_text
+
+MAX_CHANGES = 1000
+
+phrasebooks = Phrasebook.__table__
+pb_translations = PhrasebookTranslation.__table__
+translations = Translation.__table__
+change_log = ChangeLog.__table__
+
+PHRASEBOOK_COLUMNS = [phrasebooks.c.id, phrasebooks.c.name, phrasebooks.c.public,
+                      phrasebooks.c.lang_from, phrasebooks.c.lang_to, phrasebooks.c.version]
+
+ENTRY_COLUMNS = [pb_translations.c.phrasebook_id, translations.c.id, translations.c.lang_from,
+                 translations.c.lang_to, phrase_text(translations.c.phrase_from_id).label("text_from"),
+                 phrase_text(translations.c.phrase_to_id).label("text_to"), pb_translations.c.note]
+
+
+def latest_change_id(user):
+    """Return the id of the user's newest committed change log entry.
+    Writers hold a per-user lock until commit, so no lower id of the user's can still appear."""
+
+    return db.session.execute(select(func.coalesce(func.max(change_log.c.id), 0))
+                              .where(change_log.c.user_id == user.id)).scalar()
+
+
+def fetch_phrasebooks(*criteria):
+    query = select(*PHRASEBOOK_COLUMNS).where(*criteria).order_by(phrasebooks.c.id)
+    return [dict(row) for row in db.session.execute(query).mappings()]
+
+
+def fetch_entries(*criteria):
+    query = (select(*ENTRY_COLUMNS)
+             .select_from(pb_translations.join(translations).join(phrasebooks))
+             .where(*criteria)
+             .order_by(pb_translations.c.phrasebook_id, translations.c.id))
+    return [dict(row) for row in db.session.execute(query).mappings()]
+
+
+def snapshot(user):
+    """Return the user's complete phrasebook state, for clients without a usable cursor."""
+
+    # Read the cursor first so changes committed while the snapshot is built are sent again next sync.
+    cursor = latest_change_id(user)
+
+    return {
+        "cursor": cursor,
+        "reset": True,
+        "more": False,
+        "phrasebooks": {"upserts": fetch_phrasebooks(phrasebooks.c.user_id == user.id), "deletes": []},
+        "translations": {"upserts": fetch_entries(phrasebooks.c.user_id == user.id), "deletes": []},
+    }
+
+
+def merge_ops(rows):
+    """Collapse the change log rows for each entity into one net operation.
+    Entities inserted and deleted since the cursor were never seen by the client and are dropped."""
+
+    first = {}
+    last = {}
+    for row in rows:
+        key = (row.entity, row.phrasebook_id, row.translation_id)
+        first.setdefault(key, row.op)
+        last[key] = row.op
+
+    merged = {}
+    for key, op in last.items():
+        if op == "delete":
+            if first[key] != "insert":
+                merged[key] = "delete"
+        else:
+            merged[key] = "insert" if first[key] == "insert" else "update"
+
+    return merged
+
+
+def changes_since(user, since, limit=MAX_CHANGES):
+    """Return what changed in the user's phrasebooks after change log id `since`.
+
+    Returns a full snapshot when there is no cursor or when it is older than the user's
+    compacted history. At most `limit` log entries are read per call; `more` tells the
+    client to call again with the returned cursor."""
+
+    if since is None or since < user.sync_floor:
+        return snapshot(user)
+
+    rows = db.session.execute(
+        select(change_log)
+        .where(change_log.c.user_id == user.id, change_log.c.id > since)
+        .order_by(change_log.c.id)
+        .limit(limit + 1)).all()
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    merged = merge_ops(rows)
+
+    pb_ops = {pb_id: op for (entity, pb_id, _), op in merged.items() if entity == "phrasebook"}
+    entry_ops = {(pb_id, t_id): op for (entity, pb_id, t_id), op in merged.items() if entity == "translation"}
+
+    upsert_pbs = [pb_id for pb_id, op in pb_ops.items() if op != "delete"]
+    upsert_entries = [key for key, op in entry_ops.items() if op != "delete"]
+
+    pb_rows = []
+    if upsert_pbs:
+        pb_rows = fetch_phrasebooks(phrasebooks.c.id.in_(upsert_pbs), phrasebooks.c.user_id == user.id)
+        for row in pb_rows:
+            row["op"] = pb_ops[row["id"]]
+
+    entry_rows = []
+    if upsert_entries:
+        pair = db.tuple_(pb_translations.c.phrasebook_id, pb_translations.c.translation_id)
+        entry_rows = fetch_entries(pair.in_(upsert_entries), phrasebooks.c.user_id == user.id)
+        for row in entry_rows:
+            row["op"] = entry_ops[(row["phrasebook_id"], row["id"])]
+
+    return {
+        "cursor": rows[-1].id if rows else since,
+        "reset": False,
+        "more": more,
+        "phrasebooks": {"upserts": pb_rows,
+                        "deletes": sorted(pb_id for pb_id, op in pb_ops.items() if op == "delete")},
+        "translations": {"upserts": entry_rows,
+                         "deletes": sorted([pb_id, t_id] for (pb_id, t_id), op in entry_ops.items() if op == "delete")},
+    }
+
+
+def compact_change_log(older_than=timedelta(days=30)):
+    """Shrink the change log by removing entries older than `older_than` that no client needs.
+
+    Entries superseded by a newer entry for the same entity are dropped, and old tombstones
+    are dropped after raising their user's sync_floor, so clients with older cursors resync.
+    Returns the number of entries removed."""
+
+    horizon = datetime.utcnow() - older_than
+    newer = aliased(ChangeLog)
+
+    superseded = db.exists().where(newer.user_id == ChangeLog.user_id,
+                                   newer.entity == ChangeLog.entity,
+                                   newer.phrasebook_id == ChangeLog.phrasebook_id,
+                                   newer.translation_id.is_not_distinct_from(ChangeLog.translation_id),
+                                   newer.id > ChangeLog.id)
+
+    removed = (ChangeLog.query
+               .filter(ChangeLog.created_at < horizon, superseded)
+               .delete(synchronize_session=False))
+
+    old_tombstones = ChangeLog.query.filter(ChangeLog.created_at < horizon, ChangeLog.op == "delete")
+    floors = (db.session.query(ChangeLog.user_id, func.max(ChangeLog.id))
+              .filter(ChangeLog.created_at < horizon, ChangeLog.op == "delete")
+              .group_by(ChangeLog.user_id)
+              .all())
+
+    for user_id, floor in floors:
+        (User.query.filter_by(id=user_id)
+         .update({"sync_floor": func.greatest(User.sync_floor, floor)}, synchronize_session=False))
+
+    removed += old_tombstones.delete(synchronize_session=False)
+    db.session.commit()
+
+    return removed
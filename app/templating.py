@@ -0,0 +1,34 @@
+"""Template performance helpers for Translation Buddy"""
+
+import os
+
+from jinja2 import FileSystemBytecodeCache
+
+
+def init_templates(app, languages):
+    """Set up the Jinja environment for app and compile every template up front.
+
+    Compiled templates are written to a bytecode cache on disk, so workers started
+    after the first one load them instead of parsing the template sources again.
+    The language code -> name mapping is exposed to templates as `lang_names`."""
+
+    cache_dir = app.config.get("TEMPLATE_CACHE_DIR")
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    app.jinja_env.globals["lang_names"] = dict(languages)
+
+    precompile_templates(app)
+
+
+def precompile_templates(app):
+    """Load every html template into the environment's template cache."""
+
+    env = app.jinja_env
+    names = env.list_templates(extensions=["html"])
+
+    for name in names:
+        env.get_template(name)
+
+    return names
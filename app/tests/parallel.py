@@ -0,0 +1,123 @@
+"""Run the test modules in parallel processes, each against its own copy of the test database.
+
+    python -m tests.parallel [-j WORKERS] [tests.test_module ...]     (from app/)
+
+The schema is created once in the template database (TEST_DATABASE_URL, default
+postgresql:///translator-test). Every worker gets a clone made with
+CREATE DATABASE ... TEMPLATE, which copies files instead of replaying DDL, and runs
+its share of the modules one after another with TEST_DATABASE_URL pointing at it."""
+
+import argparse
+import os
+import pkgutil
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+
+DEFAULT_URL = "postgresql:///translator-test"
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(TESTS_DIR)
+
+
+def discover_modules():
+    return sorted(f"tests.{m.name}" for m in pkgutil.iter_modules([TESTS_DIR]) if m.name.startswith("test_"))
+
+
+def prepare_template(url):
+    """Create the current schema in the template database."""
+
+    from models import db
+
+    engine = create_engine(url)
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    engine.dispose()
+
+
+def clone_databases(url, workers):
+    """Create one clone of the template database per worker and return their URLs."""
+
+    template = make_url(url)
+    admin = create_engine(template.set(database="postgres"), isolation_level="AUTOCOMMIT")
+
+    urls = []
+    with admin.connect() as conn:
+        for i in range(workers):
+            name = f"{template.database}_{i}"
+            conn.execute(text(f'DROP DATABASE IF EXISTS "{name}"'))
+            conn.execute(text(f'CREATE DATABASE "{name}" TEMPLATE "{template.database}"'))
+            urls.append(str(template.set(database=name)))
+
+    admin.dispose()
+    return urls
+
+
+def drop_databases(url, urls):
+    admin = create_engine(make_url(url).set(database="postgres"), isolation_level="AUTOCOMMIT")
+    with admin.connect() as conn:
+        for clone in urls:
+            conn.execute(text(f'DROP DATABASE IF EXISTS "{make_url(clone).database}"'))
+    admin.dispose()
+
+
+def run_worker(db_url, modules, results):
+    env = dict(os.environ, TEST_DATABASE_URL=db_url, TEST_SCHEMA_READY="1")
+
+    while True:
+        try:
+            module = modules.get_nowait()
+        except queue.Empty:
+            return
+
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-m", "unittest", module], cwd=APP_DIR, env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        results.append((module, proc.returncode, time.perf_counter() - start, proc.stdout))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--keep", action="store_true", help="Keep the cloned databases afterwards.")
+    parser.add_argument("modules", nargs="*")
+    args = parser.parse_args(argv)
+
+    url = os.environ.get("TEST_DATABASE_URL", DEFAULT_URL)
+    names = args.modules or discover_modules()
+    workers = max(1, min(args.workers, len(names)))
+
+    prepare_template(url)
+    urls = clone_databases(url, workers)
+
+    modules = queue.Queue()
+    for name in names:
+        modules.put(name)
+
+    results = []
+    threads = [threading.Thread(target=run_worker, args=(db_url, modules, results)) for db_url in urls]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        if not args.keep:
+            drop_databases(url, urls)
+
+    failed = [r for r in results if r[1] != 0]
+    for module, code, seconds, output in sorted(results):
+        print(f"{'FAIL' if code else 'ok  '} {module} ({seconds:.1f}s)")
+    for module, code, seconds, output in failed:
+        print(f"\n===== {module} =====\n{output}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
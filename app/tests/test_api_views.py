@@ -0,0 +1,319 @@
+"""JSON API views tests"""
+
+# run these tests like:
+#
+#    python -m unittest tests.test_api_views     (from app/)
+
+import io
+import os
+import json
+from models import db, User, Phrasebook, Translation, PhrasebookTranslation
+
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "postgresql:///translator-test")
+
+
+from app import app, CURR_USER_KEY
+from tests.fixtures import DBTestCase
+
+app.config["WTF_CSRF_ENABLED"] = False
+app.config["TESTING"] = True
+app.config["DEBUG_TB_HOSTS"] = ["dont-show-debug-toolbar"]
+
+
+class APIViewsTestCase(DBTestCase):
+    """Testing JSON API view functions."""
+
+    def setUp(self):
+        """Create test client & mock data.
+        User1 has a public phrasebook with 2 translations. User2 has a private phrasebook
+        sharing the 2nd translation, with a note on it."""
+
+        super().setUp()
+
+        self.client = app.test_client()
+
+        u1 = User.signup("testuser", "password")
+        u1.id = 111
+        u2 = User.signup("testuser2", "password")
+        u2.id = 222
+        db.session.commit()
+        self.uid1 = 111
+        self.uid2 = 222
+
+        p1 = Phrasebook(id=111, name="phrasebook", user_id=self.uid1, public=True, lang_from="EN", lang_to="ES")
+        p2 = Phrasebook(id=222, name="french phrases", user_id=self.uid2, public=False, lang_from="EN", lang_to="FR")
+        t1 = Translation(id=111, lang_from="EN", lang_to="ES", text_from="What's going on, pumpkin?", text_to="¿Qué te pasa, calabaza?")
+        t2 = Translation(id=222, lang_from="EN", lang_to="FR", text_from="What a test!", text_to="Quel test!")
+        db.session.add_all([p1, p2, t1, t2])
+        db.session.commit()
+
+        p1.translations.append(t1)
+        p1.translations.append(t2)
+        p2.translations.append(t2)
+        db.session.commit()
+
+        PhrasebookTranslation.query.get((222, 222)).note = "testuser2's note"
+        db.session.commit()
+
+        self.pid1 = 111
+        self.pid2 = 222
+        self.tid1 = 111
+        self.tid2 = 222
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        super().tearDown()
+
+    def login(self, c, uid):
+        with c.session_transaction() as session:
+            session[CURR_USER_KEY] = uid
+
+    def test_login_required(self):
+        """API routes should answer 401 when not logged in."""
+        with self.client as c:
+            resp = c.get("/api/v1/phrasebooks")
+            self.assertEqual(resp.status_code, 401)
+            self.assertEqual(resp.get_json(), {"error": "Login required."})
+
+    def test_list_phrasebooks_sparse_fields(self):
+        """Should list only the user's phrasebooks and only the requested fields."""
+        with self.client as c:
+            self.login(c, self.uid2)
+
+            resp = c.get("/api/v1/phrasebooks?fields=name")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_json(), {"data": [{"id": self.pid2, "name": "french phrases"}],
+                                               "next_cursor": None})
+
+            resp = c.get("/api/v1/phrasebooks?public=1&fields=name,lang_to")
+            self.assertEqual(resp.get_json()["data"], [{"id": self.pid1, "name": "phrasebook", "lang_to": "ES"}])
+
+            resp = c.get("/api/v1/phrasebooks?fields=password")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_translations_cursor(self):
+        """Translations should be paged by cursor."""
+        with self.client as c:
+            self.login(c, self.uid1)
+
+            resp = c.get(f"/api/v1/phrasebooks/{self.pid1}/translations?limit=1&fields=text_to")
+            page = resp.get_json()
+            self.assertEqual(page["data"], [{"id": self.tid1, "text_to": "¿Qué te pasa, calabaza?"}])
+            self.assertIsNotNone(page["next_cursor"])
+
+            resp = c.get(f"/api/v1/phrasebooks/{self.pid1}/translations?limit=1&fields=text_to&cursor={page['next_cursor']}")
+            page = resp.get_json()
+            self.assertEqual(page["data"], [{"id": self.tid2, "text_to": "Quel test!"}])
+            self.assertIsNone(page["next_cursor"])
+
+    def test_show_phrasebook_embeds_notes(self):
+        """Embedded translations should include notes, but only on the user's own phrasebooks."""
+        with self.client as c:
+            self.login(c, self.uid2)
+
+            resp = c.get(f"/api/v1/phrasebooks/{self.pid2}?embed=translations")
+            data = resp.get_json()["data"]
+            self.assertEqual(data["name"], "french phrases")
+            self.assertEqual(data["translations"][0]["note"], "testuser2's note")
+
+            resp = c.get(f"/api/v1/phrasebooks/{self.pid1}?embed=translations")
+            data = resp.get_json()["data"]
+            self.assertEqual(len(data["translations"]), 2)
+            self.assertNotIn("note", data["translations"][0])
+
+            # user1's phrasebook is public but user2's is not
+            self.login(c, self.uid1)
+            resp = c.get(f"/api/v1/phrasebooks/{self.pid2}")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_bulk_add_and_delete(self):
+        """Should add existing and new translations in one request and delete them with orphan cleanup."""
+        with self.client as c:
+            self.login(c, self.uid2)
+
+            resp = c.post(f"/api/v1/phrasebooks/{self.pid2}/translations",
+                          json={"translations": [
+                              {"id": self.tid1, "note": "copied"},
+                              {"id": self.tid2},
+                              {"lang_from": "EN", "lang_to": "FR", "text_from": "cheese", "text_to": "fromage"}]})
+            self.assertEqual(resp.status_code, 201)
+            body = resp.get_json()
+            self.assertEqual(len(body["added"]), 2)
+            self.assertEqual(body["skipped"], [self.tid2])
+
+            new_id = body["added"][1]
+            self.assertEqual(Translation.query.get(new_id).text_to, "fromage")
+            self.assertEqual(PhrasebookTranslation.query.get((self.pid2, self.tid1)).note, "copied")
+
+            resp = c.delete(f"/api/v1/phrasebooks/{self.pid2}/translations",
+                            json={"ids": [self.tid1, new_id]})
+            self.assertEqual(sorted(resp.get_json()["deleted"]), sorted([self.tid1, new_id]))
+
+            # t1 is still in user1's phrasebook, the new translation is orphaned
+            self.assertIsNotNone(Translation.query.get(self.tid1))
+            self.assertIsNone(Translation.query.get(new_id))
+
+            # Other users' phrasebooks cannot be changed
+            resp = c.delete(f"/api/v1/phrasebooks/{self.pid1}/translations", json={"ids": [self.tid1]})
+            self.assertEqual(resp.status_code, 404)
+
+    def test_bulk_add_private_translation(self):
+        """Translations saved only in other users' private phrasebooks cannot be added by id."""
+        t3 = Translation(id=333, lang_from="EN", lang_to="FR", text_from="secret", text_to="secret")
+        db.session.add(t3)
+        Phrasebook.query.get(self.pid2).translations.append(t3)
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.uid1)
+
+            resp = c.post(f"/api/v1/phrasebooks/{self.pid1}/translations", json={"translations": [{"id": 333}]})
+            self.assertEqual(resp.status_code, 404)
+            self.assertIsNone(PhrasebookTranslation.query.get((self.pid1, 333)))
+
+            resp = c.post(f"/api/v1/phrasebooks/{self.pid1}/translations", json={"translations": [{"id": 999}]})
+            self.assertEqual(resp.status_code, 404)
+
+    def test_bulk_add_validation(self):
+        """Non-string notes should be a 400, and new translations differing only in lang_from should both be saved."""
+        with self.client as c:
+            self.login(c, self.uid2)
+
+            for note in ({"x": 1}, ["a"], 5):
+                resp = c.post(f"/api/v1/phrasebooks/{self.pid2}/translations",
+                              json={"translations": [{"id": self.tid1, "note": note}]})
+                self.assertEqual(resp.status_code, 400)
+                self.assertEqual(resp.get_json(), {"error": "Notes must be strings."})
+
+            resp = c.post(f"/api/v1/phrasebooks/{self.pid2}/translations",
+                          json={"translations": [
+                              {"lang_from": "EN", "lang_to": "FR", "text_from": "chat", "text_to": "chat"},
+                              {"lang_from": "DE", "lang_to": "FR", "text_from": "chat", "text_to": "chat"}]})
+            self.assertEqual(resp.status_code, 201)
+            added = resp.get_json()["added"]
+            self.assertEqual(sorted(Translation.query.get(t_id).lang_from for t_id in added), ["DE", "EN"])
+
+    def test_sync(self):
+        """Sync should send a snapshot without a cursor, then only what changed since the cursor."""
+        with self.client as c:
+            self.login(c, self.uid2)
+
+            resp = c.get("/api/v1/sync")
+            body = resp.get_json()
+            self.assertTrue(body["reset"])
+            self.assertEqual([p["id"] for p in body["phrasebooks"]["upserts"]], [self.pid2])
+            self.assertEqual(body["translations"]["upserts"][0]["note"], "testuser2's note")
+            cursor = body["cursor"]
+
+            # Nothing changed
+            body = c.get(f"/api/v1/sync?since={cursor}").get_json()
+            self.assertFalse(body["reset"])
+            self.assertEqual(body["phrasebooks"], {"upserts": [], "deletes": []})
+            self.assertEqual(body["translations"], {"upserts": [], "deletes": []})
+            self.assertEqual(body["cursor"], cursor)
+
+            # A note edit is sent as an update, a removal as a tombstone
+            c.post(f"/{self.pid2}/{self.tid2}/note", data={"note": "edited"})
+            body = c.get(f"/api/v1/sync?since={cursor}").get_json()
+            self.assertEqual(body["translations"]["upserts"][0]["note"], "edited")
+            self.assertEqual(body["translations"]["upserts"][0]["op"], "update")
+
+            c.delete(f"/api/v1/phrasebooks/{self.pid2}/translations", json={"ids": [self.tid2]})
+            body = c.get(f"/api/v1/sync?since={cursor}").get_json()
+            self.assertEqual(body["translations"]["upserts"], [])
+            self.assertEqual(body["translations"]["deletes"], [[self.pid2, self.tid2]])
+
+    def test_import(self):
+        """Should stream progress while importing CSV or JSON Lines, translating source-only rows and skipping duplicates."""
+        with self.client as c:
+            self.login(c, self.uid1)
+
+            csv_body = ("text_from,text_to,note\n"
+                        "cheese,queso,tasty\n"
+                        "What's going on, pumpkin?,\"¿Qué te pasa, calabaza?\",\n"
+                        ",orphan,\n"
+                        "hello world!,,\n")
+            resp = c.post(f"/api/v1/phrasebooks/{self.pid1}/import?format=csv", data=csv_body.encode(),
+                          content_type="text/csv")
+            self.assertEqual(resp.mimetype, "application/x-ndjson")
+            lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+            final = lines[-1]
+            self.assertTrue(final["done"])
+            self.assertEqual(final["rows"], 4)
+            self.assertEqual(final["invalid"], 1)
+            self.assertEqual(final["invalid_lines"], [4])
+            self.assertEqual(final["added"], 2)
+            self.assertEqual(final["translated"], 1)
+
+            pb = Phrasebook.query.get(self.pid1)
+            self.assertEqual(pb.translation_count, 4)
+            self.assertIn("¡Hola mundo!", [t.text_to for t in pb.translations])
+
+            # The same phrase again as JSON Lines is recognised as already in the phrasebook
+            resp = c.post(f"/api/v1/phrasebooks/{self.pid1}/import",
+                          data=b'{"text_from": "cheese", "text_to": "queso"}\nnot json\n',
+                          content_type="application/x-ndjson")
+            final = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()][-1]
+            self.assertEqual((final["added"], final["skipped"], final["invalid"]), (0, 1, 1))
+
+            resp = c.post(f"/api/v1/phrasebooks/{self.pid2}/import?format=csv", data=b"a,b\n",
+                          content_type="text/csv")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_import_rejects_cross_site_forms(self):
+        """Bodies a cross-site form can send, and form uploads without a CSRF token, shouldn't import anything."""
+        with self.client as c:
+            self.login(c, self.uid1)
+
+            resp = c.post(f"/api/v1/phrasebooks/{self.pid1}/import?format=csv", data=b"cheese,queso\n",
+                          content_type="text/plain")
+            self.assertEqual(resp.status_code, 415)
+
+            resp = c.post(f"/api/v1/phrasebooks/{self.pid1}/import?format=csv", data={"text_from": "cheese"})
+            self.assertEqual(resp.status_code, 415)
+
+            resp = c.post(f"/api/v1/phrasebooks/{self.pid1}/import",
+                          data={"file": (io.BytesIO(b"cheese,queso\n"), "phrases.csv")},
+                          content_type="multipart/form-data")
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("CSRF", resp.get_json()["error"])
+
+            self.assertEqual(Phrasebook.query.get(self.pid1).translation_count, 2)
+
+    def test_import_csv_edge_cases(self):
+        """Only newlines should end CSV rows, and malformed CSV should end the stream with an error line."""
+        with self.client as c:
+            self.login(c, self.uid1)
+
+            resp = c.post(f"/api/v1/phrasebooks/{self.pid1}/import?format=csv",
+                          data="line\u2028separator,queso\n".encode(), content_type="text/csv")
+            final = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()][-1]
+            self.assertEqual((final["rows"], final["added"]), (1, 1))
+
+            resp = c.post(f"/api/v1/phrasebooks/{self.pid1}/import?format=csv",
+                          data=b"cheese," + b"x" * 200000 + b"\n", content_type="text/csv")
+            final = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()][-1]
+            self.assertIn("error", final)
+
+    def test_popular_translations(self):
+        """Popular translations should count public saves per language pair, kept up to date as phrasebooks change."""
+        with self.client as c:
+            self.login(c, self.uid1)
+
+            resp = c.get("/api/v1/translations/popular?lang_from=en&lang_to=fr&fields=text_to,saves")
+            self.assertEqual(resp.get_json()["data"], [{"id": self.tid2, "text_to": "Quel test!", "saves": 1}])
+
+            # Making user2's phrasebook public counts its copy of t2 too
+            Phrasebook.query.get(self.pid2).public = True
+            db.session.commit()
+            resp = c.get("/api/v1/translations/popular?lang_from=EN&lang_to=FR&fields=saves")
+            self.assertEqual(resp.get_json()["data"], [{"id": self.tid2, "saves": 2}])
+
+            pb = Phrasebook.query.get(self.pid1)
+            pb.delete_translation(Translation.query.get(self.tid1))
+            db.session.commit()
+            resp = c.get("/api/v1/translations/popular?lang_from=EN&lang_to=ES")
+            self.assertEqual(resp.get_json()["data"], [])
+
+            resp = c.get("/api/v1/translations/popular?lang_from=EN")
+            self.assertEqual(resp.status_code, 400)
@@ -2,37 +2,34 @@
 
 # run these tests like:
 #
-#    python -m unittest test_user_model.py
+#    python -m unittest tests.test_app_functions     (from app/)
 
 import os
-from unittest import TestCase
 from sqlalchemy import exc
 from flask import session
 from models import db, User, Phrasebook, Translation, PhrasebookTranslation
 
-os.environ["DATABASE_URL"] = "postgresql:///translator-test"
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "postgresql:///translator-test")
 
 
-from app import app, CURR_USER_KEY, get_translation, do_login, do_logout
+from app import app, create_app, load_languages, CURR_USER_KEY, get_translation, do_login, do_logout
+from tests.fixtures import DBTestCase
+from templating import precompile_templates
+from translation import translation_cache, remember_result
 
 app.config['WTF_CSRF_ENABLED'] = False
 app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
 
-with app.app_context():
-    db.create_all()
-
-
-class FunctionsTestCase(TestCase):
+class FunctionsTestCase(DBTestCase):
     """Testing attributes of User model."""
 
     def setUp(self):
         """Create test client & mock data.
         2 users each with one phrasebook. User1 contains 2 translations. The first is only in user1's phrasebook, the 2nd is in both user1 and user2's phrasebooks"""
 
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
         # create user 1
         u1 = User.signup("testuser", "password")
@@ -155,7 +152,7 @@ class FunctionsTestCase(TestCase):
 
     def tearDown(self):
         """Clean up any fouled transaction."""
-        db.session.rollback()
+        super().tearDown()
         
     def test_get_translation(self):
         """Given text and languages, should return a valid translation object and translation into a target language"""
@@ -168,6 +165,29 @@ class FunctionsTestCase(TestCase):
         self.assertEqual(translation.lang_from, "EN")
         self.assertEqual(translation.lang_to, "ES")
         self.assertIsInstance(translation, Translation)
+
+    def test_get_translation_detects_language(self):
+        """An auto-detect request should resolve the source language before translating."""
+        translation = get_translation(text="Good morning, where can I buy a ticket?", source_lang="auto", target_lang="DE")
+
+        self.assertEqual(translation.lang_from, "EN")
+        self.assertEqual(translation.lang_to, "DE")
+
+    def test_get_translation_uses_cache(self):
+        """A cached DeepL result should be reused instead of asking DeepL, but never a saved translation."""
+        db.session.add(Translation(lang_from="EN", lang_to="FR", text_from="Good evening, see you tomorrow.", text_to="Bonsoir (saved)"))
+        db.session.commit()
+        translation_cache.clear()
+
+        translation = get_translation(text="Good evening, see you tomorrow.", source_lang="auto", target_lang="FR")
+        self.assertNotEqual(translation.text_to, "Bonsoir (saved)")
+
+        remember_result("Good evening, see you tomorrow.", "EN", "FR", "Bonsoir (cached)")
+        translation = get_translation(text="Good evening, see you tomorrow.", source_lang="auto", target_lang="FR")
+
+        self.assertEqual(translation.lang_from, "EN")
+        self.assertEqual(translation.text_to, "Bonsoir (cached)")
+        translation_cache.clear()
         
     def test_do_login(self):
         """Function should add user id to session."""
@@ -198,5 +218,24 @@ class FunctionsTestCase(TestCase):
                 self.assertEqual(self.uid1, session.get(CURR_USER_KEY))
                 do_logout()
                 self.assertIsNone(session.get(CURR_USER_KEY))
-                
-                
\ No newline at end of file
+
+
+    def test_precompile_templates(self):
+        """All templates should be compiled at startup and language names exposed to templates."""
+
+        names = precompile_templates(app)
+        self.assertIn("user/profile.html", names)
+        self.assertIn("forms/edit_note.html", names)
+        self.assertEqual(app.jinja_env.globals["lang_names"]["ES"], "Spanish")
+
+
+    def test_create_app(self):
+        """The factory should build an independent app sharing the language tables fetched once per process."""
+
+        other = create_app({"TESTING": True, "ADMIN_TOKEN": "other"})
+        self.assertIsNot(other, app)
+        self.assertIs(other.config["SOURCE_LANGUAGES"], app.config["SOURCE_LANGUAGES"])
+        self.assertEqual(load_languages.cache_info().misses, 1)
+        self.assertEqual(other.config["ADMIN_TOKEN"], "other")
+        self.assertIn("views.home", other.view_functions)
+        self.assertIn("db-upgrade", other.cli.commands)
@@ -0,0 +1,82 @@
+"""Static asset and response compression tests"""
+
+# run these tests like:
+#
+#    python -m unittest tests.test_assets     (from app/)
+
+import gzip
+import os
+import tempfile
+from unittest import TestCase
+
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "postgresql:///translator-test")
+
+
+from app import app
+from assets import build_assets
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+
+class AssetsTestCase(TestCase):
+    """Testing fingerprinted assets and HTML compression."""
+
+    def setUp(self):
+        self.min_size = app.config["COMPRESS_MIN_SIZE"]
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config["COMPRESS_MIN_SIZE"] = self.min_size
+
+    def test_build_assets(self):
+        """Built names should change with the content, and the gzip copy should match the original."""
+
+        with tempfile.TemporaryDirectory() as static_dir:
+            with open(os.path.join(static_dir, "site.css"), "w") as f:
+                f.write("body { color: red; }")
+            first = build_assets(static_dir, os.path.join(static_dir, "build"))["site.css"]
+
+            with open(os.path.join(static_dir, "site.css"), "w") as f:
+                f.write("body { color: blue; }")
+            manifest = build_assets(static_dir, os.path.join(static_dir, "build"))
+
+            self.assertEqual(list(manifest), ["site.css"])
+            self.assertNotEqual(manifest["site.css"], first)
+            self.assertRegex(first, r"^site\.[0-9a-f]{12}\.css$")
+            with open(os.path.join(static_dir, "build", manifest["site.css"] + ".gz"), "rb") as f:
+                self.assertEqual(gzip.decompress(f.read()), b"body { color: blue; }")
+
+    def test_serve_asset(self):
+        """Fingerprinted assets should be linked from pages and served precompressed with a long cache."""
+
+        name = app.config["ASSET_MANIFEST"]["style.css"]
+        html = self.client.get("/", headers={"Accept-Encoding": "identity"}).get_data(as_text=True)
+        self.assertIn(f"/assets/{name}", html)
+
+        resp = self.client.get(f"/assets/{name}", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(resp.mimetype, "text/css")
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+        self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+
+        with open(os.path.join(app.static_folder, "style.css"), "rb") as f:
+            self.assertEqual(gzip.decompress(resp.get_data()), f.read())
+
+        self.assertEqual(self.client.get("/assets/style.000000000000.css").status_code, 404)
+
+    def test_compress_html(self):
+        """HTML above the size threshold should be gzipped for clients that accept it."""
+
+        app.config["COMPRESS_MIN_SIZE"] = 0
+        resp = self.client.get("/", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn(b"<html", gzip.decompress(resp.get_data()))
+
+        resp = self.client.get("/", headers={"Accept-Encoding": "identity"})
+        self.assertNotIn("Content-Encoding", resp.headers)
+
+        app.config["COMPRESS_MIN_SIZE"] = 10 ** 9
+        resp = self.client.get("/", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", resp.headers)
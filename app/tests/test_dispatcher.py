@@ -0,0 +1,79 @@
+"""DeepL dispatcher tests"""
+
+# run these tests like:
+#
+#    python -m unittest tests.test_dispatcher     (from app/)
+
+import asyncio
+import threading
+import time
+from unittest import TestCase
+
+from dispatcher import Dispatcher, DeadlineExceeded, INTERACTIVE, BULK
+
+
+class DispatcherTestCase(TestCase):
+    """Testing slot priorities, fairness and deadlines."""
+
+    def run_in_order(self, dispatcher, requests):
+        """Queue (priority, user) requests behind a held slot and return the order they get slots in."""
+
+        order = []
+        threads = [threading.Thread(target=self.take, args=(dispatcher, priority, user, order))
+                   for priority, user in requests]
+
+        with dispatcher.slot(BULK):
+            for t in threads:
+                t.start()
+                time.sleep(0.02)
+        for t in threads:
+            t.join()
+
+        return order
+
+    def take(self, dispatcher, priority, user, order):
+        with dispatcher.slot(priority, user=user):
+            order.append((priority, user))
+
+    def test_interactive_first(self):
+        """Interactive requests should get slots before bulk requests queued earlier."""
+
+        order = self.run_in_order(Dispatcher(max_concurrency=1, interactive_reserve=0),
+                                  [(BULK, 1), (BULK, 1), (INTERACTIVE, 2)])
+
+        self.assertEqual(order[0], (INTERACTIVE, 2))
+
+    def test_fair_across_users(self):
+        """A user with many queued requests should take turns with another user's."""
+
+        order = self.run_in_order(Dispatcher(max_concurrency=1, interactive_reserve=0),
+                                  [(BULK, 1), (BULK, 1), (BULK, 1), (BULK, 2)])
+
+        self.assertEqual([user for priority, user in order], [1, 2, 1, 1])
+
+    def test_interactive_reserve(self):
+        """Bulk work should not be able to take the slots reserved for interactive requests."""
+
+        dispatcher = Dispatcher(max_concurrency=2, interactive_reserve=1)
+
+        with dispatcher.slot(BULK):
+            self.assertRaises(DeadlineExceeded, dispatcher.slot(BULK, deadline=time.monotonic() + 0.05).__enter__)
+            with dispatcher.slot(INTERACTIVE, deadline=time.monotonic() + 0.05):
+                pass
+
+    def test_deadline(self):
+        """Requests that can't start before their deadline should be dropped, sync or async."""
+
+        dispatcher = Dispatcher(max_concurrency=1, interactive_reserve=0)
+
+        async def wait_async():
+            async with dispatcher.aslot(INTERACTIVE, deadline=time.monotonic() + 0.05):
+                pass
+
+        with dispatcher.slot(INTERACTIVE):
+            self.assertRaises(DeadlineExceeded, dispatcher.slot(INTERACTIVE, deadline=time.monotonic() + 0.05).__enter__)
+            self.assertRaises(DeadlineExceeded, asyncio.run, wait_async())
+
+        with dispatcher.slot(INTERACTIVE, deadline=time.monotonic() + 0.05):
+            self.assertEqual(dispatcher.running[INTERACTIVE], 1)
+        self.assertEqual(dispatcher.running[INTERACTIVE], 0)
@@ -2,30 +2,26 @@
 
 # run these tests like:
 #
-#    python -m unittest test_user_model.py
+#    python -m unittest tests.test_home_views     (from app/)
 
 import os
-from unittest import TestCase
 from sqlalchemy import exc
 from flask import session
 from models import db, User, Phrasebook, Translation, PhrasebookTranslation
 from bs4 import BeautifulSoup
 
-os.environ["DATABASE_URL"] = "postgresql:///translator-test"
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "postgresql:///translator-test")
 
 
 from app import app, CURR_USER_KEY
+from tests.fixtures import DBTestCase
 
 app.config['WTF_CSRF_ENABLED'] = False
 app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
 
-with app.app_context():
-    db.create_all()
-
-
-class ViewsTestCase(TestCase):
+class ViewsTestCase(DBTestCase):
     """Testing app view functions."""
 
     def setUp(self):
@@ -33,8 +29,7 @@ class ViewsTestCase(TestCase):
         2 users each with one phrasebook. User1 contains 2 translations. The first is only in user1's phrasebook, the 2nd is in both user1 and user2's phrasebooks"""
 
 
-        db.drop_all()
-        db.create_all()
+        super().setUp()
         
         self.client = app.test_client()
 
@@ -52,7 +47,7 @@ class ViewsTestCase(TestCase):
 
     def tearDown(self):
         """Clean up any fouled transaction."""
-        db.session.rollback()
+        super().tearDown()
 
 
 ##################################################
@@ -0,0 +1,37 @@
+"""Local language detection tests"""
+
+# run these tests like:
+#
+#    python -m unittest tests.test_language_detection     (from app/)
+
+from unittest import TestCase
+
+from language_detection import detect_language
+
+
+class LanguageDetectionTestCase(TestCase):
+    """Testing the offline language identifier."""
+
+    def test_detect_language(self):
+        """Sentences should be identified by their character n-grams."""
+
+        self.assertEqual(detect_language("Good morning, where can I buy a ticket?"), "EN")
+        self.assertEqual(detect_language("Guten Morgen, wo kann ich eine Fahrkarte kaufen?"), "DE")
+        self.assertEqual(detect_language("Buenos días, ¿dónde puedo comprar un billete?"), "ES")
+        self.assertEqual(detect_language("Доброго ранку, де я можу купити квиток?"), "UK")
+        self.assertEqual(detect_language("Šiandien graži diena ir noriu eiti į paplūdimį"), "LT")
+
+    def test_detect_language_by_script(self):
+        """Languages with a script of their own should be identified by it."""
+
+        self.assertEqual(detect_language("こんにちは"), "JA")
+        self.assertEqual(detect_language("안녕하세요"), "KO")
+        self.assertEqual(detect_language("Καλημέρα"), "EL")
+
+    def test_detect_language_unsure(self):
+        """Short or out-of-candidate texts should be left to DeepL."""
+
+        self.assertIsNone(detect_language("hola"))
+        self.assertIsNone(detect_language("12345 !!"))
+        self.assertIsNone(detect_language("Доброе утро, где я могу купить билет?", ["EN", "DE"]))
+        self.assertIsNone(detect_language("こんにちは", ["EN", "DE"]))
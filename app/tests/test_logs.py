@@ -0,0 +1,78 @@
+"""Structured logging tests"""
+
+# run these tests like:
+#
+#    python -m unittest tests.test_logs     (from app/)
+
+import json
+import logging
+import os
+from unittest import TestCase
+
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "postgresql:///translator-test")
+
+
+from app import app
+from logs import JsonFormatter, SampleFilter, parse_sample_rates, request_id_var
+
+
+def make_record(name="x", level=logging.DEBUG, request_id=None, **extra):
+    record = logging.LogRecord(name, level, __file__, 1, "hello %s", ("world",), None)
+    record.request_id = request_id
+    record.__dict__.update(extra)
+    return record
+
+
+class LogFormatTestCase(TestCase):
+    """Testing the JSON lines and debug sampling."""
+
+    def test_json_formatter(self):
+        """A record should become one JSON object with its request id and extra fields."""
+
+        line = JsonFormatter().format(make_record(level=logging.INFO, request_id="abc", duration_ms=1.5))
+        self.assertNotIn("\n", line)
+
+        entry = json.loads(line)
+        self.assertEqual((entry["level"], entry["logger"], entry["message"]), ("INFO", "x", "hello world"))
+        self.assertEqual((entry["request_id"], entry["duration_ms"]), ("abc", 1.5))
+        self.assertNotIn("args", entry)
+
+    def test_sampling(self):
+        """Debug records should be sampled per request and logger; INFO and above never."""
+
+        sampler = SampleFilter(1.0, parse_sample_rates("sql=0, deepl=0.5"))
+
+        self.assertFalse(sampler.filter(make_record("sql", request_id="a")))
+        self.assertTrue(sampler.filter(make_record("sql", logging.WARNING, request_id="a")))
+        self.assertTrue(sampler.filter(make_record("slow_queries", request_id="a")))
+
+        # The same request is either kept or dropped for all of its records
+        kept = [sampler.filter(make_record("deepl.calls", request_id=str(i))) for i in range(200)]
+        self.assertEqual(kept, [sampler.filter(make_record("deepl", request_id=str(i))) for i in range(200)])
+        self.assertTrue(50 < sum(kept) < 150)
+
+        with self.assertRaises(ValueError):
+            parse_sample_rates("sql=2")
+
+
+class RequestIdTestCase(TestCase):
+    """Testing the request id header."""
+
+    def setUp(self):
+        app.config["ADMIN_TOKEN"] = "test-admin-token"
+        self.client = app.test_client()
+
+    def test_request_id(self):
+        """A usable incoming id should be echoed back, anything else replaced."""
+
+        headers = {"X-Admin-Token": "test-admin-token"}
+
+        resp = self.client.get("/metrics", headers=dict(headers, **{"X-Request-ID": "lb-1234"}))
+        self.assertEqual(resp.headers["X-Request-ID"], "lb-1234")
+
+        resp = self.client.get("/metrics", headers=dict(headers, **{"X-Request-ID": "not ok"}))
+        self.assertRegex(resp.headers["X-Request-ID"], r"^[0-9a-f]{32}$")
+
+        resp = self.client.get("/metrics", headers=headers)
+        self.assertRegex(resp.headers["X-Request-ID"], r"^[0-9a-f]{32}$")
+        self.assertIsNone(request_id_var.get())
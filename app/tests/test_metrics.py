@@ -0,0 +1,63 @@
+"""Metrics and connection pool configuration tests"""
+
+# run these tests like:
+#
+#    python -m unittest tests.test_metrics     (from app/)
+
+import os
+from unittest import TestCase
+
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "postgresql:///translator-test")
+
+
+from app import app
+from database import engine_options, InstrumentedQueuePool
+import metrics
+
+
+class MetricsTestCase(TestCase):
+    """Testing metrics rendering, the /metrics route and pool options."""
+
+    def setUp(self):
+        app.config["ADMIN_TOKEN"] = "test-admin-token"
+        self.client = app.test_client()
+
+    def test_render(self):
+        """Counters and histograms should render in the Prometheus text format."""
+
+        c = metrics.counter("test_requests_total", "Test requests.", ["route"])
+        c.inc(route="/user")
+        c.inc(2, route="/user")
+        h = metrics.histogram("test_wait_seconds", "Test waits.", buckets=(0.1, 1))
+        h.observe(0.5)
+
+        text = metrics.render()
+        self.assertIn('test_requests_total{route="/user"} 3', text)
+        self.assertIn('test_wait_seconds_bucket{le="0.1"} 0', text)
+        self.assertIn('test_wait_seconds_bucket{le="1"} 1', text)
+        self.assertIn('test_wait_seconds_count 1', text)
+
+    def test_metrics_route_requires_token(self):
+        """/metrics should be hidden without the admin token."""
+
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.client.get("/metrics", headers={"Authorization": "Bearer test-admin-token"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("db_pool_checkouts_total", resp.get_data(as_text=True))
+
+    def test_engine_options(self):
+        """Pool options should come from the environment, with PgBouncer-safe statement timeouts."""
+
+        options = engine_options({"DB_POOL_SIZE": "2", "DB_MAX_OVERFLOW": "0",
+                                  "DB_POOL_PRE_PING": "false", "DB_STATEMENT_TIMEOUT_MS": "5000"})
+        self.assertEqual(options["poolclass"], InstrumentedQueuePool)
+        self.assertEqual(options["pool_size"], 2)
+        self.assertEqual(options["max_overflow"], 0)
+        self.assertFalse(options["pool_pre_ping"])
+        self.assertEqual(options["connect_args"], {"options": "-c statement_timeout=5000"})
+
+        options = engine_options({"DB_STATEMENT_TIMEOUT_MS": "5000", "DB_PGBOUNCER": "1"})
+        self.assertNotIn("connect_args", options)
+        self.assertEqual(options["execution_options"], {"statement_timeout_local": 5000})
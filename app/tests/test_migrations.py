@@ -0,0 +1,67 @@
+"""Migration and query plan tests"""
+
+# run these tests like:
+#
+#    python -m unittest tests.test_migrations     (from app/)
+
+import os
+from unittest import TestCase
+from sqlalchemy import text
+from models import db
+
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "postgresql:///translator-test")
+
+
+from app import app
+import migrations
+from query_plans import check_query_plans
+
+
+class MigrationsTestCase(TestCase):
+    """Testing schema migrations against the test database."""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+
+        with db.engine.begin() as conn:
+            conn.execute(text(f"DROP TABLE IF EXISTS {migrations.MIGRATIONS_TABLE}"))
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def test_discover_in_order(self):
+        """Migrations should be found in revision order."""
+
+        revisions = [migrations.revision(m) for m in migrations.discover()]
+        self.assertEqual(revisions, sorted(revisions))
+        self.assertEqual(revisions[:2], ["0001_baseline", "0002_performance_indexes"])
+
+    def test_upgrade_is_idempotent(self):
+        """Migrations should apply cleanly to a schema that already has their changes, and only once."""
+
+        # Databases old enough to need the migrations still have the text columns
+        # that 0005 and 0010 move into the phrases table.
+        with db.engine.begin() as conn:
+            conn.execute(text("ALTER TABLE translations ADD COLUMN text_from TEXT, ADD COLUMN text_to TEXT"))
+
+        applied = migrations.upgrade(db.engine, echo=lambda msg: None)
+        self.assertEqual(len(applied), len(migrations.discover()))
+
+        self.assertEqual(migrations.upgrade(db.engine, echo=lambda msg: None), [])
+        self.assertEqual(migrations.pending_migrations(db.engine), [])
+
+    def test_stamp(self):
+        """Stamping should mark every migration as applied without running it."""
+
+        migrations.stamp(db.engine)
+        self.assertEqual(migrations.pending_migrations(db.engine), [])
+
+    def test_query_plans(self):
+        """Hot queries should be able to use their indexes."""
+
+        self.assertEqual(check_query_plans(db.engine), [])
@@ -2,37 +2,32 @@
 
 # run these tests like:
 #
-#    python -m unittest test_user_model.py
+#    python -m unittest tests.test_phrasebook_model     (from app/)
 
 import os
-from unittest import TestCase
 from sqlalchemy import exc
 
-from models import db, User, Phrasebook, Translation, PhrasebookTranslation
+from models import db, User, Phrasebook, Translation, PhrasebookTranslation, TranslationNeighbors, CHANGE_LOG_LOCK
 
-os.environ["DATABASE_URL"] = "postgresql:///translator-test"
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "postgresql:///translator-test")
 
 
 from app import app
+from tests.fixtures import DBTestCase
 
 
 # app.config['TESTING'] = True
 # app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
 
-with app.app_context():
-    db.create_all()
-
-
-class PhrasebookModelTestCase(TestCase):
+class PhrasebookModelTestCase(DBTestCase):
     """Testing attributes of User model."""
 
     def setUp(self):
         """Create test client & mock data.
         2 users each with one phrasebook. User1 contains 2 translations. The first is only in user1's phrasebook, the 2nd is in both user1 and user2's phrasebooks"""
 
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
         # create user 1
         u1 = User.signup("testuser", "password")
@@ -136,7 +131,7 @@ class PhrasebookModelTestCase(TestCase):
 
     def tearDown(self):
         """Clean up any fouled transaction."""
-        db.session.rollback()
+        super().tearDown()
 
     def test_phrasebook_model(self):
         """Does basic phrasebook model relationships work?"""
@@ -219,3 +214,81 @@ class PhrasebookModelTestCase(TestCase):
         self.assertNotIn(t1, p1.translations)
         self.assertIsNone(p1_t1)
         self.assertIsNone(t1)
+
+    def test_translation_count(self):
+        """translation_count should follow translations being added and removed, and be repairable."""
+
+        self.assertEqual(self.p1.translation_count, 2)
+        self.assertEqual(self.p2.translation_count, 1)
+
+        self.p1.delete_translation(self.t2)
+        db.session.commit()
+        self.assertEqual(Phrasebook.query.get(self.pid1).translation_count, 1)
+
+        p3 = Phrasebook(name="copy", user_id=self.uid2, lang_from="EN", lang_to="ES")
+        p3.translations.append(self.t1)
+        db.session.add(p3)
+        db.session.commit()
+        self.assertEqual(p3.translation_count, 1)
+
+        # A wrong count is fixed by recounting
+        Phrasebook.query.filter_by(id=self.pid2).update({"translation_count": 7})
+        db.session.commit()
+        self.assertEqual(Phrasebook.recount_translations(), 1)
+        self.assertEqual(Phrasebook.query.get(self.pid2).translation_count, 1)
+
+    def test_change_log_lock(self):
+        """Writing a user's change log entries should hold that user's lock until commit."""
+
+        self.p2_t2.note = "edited"
+        db.session.flush()
+
+        locked = db.session.execute(db.text(
+            "SELECT objid FROM pg_locks WHERE locktype = 'advisory' AND classid = :ns AND objsubid = 2 AND pid = pg_backend_pid()"),
+            {"ns": CHANGE_LOG_LOCK}).scalars().all()
+        self.assertEqual(locked, [self.uid2])
+
+    def test_translation_neighbors(self):
+        """Suggestions should come from translations saved together in public phrasebooks of the same language pair."""
+
+        t3 = Translation(id=3, lang_from="EN", lang_to="ES", text_from="cheese", text_to="queso")
+        t4 = Translation(id=4, lang_from="EN", lang_to="ES", text_from="bread", text_to="pan")
+        p3 = Phrasebook(id=3, name="food", user_id=self.uid2, public=True, lang_from="EN", lang_to="ES")
+        p4 = Phrasebook(id=4, name="more food", user_id=self.uid2, public=True, lang_from="EN", lang_to="ES")
+        db.session.add_all([t3, t4, p3, p4])
+        db.session.commit()
+
+        p3.translations.extend([self.t1, t3, t4])
+        p4.translations.extend([self.t1, t3])
+        db.session.commit()
+        self.assertTrue(TranslationNeighbors.query.get(self.tid1).stale)
+
+        TranslationNeighbors.refresh(db.session.connection())
+        db.session.commit()
+
+        # t2 shares a phrasebook with t1 but is in another language pair
+        self.assertEqual(TranslationNeighbors.query.get(self.tid1).neighbor_ids, [3, 4])
+        self.assertEqual(TranslationNeighbors.recommend([self.tid1]), [t3, t4])
+        self.assertEqual(TranslationNeighbors.recommend([self.tid1, 3]), [t4])
+
+        # Making a phrasebook private queues its translations again
+        p4.public = False
+        db.session.commit()
+        self.assertTrue(TranslationNeighbors.query.get(self.tid1).stale)
+        self.assertTrue(TranslationNeighbors.query.get(3).stale)
+
+    def test_refresh_after_request(self):
+        """A request that commits changes to public phrasebooks should refresh the recommendations it made stale."""
+
+        with app.test_request_context():
+            p3 = Phrasebook(id=3, name="food", user_id=self.uid2, public=True, lang_from="EN", lang_to="ES")
+            t3 = Translation(id=3, lang_from="EN", lang_to="ES", text_from="cheese", text_to="queso")
+            p3.translations.extend([self.t1, t3])
+            db.session.add(p3)
+            db.session.commit()
+            self.assertTrue(TranslationNeighbors.query.get(self.tid1).stale)
+
+            app.process_response(app.response_class())
+
+            self.assertFalse(TranslationNeighbors.query.get(self.tid1).stale)
+            self.assertEqual(TranslationNeighbors.query.get(self.tid1).neighbor_ids, [3])
@@ -2,30 +2,26 @@
 
 # run these tests like:
 #
-#    python -m unittest test_user_model.py
+#    python -m unittest tests.test_phrasebook_views     (from app/)
 
 import os
-from unittest import TestCase
 from sqlalchemy import exc
 from flask import session
 from models import db, User, Phrasebook, Translation, PhrasebookTranslation
 from bs4 import BeautifulSoup
 
-os.environ["DATABASE_URL"] = "postgresql:///translator-test"
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "postgresql:///translator-test")
 
 
 from app import app, CURR_USER_KEY
+from tests.fixtures import DBTestCase
 
 app.config['WTF_CSRF_ENABLED'] = False
 app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
 
-with app.app_context():
-    db.create_all()
-
-
-class PhrasebookViewsTestCase(TestCase):
+class PhrasebookViewsTestCase(DBTestCase):
     """Testing app view functions."""
 
     def setUp(self):
@@ -33,8 +29,7 @@ class PhrasebookViewsTestCase(TestCase):
         2 users each with one phrasebook. User1 contains 2 translations. The first is only in user1's phrasebook, the 2nd is in both user1 and user2's phrasebooks"""
 
 
-        db.drop_all()
-        db.create_all()
+        super().setUp()
         
         self.client = app.test_client()
 
@@ -171,7 +166,7 @@ class PhrasebookViewsTestCase(TestCase):
 
     def tearDown(self):
         """Clean up any fouled transaction."""
-        db.session.rollback()
+        super().tearDown()
     
     
 ##################################################
@@ -213,6 +208,75 @@ class PhrasebookViewsTestCase(TestCase):
             translations_from[2] = "I'm orphaned data"
             self.assertEqual(len(translations_from), 3)    
         
+    def test_user_page_etag(self):
+        """Does /user answer 304 Not Modified while the user's phrasebooks are unchanged, and a new page once they change?"""
+
+        with self.client as c:
+            with c.session_transaction() as session:
+                session[CURR_USER_KEY] = self.uid1
+
+            # First render stores the CSRF token in the session, so use the second page's ETag.
+            c.get("/user")
+            resp = c.get("/user")
+            etag = resp.headers.get("ETag")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIsNotNone(etag)
+
+            resp = c.get("/user", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            # Editing a note changes the phrasebook version and so the page.
+            c.post(f"/{self.pid1}/{self.tid1}/note", data={"note": "new note"})
+            resp = c.get("/user", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers.get("ETag"), etag)
+            self.assertIn("new note", resp.get_data(as_text=True))
+
+    def test_user_page_etag_consumes_flashes(self):
+        """Does a 304 for /user pop the pending flash messages the client's copy already shows?"""
+
+        with self.client as c:
+            with c.session_transaction() as session:
+                session[CURR_USER_KEY] = self.uid1
+            c.get("/user")
+
+            with c.session_transaction() as session:
+                session["_flashes"] = [("success", "Phrasebook updated.")]
+            etag = c.get("/user").headers.get("ETag")
+
+            with c.session_transaction() as session:
+                session["_flashes"] = [("success", "Phrasebook updated.")]
+            resp = c.get("/user", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            with c.session_transaction() as session:
+                self.assertNotIn("_flashes", session)
+
+    def test_user_page_sort_and_filter(self):
+        """Does /user sort by ?sort= (remembered in the session) and show only the ?lang= phrasebooks?"""
+
+        db.session.add(Phrasebook(name="alpha", user_id=self.uid1, lang_from="EN", lang_to="FR"))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            html = c.get("/user?sort=name").get_data(as_text=True)
+            self.assertLess(html.index("alpha"), html.index("phrasebook\n"))
+            self.assertLess(html.index("phrasebook\n"), html.index("secondbook"))
+            self.assertEqual(session["sort"], "name")
+
+            html = c.get("/user?lang=FR").get_data(as_text=True)
+            self.assertIn("alpha", html)
+            self.assertNotIn("secondbook", html)
+            self.assertIn('href="/user?lang=ES"', html)
+            self.assertIn('href="/user?sort=id&lang=FR"', html)
+
+            resp = c.get("/filter/FR")
+            self.assertEqual(resp.location, "http://localhost/user?lang=FR")
+
     def test_add_phrasebook(self):
         """If logged in, does route add new phrasebook and assign it to the current user. If not logged in, does route display unauthorized message and redirect home"""
         
@@ -386,3 +450,57 @@ class PhrasebookViewsTestCase(TestCase):
             note = pb_t.note
             self.assertEqual(resp.status_code, 200)
             self.assertIsNone(note)
+
+
+    def test_in_place_updates(self):
+        """Requests from app.js should get back only the changed fragment or a JSON delta, not a redirect."""
+        
+        xhr = {"X-Requested-With": "XMLHttpRequest"}
+        
+        with self.client as c:
+            with c.session_transaction() as session:
+                session[CURR_USER_KEY] = self.uid1
+            
+            resp = c.post(f"/{self.pid1}/{self.tid1}/note", data={"note": "in place"}, headers=xhr)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("in place", str(resp.data))
+            self.assertNotIn("<html", str(resp.data))
+            
+            resp = c.post(f"/phrasebook/{self.pid1}/edit", data={"name": "renamed"}, headers=xhr)
+            soup = BeautifulSoup(resp.data, "html.parser")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIsNotNone(soup.find(id=f"pb-header-{self.pid1}"))
+            self.assertIn("renamed", soup.get_text())
+            
+            resp = c.post(f"/phrasebook/{self.pid1}/translation/{self.tid1}/delete", headers=xhr)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {"phrasebook_id": self.pid1,
+                                         "translation_id": self.tid1,
+                                         "translation_count": 1})
+            
+            resp = c.post("/translation/add", headers=xhr)
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json, {"error": "No data submitted"})
+
+    def test_other_users_entries_unchanged(self):
+        """Users should not be able to delete or annotate entries in someone else's phrasebook."""
+        
+        xhr = {"X-Requested-With": "XMLHttpRequest"}
+        
+        with self.client as c:
+            with c.session_transaction() as session:
+                session[CURR_USER_KEY] = self.uid1
+            
+            resp = c.post(f"/{self.pid2}/{self.tid2}/note", data={"note": "not mine"}, headers=xhr)
+            self.assertEqual(resp.status_code, 403)
+            self.assertEqual(resp.json, {"error": "Access unauthorized."})
+            
+            resp = c.post(f"/phrasebook/{self.pid2}/translation/{self.tid2}/delete", headers=xhr)
+            self.assertEqual(resp.status_code, 403)
+            
+            resp = c.post(f"/phrasebook/{self.pid2}/translation/{self.tid2}/delete", follow_redirects=True)
+            self.assertIn("Access unauthorized.", str(resp.data))
+            
+            self.assertEqual(PhrasebookTranslation.query.get((self.pid2, self.tid2)).note,
+                             "Tesing is happening! testuser2's testing note.")
+            self.assertIn(Translation.query.get(self.tid2), Phrasebook.query.get(self.pid2).translations)
@@ -0,0 +1,115 @@
+"""Spaced repetition practice tests"""
+
+# run these tests like:
+#
+#    python -m unittest tests.test_practice     (from app/)
+
+import os
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+
+from models import db, User, Phrasebook, Translation, ReviewCard
+from practice import schedule, due_cards, record_reviews
+
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "postgresql:///translator-test")
+
+
+from app import app, CURR_USER_KEY
+from tests.fixtures import DBTestCase
+
+app.config["WTF_CSRF_ENABLED"] = False
+app.config["TESTING"] = True
+app.config["DEBUG_TB_HOSTS"] = ["dont-show-debug-toolbar"]
+
+
+class ScheduleTestCase(TestCase):
+    """Testing the review intervals."""
+
+    def test_schedule(self):
+        new = (0.0, 2.5, 0, 0)
+
+        self.assertEqual(schedule(new, "good"), (1.0, 2.5, 1, 0))
+        self.assertEqual(schedule((1.0, 2.5, 1, 0), "good"), (6.0, 2.5, 2, 0))
+        self.assertEqual(schedule((6.0, 2.5, 2, 0), "good"), (15.0, 2.5, 3, 0))
+
+        interval, ease, reps, lapses = schedule((6.0, 2.5, 2, 0), "easy")
+        self.assertAlmostEqual(interval, 19.5)
+        self.assertAlmostEqual(ease, 2.65)
+
+        # Forgetting a card starts it over and makes it harder, but never below the minimum ease
+        self.assertEqual(schedule((15.0, 2.5, 3, 0), "again"), (0.0, 2.3, 0, 1))
+        self.assertEqual(schedule((15.0, 1.3, 3, 0), "again")[1], 1.3)
+
+
+class PracticeTestCase(DBTestCase):
+    """Testing review cards and the practice API."""
+
+    def setUp(self):
+        """A user with one phrasebook of 2 translations."""
+
+        super().setUp()
+
+        self.client = app.test_client()
+
+        u = User.signup("testuser", "password")
+        u.id = 111
+        db.session.commit()
+        self.uid = 111
+
+        pb = Phrasebook(id=111, name="phrasebook", user_id=self.uid, lang_from="EN", lang_to="ES")
+        t1 = Translation(id=111, lang_from="EN", lang_to="ES", text_from="cheese", text_to="queso")
+        t2 = Translation(id=222, lang_from="EN", lang_to="ES", text_from="bread", text_to="pan")
+        db.session.add_all([pb, t1, t2])
+        db.session.commit()
+
+        pb.translations.extend([t1, t2])
+        db.session.commit()
+
+        self.pid = 111
+
+    def test_cards_created_due(self):
+        """Saving a translation to a phrasebook should give it a card that is due right away."""
+
+        self.assertEqual(ReviewCard.query.filter_by(user_id=self.uid).count(), 2)
+
+        due = due_cards(self.uid, 10)
+        self.assertEqual({(c["phrasebook_id"], c["translation_id"]) for c in due}, {(111, 111), (111, 222)})
+        self.assertEqual({c["text_to"] for c in due}, {"queso", "pan"})
+
+    def test_record_reviews(self):
+        """Answers should move cards out of the due list, building on each other within a batch."""
+
+        now = datetime.now(timezone.utc)
+        updated = record_reviews(self.uid, [(111, 111, "good"), (111, 111, "good"), (111, 999, "good")], now)
+        db.session.commit()
+
+        self.assertEqual(updated, [(111, 111)])
+        card = ReviewCard.query.get((111, 111))
+        self.assertEqual((card.interval, card.reps), (6.0, 2))
+        self.assertAlmostEqual(card.due_at.timestamp(), (now + timedelta(days=6)).timestamp(), places=3)
+
+        self.assertEqual([c["translation_id"] for c in due_cards(self.uid, 10)], [222])
+        self.assertEqual(len(due_cards(self.uid, 10, now=now + timedelta(days=7))), 2)
+
+    def test_practice_api(self):
+        """The API should list due cards and accept a batch of answers."""
+
+        with self.client as c:
+            with c.session_transaction() as session:
+                session[CURR_USER_KEY] = self.uid
+
+            resp = c.get(f"/api/v1/practice/due?limit=1&phrasebook_id={self.pid}")
+            self.assertEqual(len(resp.get_json()["data"]), 1)
+
+            resp = c.post("/api/v1/practice/reviews",
+                          json={"reviews": [{"phrasebook_id": self.pid, "translation_id": 111, "grade": "easy"},
+                                            {"phrasebook_id": self.pid, "translation_id": 222, "grade": "again"}]})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_json(), {"updated": 2})
+
+            resp = c.get("/api/v1/practice/due")
+            self.assertEqual(resp.get_json()["data"], [])
+
+            resp = c.post("/api/v1/practice/reviews",
+                          json={"reviews": [{"phrasebook_id": self.pid, "translation_id": 111, "grade": "meh"}]})
+            self.assertEqual(resp.status_code, 400)
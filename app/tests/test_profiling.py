@@ -0,0 +1,83 @@
+"""Request profiling tests"""
+
+# run these tests like:
+#
+#    python -m unittest tests.test_profiling     (from app/)
+
+import os
+import threading
+import time
+from unittest import TestCase
+
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "postgresql:///translator-test")
+
+
+from app import app
+from models import db
+from profiling import Sampler, profile_signature, request_profiles
+from tests.fixtures import create_schema
+
+ADMIN = {"X-Admin-Token": "test-admin-token"}
+
+
+class ProfilingTestCase(TestCase):
+    """Testing the sampler and the profiling hooks."""
+
+    def setUp(self):
+        app.config["ADMIN_TOKEN"] = "test-admin-token"
+        app.config["PROFILE_INTERVAL"] = 0.001
+        with app.app_context():
+            create_schema()
+            with db.engine.begin() as conn:
+                conn.execute(request_profiles.delete())
+        self.client = app.test_client()
+
+    def stored(self):
+        with app.app_context():
+            with db.engine.connect() as conn:
+                return conn.execute(request_profiles.select()).all()
+
+    def test_sampler(self):
+        """The sampler should count collapsed stacks of the other thread, outermost frame first."""
+
+        def sleepy_work():
+            time.sleep(0.05)
+
+        thread = threading.Thread(target=sleepy_work)
+        thread.start()
+        sampler = Sampler(thread.ident, 0.001)
+        sampler.start()
+        thread.join()
+        stacks = sampler.stop()
+
+        self.assertTrue(stacks)
+        stack = stacks.most_common(1)[0][0]
+        self.assertTrue(stack.startswith("_bootstrap"))
+        self.assertIn(";sleepy_work (test_profiling.py:", stack)
+
+    def test_signed_request_is_profiled(self):
+        """Only a request signed for its own path is profiled; profiles are admin only."""
+
+        expires = time.time() + 60
+        self.client.get("/metrics?_profile=" + profile_signature("/user", "test-admin-token", expires), headers=ADMIN)
+        self.client.get("/metrics?_profile=wrong", headers=ADMIN)
+        self.client.get("/metrics?_profile=" + profile_signature("/metrics", "test-admin-token", time.time() - 1),
+                        headers=ADMIN)
+        self.assertEqual(self.stored(), [])
+
+        resp = self.client.get("/metrics?_profile=" + profile_signature("/metrics", "test-admin-token", expires), headers=ADMIN)
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.client.get("/admin/profiles")
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.client.get("/admin/profiles", headers=ADMIN)
+        [profile] = resp.get_json()["data"]
+        self.assertEqual((profile["endpoint"], profile["status"], profile["reason"]),
+                         ("metrics.show_metrics", 200, "requested"))
+
+        resp = self.client.get(f"/admin/profiles/{profile['id']}", headers=ADMIN)
+        self.assertEqual(resp.status_code, 200)
+        for line in resp.get_data(as_text=True).splitlines():
+            stack, count = line.rsplit(" ", 1)
+            self.assertTrue(count.isdigit())
@@ -2,30 +2,26 @@
 
 # run these tests like:
 #
-#    python -m unittest test_user_model.py
+#    python -m unittest tests.test_public_views     (from app/)
 
 import os
-from unittest import TestCase
-from sqlalchemy import exc
+from sqlalchemy import event, exc
 from flask import session
 from models import db, User, Phrasebook, Translation, PhrasebookTranslation
 from bs4 import BeautifulSoup
 
-os.environ["DATABASE_URL"] = "postgresql:///translator-test"
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "postgresql:///translator-test")
 
 
 from app import app, CURR_USER_KEY
+from tests.fixtures import DBTestCase
 
 app.config['WTF_CSRF_ENABLED'] = False
 app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
 
-with app.app_context():
-    db.create_all()
-
-
-class PublicViewsTestCase(TestCase):
+class PublicViewsTestCase(DBTestCase):
     """Testing app view functions."""
 
     def setUp(self):
@@ -33,8 +29,7 @@ class PublicViewsTestCase(TestCase):
         2 users each with one phrasebook. User1 contains 2 translations. The first is only in user1's phrasebook, the 2nd is in both user1 and user2's phrasebooks"""
 
 
-        db.drop_all()
-        db.create_all()
+        super().setUp()
         
         self.client = app.test_client()
 
@@ -158,7 +153,7 @@ class PublicViewsTestCase(TestCase):
 
     def tearDown(self):
         """Clean up any fouled transaction."""
-        db.session.rollback()
+        super().tearDown()
 
 ##################################################
 # Public routes tests
@@ -206,6 +201,60 @@ class PublicViewsTestCase(TestCase):
             self.assertEqual(len(translations_from), 3)
             
 
+    def test_public_page_etag(self):
+        """Does /public answer 304 Not Modified until a public phrasebook changes?"""
+
+        with self.client as c:
+            with c.session_transaction() as session:
+                session[CURR_USER_KEY] = self.uid2
+
+            c.get("/public")
+            resp = c.get("/public")
+            etag = resp.headers.get("ETag")
+            self.assertEqual(resp.status_code, 200)
+
+            resp = c.get("/public", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            p1 = Phrasebook.query.get(self.pid1)
+            p1.name = "renamed phrasebook"
+            db.session.commit()
+
+            resp = c.get("/public", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("renamed phrasebook", resp.get_data(as_text=True))
+
+    def test_public_page_query_count(self):
+        """Does /public load its phrasebooks' owners and translations without a query per phrasebook?"""
+
+        statements = []
+        record = lambda *args: statements.append(args[2])
+        event.listen(self.connection, "before_cursor_execute", record)
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as session:
+                    session[CURR_USER_KEY] = self.uid2
+
+                c.get("/public")
+                del statements[:]
+                c.get("/public")
+                first = len(statements)
+
+                for i in range(3):
+                    pb = Phrasebook(name=f"extra {i}", user_id=self.uid1, lang_from="EN", lang_to="ES", public=True)
+                    db.session.add(pb)
+                    pb.translations.append(self.t3)
+                db.session.commit()
+
+                del statements[:]
+                resp = c.get("/public")
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn("extra 2", resp.get_data(as_text=True))
+                self.assertEqual(len(statements), first)
+        finally:
+            event.remove(self.connection, "before_cursor_execute", record)
+
     def test_add_public_translation(self):
         """Does route add public translation to users's selected phrasebooks.
         If no data is submitted, appropriate alret should be shown and redirected to public page."""
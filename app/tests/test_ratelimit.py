@@ -0,0 +1,101 @@
+"""Rate limiting tests"""
+
+# run these tests like:
+#
+#    python -m unittest tests.test_ratelimit     (from app/)
+
+import os
+from unittest import TestCase
+
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "postgresql:///translator-test")
+
+
+from app import app
+from tests.fixtures import create_schema
+import ratelimit
+from ratelimit import MemoryStore, DatabaseStore, parse_limits
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+
+class RateLimitTestCase(TestCase):
+    """Testing token buckets and 429 responses."""
+
+    def setUp(self):
+        self.limits = app.config["RATE_LIMITS"]
+        self.store = app.config["RATE_LIMIT_STORE"]
+        ratelimit.memory_store.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config["RATE_LIMITS"] = self.limits
+        app.config["RATE_LIMIT_STORE"] = self.store
+        ratelimit.memory_store.clear()
+
+    def test_parse_limits(self):
+        """Limits from the environment should parse into (scope, count, seconds) per endpoint."""
+
+        self.assertEqual(parse_limits("views.translate=user:3/60,global:100/1;api.sync=ip:5/10"),
+                         {"views.translate": [("user", 3, 60.0), ("global", 100, 1.0)],
+                          "api.sync": [("ip", 5, 10.0)]})
+        self.assertIs(parse_limits(None), ratelimit.DEFAULT_LIMITS)
+        self.assertRaises(ValueError, parse_limits, "views.translate=everyone:3/60")
+
+    def test_memory_bucket(self):
+        """A bucket should allow a burst, then refuse until it refills."""
+
+        store = MemoryStore()
+        self.assertEqual([store.take("k", 2, 0.5)[0] for i in range(3)], [True, True, False])
+        self.assertEqual(store.take("k", 2, 0.5), (False, 2))
+        self.assertTrue(store.take("other", 2, 0.5)[0])
+
+    def test_database_bucket(self):
+        """The shared store should give the same answers as the in-process one."""
+
+        with app.app_context():
+            create_schema()
+            store = DatabaseStore()
+            store.clear()
+            try:
+                self.assertEqual([store.take("k", 2, 0.5)[0] for i in range(3)], [True, True, False])
+                allowed, wait = store.take("k", 2, 0.5)
+                self.assertFalse(allowed)
+                self.assertIn(wait, (1, 2))
+            finally:
+                store.clear()
+
+    def test_translate_rate_limited(self):
+        """Requests over the route's limit should get a 429 with Retry-After."""
+
+        app.config["RATE_LIMITS"] = {"views.translate": [("user", 1, 60), ("ip", 2, 60)]}
+
+        responses = [self.client.post("/translate", data={}) for i in range(3)]
+
+        self.assertEqual([r.status_code for r in responses], [302, 302, 429])
+        self.assertEqual(responses[2].headers["Retry-After"], "30")
+        self.assertEqual(self.client.get("/").status_code, 200)
+
+    def test_refused_request_puts_tokens_back(self):
+        """A request refused by one bucket shouldn't use up the others."""
+
+        app.config["RATE_LIMITS"] = {"views.translate": [("ip", 2, 60), ("global", 1, 60)]}
+
+        responses = [self.client.post("/translate", data={}) for i in range(3)]
+        self.assertEqual([r.status_code for r in responses], [302, 429, 429])
+
+        ratelimit.memory_store.buckets.pop("views.translate:global")
+        self.assertEqual(self.client.post("/translate", data={}).status_code, 302)
+
+    def test_api_rate_limited(self):
+        """API routes should get their 429 as a JSON error."""
+
+        app.config["RATE_LIMITS"] = {"api.sync": [("global", 1, 60)]}
+
+        self.client.get("/api/v1/sync")
+        resp = self.client.get("/api/v1/sync")
+
+        self.assertEqual(resp.status_code, 429)
+        self.assertIn("Too many requests", resp.get_json()["error"])
+        self.assertEqual(resp.headers["Retry-After"], "60")
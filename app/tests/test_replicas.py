@@ -0,0 +1,116 @@
+"""Read replica routing tests"""
+
+# run these tests like:
+#
+#    python -m unittest tests.test_replicas     (from app/)
+
+import os
+import threading
+from unittest import mock
+from models import db, User
+
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "postgresql:///translator-test")
+
+
+from app import app, CURR_USER_KEY
+from tests.fixtures import DBTestCase
+from flask import g
+import replicas
+
+app.config["WTF_CSRF_ENABLED"] = False
+app.config["TESTING"] = True
+app.config["DEBUG_TB_HOSTS"] = ["dont-show-debug-toolbar"]
+
+
+class ReplicaRoutingTestCase(DBTestCase):
+    """Testing which requests may read from a replica."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = app.test_client()
+
+        u = User.signup("testuser", "password")
+        u.id = 111
+        db.session.commit()
+        self.uid = 111
+
+    def tearDown(self):
+        super().tearDown()
+
+    def test_replica_binds(self):
+        """Replica URLs should become numbered binds."""
+
+        self.assertEqual(replicas.replica_binds(" postgresql://r1/db, postgresql://r2/db?connect_timeout=5,"),
+                         {"replica_0": "postgresql://r1/db?connect_timeout=2",
+                          "replica_1": "postgresql://r2/db?connect_timeout=5"})
+        self.assertEqual(replicas.replica_binds(None), {})
+
+    def test_lag_check_single_flight(self):
+        """While one thread checks a replica, others should get the cached lag instead of connecting."""
+
+        health = replicas.ReplicaHealth()
+        started = threading.Event()
+        release = threading.Event()
+
+        class SlowEngine:
+            def connect(self):
+                started.set()
+                release.wait(5)
+                raise OSError("unreachable")
+
+        checker = threading.Thread(target=health.lag, args=("replica_0", SlowEngine()))
+        checker.start()
+        started.wait(5)
+
+        class UnusedEngine:
+            def connect(self):
+                raise AssertionError("second lag check while one is running")
+
+        self.assertEqual(health.lag("replica_0", UnusedEngine()), float("inf"))
+        release.set()
+        checker.join()
+        self.assertEqual(health.checking, set())
+
+    def test_wants_replica(self):
+        """Only GETs to read-only views outside the read-your-writes window may use a replica."""
+
+        with app.test_request_context("/public"):
+            self.assertTrue(replicas.wants_replica())
+
+        with app.test_request_context("/user/edit", method="POST"):
+            self.assertFalse(replicas.wants_replica())
+
+        with app.test_request_context("/logout"):
+            self.assertFalse(replicas.wants_replica())
+
+    def test_one_replica_per_request(self):
+        """Every read of a request should go to the replica picked for its first read."""
+
+        binds = {"replica_0": "postgresql://r0/db", "replica_1": "postgresql://r1/db"}
+        engines = {key: object() for key in binds}
+        fake_db = type("FakeDB", (), {"get_engine": lambda self, app, bind: engines[bind]})()
+
+        with mock.patch.dict(app.config, {"SQLALCHEMY_BINDS": binds}), \
+                mock.patch.object(replicas.health, "lag", return_value=0):
+            for i in range(5):
+                with app.test_request_context("/public"):
+                    picked = {replicas.request_replica(app, fake_db) for j in range(20)}
+                    self.assertEqual(len(picked), 1)
+                    self.assertIn(picked.pop(), engines.values())
+
+    def test_write_starts_sticky_window(self):
+        """A request that writes should send the user's next reads to the primary."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid
+
+            c.post("/phrasebook/add", data={"name": "new", "lang_from": "EN", "lang_to": "ES"})
+            self.assertTrue(g.get("db_wrote"))
+
+            with c.session_transaction() as sess:
+                self.assertIn(replicas.WRITTEN_AT_KEY, sess)
+
+            c.get("/public")
+            self.assertFalse(replicas.wants_replica())
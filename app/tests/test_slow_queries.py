@@ -0,0 +1,119 @@
+"""Slow query log tests"""
+
+# run these tests like:
+#
+#    python -m unittest tests.test_slow_queries     (from app/)
+
+import os
+from unittest import TestCase, mock
+
+from sqlalchemy import text
+
+from models import db
+
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "postgresql:///translator-test")
+
+
+from app import app
+from slow_queries import SlowQueryLog, check_repeats, fingerprint, numbered_placeholders, params_shape, slow_query_log
+from tests.fixtures import DBTestCase
+
+ADMIN = {"X-Admin-Token": "test-admin-token"}
+
+
+class FingerprintTestCase(TestCase):
+    """Testing fingerprints and the in-memory log."""
+
+    def test_fingerprint(self):
+        """Runs of a query with different values should share a fingerprint."""
+
+        fp1, normalized = fingerprint("SELECT * FROM users WHERE id = 5 AND username = 'o''neil'")
+        fp2, _ = fingerprint("SELECT *  FROM users\n WHERE id = 17 AND username = 'bob'")
+        self.assertEqual(fp1, fp2)
+        self.assertEqual(normalized, "SELECT * FROM users WHERE id = ? AND username = ?")
+
+        fp3, normalized = fingerprint("SELECT * FROM users WHERE id IN (%(id_1)s, %(id_2)s, %(id_3)s)")
+        fp4, _ = fingerprint("SELECT * FROM users WHERE id IN (%(id_1)s)")
+        self.assertEqual(fp3, fp4)
+        self.assertEqual(normalized, "SELECT * FROM users WHERE id IN (...)")
+
+        self.assertNotEqual(fp1, fp3)
+
+    def test_params_shape(self):
+        """Parameters should be described by type only."""
+
+        self.assertEqual(params_shape({"name": "secret", "id": 1}), "{id: int, name: str}")
+        self.assertEqual(params_shape(("secret", 1.5)), "(str, float)")
+        self.assertEqual(params_shape([{"id": 1}, {"id": 2}], executemany=True), "2 x {id: int}")
+
+    def test_numbered_placeholders(self):
+        """psycopg2 placeholders should become $n, with a repeated name keeping its number."""
+
+        self.assertEqual(numbered_placeholders("SELECT %(a)s, %(b)s, %(a)s LIKE 'x%%'", {"a": 1, "b": 2}),
+                         "SELECT $1, $2, $1 LIKE 'x%'")
+        self.assertEqual(numbered_placeholders("SELECT %s, %s", (1, 2)), "SELECT $1, $2")
+        self.assertEqual(numbered_placeholders("SELECT 'x%%'", None), "SELECT 'x%%'")
+
+    def test_log(self):
+        """The report should rank by total time; the cheapest fingerprint makes room for new ones."""
+
+        log = SlowQueryLog(max_fingerprints=2)
+        log.record("a", "SELECT a", 300.0, "()", "home", "-", "plan a", 0)
+        log.record("b", "SELECT b", 250.0, "()", "home", "-", None, 0)
+        log.record("b", "SELECT b", 250.0, "()", "user", "-", None, 0)
+        log.record("c", "SELECT c", 1000.0, "()", "home", "-", None, 0)
+
+        slow = log.report()["slow"]
+        self.assertEqual([e["fingerprint"] for e in slow], ["c", "b"])
+        self.assertEqual((slow[1]["count"], slow[1]["mean_ms"]), (2, 250.0))
+        self.assertEqual(slow[1]["routes"], {"home": 1, "user": 1})
+
+        # The first slow run is explained; the next one waits for SLOW_QUERY_EXPLAIN_EVERY
+        self.assertTrue(log.wants_explain("d", 0, 300))
+        self.assertFalse(log.wants_explain("c", 1, 300))
+        self.assertTrue(log.wants_explain("c", 301, 300))
+
+
+class SlowQueryTestCase(DBTestCase):
+    """Testing slow and repeated statements against the database."""
+
+    def setUp(self):
+        super().setUp()
+        app.config["ADMIN_TOKEN"] = "test-admin-token"
+        slow_query_log.clear()
+        self.client = app.test_client()
+
+    def test_slow_query_explained(self):
+        """A slow SELECT should be logged with a generic plan, without its parameter values,
+        running it again or breaking the transaction."""
+
+        with mock.patch.dict(app.config, {"SLOW_QUERY_MS": 20}):
+            db.session.execute(text("SELECT pg_sleep(0.05), (SELECT id FROM users WHERE username = :name)"),
+                               {"name": "bob"})
+            db.session.execute(text("SELECT 1"))
+
+        [entry] = slow_query_log.report()["slow"]
+        self.assertEqual(entry["statement"], "SELECT pg_sleep(?), (SELECT id FROM users WHERE username = ?)")
+        self.assertIn("$1", entry["plan"])
+        self.assertNotIn("bob", entry["plan"])
+        self.assertNotIn("actual time", entry["plan"])
+        self.assertIn("tests/test_slow_queries.py", next(iter(entry["call_sites"])))
+
+        resp = self.client.get("/admin/slow-queries")
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.client.get("/admin/slow-queries", headers=ADMIN)
+        self.assertEqual([e["fingerprint"] for e in resp.get_json()["slow"]], [entry["fingerprint"]])
+
+    def test_repeated_query(self):
+        """A statement run SLOW_QUERY_REPEAT times in one request should be reported."""
+
+        with mock.patch.dict(app.config, {"SLOW_QUERY_REPEAT": 3}), app.test_request_context("/user"):
+            for user_id in (1, 2, 3):
+                db.session.execute(text("SELECT id FROM users WHERE id = :id"), {"id": user_id})
+            db.session.execute(text("SELECT 1"))
+            check_repeats(None)
+
+        [entry] = slow_query_log.report()["repeated"]
+        self.assertEqual((entry["requests"], entry["max_per_request"]), (1, 3))
+        self.assertEqual(entry["statement"], "SELECT id FROM users WHERE id = ?")
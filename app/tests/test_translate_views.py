@@ -2,30 +2,26 @@
 
 # run these tests like:
 #
-#    python -m unittest test_user_model.py
+#    python -m unittest tests.test_translate_views     (from app/)
 
 import os
-from unittest import TestCase
 from sqlalchemy import exc
 from flask import session
 from models import db, User, Phrasebook, Translation, PhrasebookTranslation
 from bs4 import BeautifulSoup
 
-os.environ["DATABASE_URL"] = "postgresql:///translator-test"
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "postgresql:///translator-test")
 
 
 from app import app, CURR_USER_KEY
+from tests.fixtures import DBTestCase
 
 app.config['WTF_CSRF_ENABLED'] = False
 app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
 
-with app.app_context():
-    db.create_all()
-
-
-class ViewsTestCase(TestCase):
+class ViewsTestCase(DBTestCase):
     """Testing app view functions."""
 
     def setUp(self):
@@ -33,8 +29,7 @@ class ViewsTestCase(TestCase):
         2 users each with one phrasebook. User1 contains 2 translations. The first is only in user1's phrasebook, the 2nd is in both user1 and user2's phrasebooks"""
 
 
-        db.drop_all()
-        db.create_all()
+        super().setUp()
         
         self.client = app.test_client()
 
@@ -52,7 +47,7 @@ class ViewsTestCase(TestCase):
 
     def tearDown(self):
         """Clean up any fouled transaction."""
-        db.session.rollback()
+        super().tearDown()
 
 
 ##################################################
@@ -130,3 +125,38 @@ class ViewsTestCase(TestCase):
             resp = c.get("/clear", follow_redirects=True) 
             self.assertNotIn("Hola mundo!", str(resp.data))
             self.assertIsNone(session.get("last_translation"))
+
+
+    def test_translate_async(self):
+        """Does the ASGI /translate path translate with the async client and store the result in the session?"""
+        import asyncio
+        from asgi import application
+
+        body = b"translate_text=hello+world%21&source_lang=EN&target_lang=ES"
+        scope = {"type": "http", "method": "POST", "path": "/translate", "root_path": "",
+                 "query_string": b"", "http_version": "1.1", "scheme": "http",
+                 "server": ("localhost", 80), "client": ("127.0.0.1", 1234),
+                 "headers": [(b"host", b"localhost"),
+                             (b"content-type", b"application/x-www-form-urlencoded"),
+                             (b"content-length", str(len(body)).encode())]}
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            sent.append(message)
+
+        async def run():
+            await application(scope, receive, send)
+            await application.translator.aclose()
+
+        asyncio.run(run())
+
+        start = sent[0]
+        self.assertEqual(start["status"], 302)
+        headers = dict(start["headers"])
+        cookie = headers[b"set-cookie"].decode().split(";")[0].split("=", 1)[1]
+        sess = app.session_interface.get_signing_serializer(app).loads(cookie)
+        self.assertEqual(sess['lang_to'], "ES")
+        self.assertEqual(sess['last_translation']['text_to'], "¡Hola mundo!")
@@ -2,37 +2,32 @@
 
 # run these tests like:
 #
-#    python -m unittest test_user_model.py
+#    python -m unittest tests.test_translation_model     (from app/)
 
 import os
-from unittest import TestCase
 from sqlalchemy import exc
 
-from models import db, User, Phrasebook, Translation, PhrasebookTranslation
+from models import db, User, Phrasebook, Translation, PhrasebookTranslation, Phrase
 
-os.environ["DATABASE_URL"] = "postgresql:///translator-test"
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "postgresql:///translator-test")
 
 
 from app import app
+from tests.fixtures import DBTestCase
 
 
 # app.config['TESTING'] = True
 # app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
 
-with app.app_context():
-    db.create_all()
-
-
-class PhrasebookModelTestCase(TestCase):
+class PhrasebookModelTestCase(DBTestCase):
     """Testing attributes of User model."""
 
     def setUp(self):
         """Create test client & mock data.
         2 users each with one phrasebook. User1 contains 2 translations. The first is only in user1's phrasebook, the 2nd is in both user1 and user2's phrasebooks"""
 
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
         # create user 1
         u1 = User.signup("testuser", "password")
@@ -155,7 +150,7 @@ class PhrasebookModelTestCase(TestCase):
 
     def tearDown(self):
         """Clean up any fouled transaction."""
-        db.session.rollback()
+        super().tearDown()
 
     def test_phrasebook_model(self):
         """Does basic translation model relationships work?"""
@@ -201,4 +196,23 @@ class PhrasebookModelTestCase(TestCase):
         self.assertEqual(t1_dict.get('lang_to'), self.t1.lang_to)
         self.assertEqual(t1_dict.get('text_from'), self.t1.text_from)
         self.assertEqual(t1_dict.get('text_to'), self.t1.text_to)
-        self.assertEqual(t1_dict.get('id'), self.t1.id)
\ No newline at end of file
+        self.assertEqual(t1_dict.get('id'), self.t1.id)
+
+    def test_interned_phrases(self):
+        """Translations sharing a text should share its phrase, and filters on text should find them."""
+
+        t4 = Translation(lang_from="EN", lang_to="FR", text_from="I'm orphaned data", text_to="Je suis des données orphelines")
+        db.session.add(t4)
+        db.session.commit()
+
+        self.assertEqual(t4.phrase_from_id, self.t3.phrase_from_id)
+        self.assertEqual(Phrase.query.filter_by(text="I'm orphaned data").count(), 1)
+
+        db.session.expunge_all()
+        found = Translation.query.filter_by(text_from="I'm orphaned data").order_by(Translation.id).all()
+        self.assertEqual([t.text_to for t in found], ["Soy datos huérfanos", "Je suis des données orphelines"])
+
+        self.assertEqual(set(Translation.find_existing([("EN", "FR", "I'm orphaned data", "Je suis des données orphelines"),
+                                                        ("DE", "FR", "I'm orphaned data", "Je suis des données orphelines"),
+                                                        ("EN", "ES", "What a test!", "Quel test!")])),
+                         {("EN", "FR", "I'm orphaned data", "Je suis des données orphelines")})
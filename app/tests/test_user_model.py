@@ -2,37 +2,32 @@
 
 # run these tests like:
 #
-#    python -m unittest test_user_model.py
+#    python -m unittest tests.test_user_model     (from app/)
 
 import os 
-from unittest import TestCase
 from sqlalchemy import exc 
 
 from models import db, User, Phrasebook, Translation, PhrasebookTranslation
 
-os.environ['DATABASE_URL'] = "postgresql:///translator-test"
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgresql:///translator-test")
 
 
 from app import app 
+from tests.fixtures import DBTestCase
 
 
 # app.config['TESTING'] = True
 # app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
-
-
-with app.app_context():
-    db.create_all()
     
     
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DBTestCase):
     """Testing attributes of User model."""
     
     def setUp(self):
         """Create test client & mock data.
         2 users each with one phrasebook. User1 contains 2 translations. The first is only in user1's phrasebook, the 2nd is in both user1 and user2's phrasebooks"""
         
-        db.drop_all()
-        db.create_all()
+        super().setUp()
         
         # create user 1
         u1 = User.signup("testuser", "password")
@@ -134,7 +129,7 @@ class UserModelTestCase(TestCase):
         
     def tearDown(self):
         """Clean up any fouled transaction."""
-        db.session.rollback()
+        super().tearDown()
     
     def test_user_model(self):
         """Does basic model work?"""
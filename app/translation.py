@@ -0,0 +1,183 @@
+"""DeepL access for Translation Buddy: the per-process client, the language tables and
+the cache of DeepL results that lets a repeated translation skip DeepL."""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+import deepl
+
+import metrics
+from dispatcher import BULK, dispatcher
+from language_detection import detect_language
+
+try:
+    from secret import API_AUTH_KEY
+except ImportError:
+    API_AUTH_KEY = None
+
+API_AUTH_KEY = os.environ.get("API_AUTH_KEY", API_AUTH_KEY)
+
+# DeepL accepts at most 50 texts per translate request.
+DEEPL_BATCH_SIZE = 50
+
+# The source language choice that asks for the language to be detected.
+AUTO_DETECT = "auto"
+
+TRANSLATION_CACHE_SIZE = int(os.environ.get("TRANSLATION_CACHE_SIZE", 10000))
+
+LOOKUPS = metrics.counter("translation_lookups_total", "Translations by where the result came from.", ["source"])
+DETECTIONS = metrics.counter("language_detections_total", "Auto-detect requests by who detected the language.", ["detector"])
+
+logger = logging.getLogger("deepl.calls")
+
+_translator = None
+
+
+def translator():
+    """Return this process's DeepL client. Each worker creates its own after the fork,
+    so workers never share the master's HTTP connections."""
+
+    global _translator
+    if _translator is None:
+        _translator = deepl.Translator(API_AUTH_KEY)
+
+    return _translator
+
+
+def reset_translator():
+    """Forget the client inherited from a parent process."""
+
+    global _translator
+    _translator = None
+
+
+@lru_cache(maxsize=None)
+def load_languages():
+    """Fetch the (code, name) language tables from DeepL, once per process.
+    Under gunicorn --preload this runs in the master and workers share the result."""
+
+    source = tuple((l.code, l.name) for l in translator().get_source_languages())
+    target = tuple((l.code, l.name) for l in translator().get_target_languages())
+
+    return source, target
+
+
+def target_language(lang):
+    """Map a phrasebook language (a source language code such as "EN") to a DeepL
+    target code, picking the first regional variant ("EN-GB") where DeepL needs one."""
+
+    codes = [code for code, name in load_languages()[1]]
+    if lang in codes:
+        return lang
+
+    return next((code for code in codes if code.startswith(lang + "-")), lang)
+
+
+def deepl_translate(text, source_lang, target_lang):
+    """translator().translate_text for a text or a list of texts, logged with its size and duration."""
+
+    texts = [text] if isinstance(text, str) else text
+    fields = {"texts": len(texts), "chars": sum(map(len, texts)),
+              "source_lang": source_lang, "target_lang": target_lang}
+
+    started = time.perf_counter()
+    try:
+        result = translator().translate_text(text, source_lang=source_lang, target_lang=target_lang)
+    except deepl.DeepLException as e:
+        fields["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        logger.warning("DeepL request failed: %s", e, extra=dict(fields, error=type(e).__name__))
+        raise
+
+    fields["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info("DeepL request", extra=fields)
+
+    return result
+
+
+def translate_texts(texts, source_lang, target_lang, priority=BULK, user=None):
+    """Translate a list of texts with as few DeepL requests as possible. Returns the translated texts in order.
+    Each request waits for a dispatcher slot of the given priority, taking turns with other users' work."""
+
+    out = []
+    for i in range(0, len(texts), DEEPL_BATCH_SIZE):
+        batch = texts[i:i + DEEPL_BATCH_SIZE]
+        with dispatcher.slot(priority, user=user, cost=len(batch)):
+            results = deepl_translate(batch, source_lang, target_lang)
+        out.extend(result.text for result in results)
+
+    return out
+
+
+class TranslationCache:
+    """A thread-safe LRU map of (source_lang, target_lang, text) -> translated text."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            text_to = self.entries.get(key)
+            if text_to is not None:
+                self.entries.move_to_end(key)
+            return text_to
+
+    def set(self, key, text_to):
+        with self.lock:
+            self.entries[key] = text_to
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+translation_cache = TranslationCache(TRANSLATION_CACHE_SIZE)
+
+
+def resolve_source_language(text, source_lang):
+    """Return source_lang, or for AUTO_DETECT the language guessed locally (None if not confident).
+    The guess is only used to look up the cache: DeepL still detects the language of a miss
+    (see deepl_source_language), since a wrong guess would give a wrong translation."""
+
+    if source_lang and source_lang != AUTO_DETECT:
+        return source_lang
+
+    detected = detect_language(text, [code for code, name in load_languages()[0]])
+    DETECTIONS.inc(detector="local" if detected else "deepl")
+
+    return detected
+
+
+def deepl_source_language(source_lang):
+    """Return the source_lang to send DeepL: None for AUTO_DETECT, so DeepL detects it."""
+
+    return source_lang if source_lang and source_lang != AUTO_DETECT else None
+
+
+def lookup_translation(text, source_lang, target_lang):
+    """Return a cached DeepL translation of text, or None if DeepL has to be asked.
+    Saved translations aren't consulted: users can save any text they like."""
+
+    if source_lang is None:
+        return None
+
+    text_to = translation_cache.get((source_lang, target_lang, text))
+    if text_to is not None:
+        LOOKUPS.inc(source="cache")
+
+    return text_to
+
+
+def remember_result(text, source_lang, target_lang, text_to):
+    """Cache a translation fetched from DeepL."""
+
+    LOOKUPS.inc(source="deepl")
+    translation_cache.set((source_lang, target_lang, text), text_to)